@@ -30,21 +30,40 @@
 # Any modifications to this file must keep this entire header intact.
 
 import json
+import os
 from typing import Optional
 
+from anki import hooks
+from anki.collection import Collection
 from aqt import gui_hooks, mw
-from aqt.utils import showCritical, showInfo
+from aqt.utils import showCritical, showInfo, tooltip
 
-from prompts import Prompts
+from profiling import HookProfiler
+from prompts import Prompts, PromptBudget
+from review_traces import ReviewTraceRecorder
 from notes_wrappers import NotesWrapperFactory
+from near_duplicates import NearDuplicateIndex
+from note_versions import NoteVersions
+from rephrasing_filter import RephrasingFilter
+from synced_rephrasings import SyncedRephrasings
 from constants import TUTOR_NAME, ADD_ON_ID, DISPLAY_ORIGINAL_QUESTION_CONFIG_KEY, EASE_TARGET_CONFIG_KEY, \
-    MIN_INTERVAL_DAYS_CONFIG_KEY, MIN_REVIEWS_CONFIG_KEY, LLM_BASIC_NOTE_REPHRASING_FRONT_PROMPT_CONFIG_KEY, \
-    LLM_BASIC_NOTE_REPHRASING_FRONT_PROMPT, LLM_BASIC_AND_REVERSE_NOTE_REPHRASING_BACK_PROMPT_CONFIG_KEY, \
-    LLM_NORMAL_NOTE_REPHRASING_BACK_PROMPT, LLM_CLOZE_NOTE_REPHRASING_PROMPT_CONFIG_KEY, \
-    LLM_CLOZE_NOTE_REPHRASING_PROMPT
+    MIN_INTERVAL_DAYS_CONFIG_KEY, MIN_REVIEWS_CONFIG_KEY, REPHRASING_VARIANTS_CONFIG_KEY, \
+    PROMPT_FIELD_MAX_TOKENS_CONFIG_KEY, OUTPUT_TOKENS_RATIO_CONFIG_KEY, WARM_UP_DUE_CARDS_CONFIG_KEY, \
+    WARM_UP_MAX_NOTES_PER_MINUTE_CONFIG_KEY, REQUEST_CONNECT_TIMEOUT_CONFIG_KEY, REQUEST_READ_TIMEOUT_CONFIG_KEY, \
+    SYNC_REPHRASINGS_CONFIG_KEY, COMPRESS_REPHRASINGS_CONFIG_KEY, NEAR_DUPLICATE_THRESHOLD_CONFIG_KEY, \
+    MIN_WORDS_TO_REPHRASE_CONFIG_KEY, CIRCUIT_BREAKER_FAILURES_CONFIG_KEY, SHORT_TEXT_MODEL_CONFIG_KEY, \
+    SHORT_TEXT_MAX_TOKENS_CONFIG_KEY, NOTE_TYPE_MODELS_CONFIG_KEY, DECK_MODELS_CONFIG_KEY, \
+    ROUTE_ON_SCREEN_TO_FASTEST_MODEL_CONFIG_KEY, PROFILE_HOOK_INVOCATIONS_CONFIG_KEY, PROFILES_DIR_NAME, \
+    ADDITIONAL_OPENAI_ACCOUNTS_CONFIG_KEY, RECORD_REVIEW_TRACES_CONFIG_KEY, TRACES_DIR_NAME, FORECAST_DAYS_CONFIG_KEY, \
+    COMBINE_REVERSED_NOTE_REQUESTS_CONFIG_KEY, REPHRASE_EDITED_NOTES_CONFIG_KEY, \
+    LLM_BASIC_NOTE_REPHRASING_FRONT_PROMPT_CONFIG_KEY, LLM_BASIC_AND_REVERSE_NOTE_REPHRASING_BACK_PROMPT_CONFIG_KEY, \
+    LLM_CLOZE_NOTE_REPHRASING_PROMPT_CONFIG_KEY
 from ml_tutor import MLTutor
+from ml.circuit_breaker import CircuitBreakerProvider
 from ml.ml_provider import MLProvider
+from ml.model_router import ModelRouter
 from ml.open_ai import OpenAI
+from ml.provider_pool import build_provider_pool
 
 
 class AnkiAddon:
@@ -53,27 +72,83 @@ class AnkiAddon:
 
     def __init__(self):
         self._notes_decorator_factory = NotesWrapperFactory()
+        self._note_versions = NoteVersions()
+        self._synced_rephrasings = SyncedRephrasings()
+        self._near_duplicates = NearDuplicateIndex()
+        self._rephrasing_filter = RephrasingFilter()
+        self._model_router = ModelRouter()
+        self._hook_profiler = HookProfiler()
+        self._review_trace_recorder = ReviewTraceRecorder()
         config = (
             mw.addonManager.getConfig(__name__)
             or mw.addonManager.getConfig(TUTOR_NAME.lower())
             or mw.addonManager.getConfig(ADD_ON_ID)
         )
         self._ml_tutor: Optional[MLTutor] = None
+        self._ml_provider: Optional[MLProvider] = None
         gui_hooks.addon_config_editor_will_update_json.append(self._on_config_update)
+        hooks.note_will_flush.append(self._note_versions.on_note_will_flush)
+        gui_hooks.operation_did_execute.append(self._note_versions.on_operation_did_execute)
+        gui_hooks.collection_did_load.append(self._load_synced_rephrasings)
+        gui_hooks.media_sync_did_start_or_stop.append(self._on_media_sync_did_start_or_stop)
+        gui_hooks.sync_will_start.append(self._save_synced_rephrasings)
+        gui_hooks.profile_will_close.append(self._save_synced_rephrasings)
         self._on_config_update(json.dumps(config), __name__)
 
     def _on_config_update(self, text: str, add_on_id: str) -> str:
         if add_on_id in (ADD_ON_ID, TUTOR_NAME.lower(), __name__):
             config = json.loads(text)
+            self._synced_rephrasings.set_enabled(enabled=config[SYNC_REPHRASINGS_CONFIG_KEY])
+            self._notes_decorator_factory.set_compress_rephrasings(
+                compress_rephrasings=config[COMPRESS_REPHRASINGS_CONFIG_KEY]
+            )
+            self._notes_decorator_factory.set_combine_reversed_note_requests(
+                combine_reversed_note_requests=config[COMBINE_REVERSED_NOTE_REQUESTS_CONFIG_KEY]
+            )
+            self._near_duplicates.set_threshold(threshold=config[NEAR_DUPLICATE_THRESHOLD_CONFIG_KEY])
+            self._rephrasing_filter.set_min_words(min_words=config[MIN_WORDS_TO_REPHRASE_CONFIG_KEY])
+            self._hook_profiler.start(
+                invocations_count=config[PROFILE_HOOK_INVOCATIONS_CONFIG_KEY],
+                output_dir=os.path.join(os.path.dirname(__file__), "user_files", PROFILES_DIR_NAME),
+                on_finished=self._on_profile_finished,
+            )
+            if config[RECORD_REVIEW_TRACES_CONFIG_KEY]:
+                self._review_trace_recorder.start(
+                    output_dir=os.path.join(os.path.dirname(__file__), "user_files", TRACES_DIR_NAME)
+                )
+            else:
+                self._review_trace_recorder.stop()
+            self._model_router.set_routes(
+                default_model=config["openai-generative-model"],
+                short_text_model=config[SHORT_TEXT_MODEL_CONFIG_KEY],
+                short_text_max_tokens=config[SHORT_TEXT_MAX_TOKENS_CONFIG_KEY],
+                note_type_models=config[NOTE_TYPE_MODELS_CONFIG_KEY],
+                deck_models=config[DECK_MODELS_CONFIG_KEY],
+                route_on_screen_to_fastest_model=config[ROUTE_ON_SCREEN_TO_FASTEST_MODEL_CONFIG_KEY],
+            )
             ml_provider = self._initialize_ml_provider(config=config)
-            prompts = Prompts(
-                front=config[LLM_BASIC_NOTE_REPHRASING_FRONT_PROMPT_CONFIG_KEY] or LLM_BASIC_NOTE_REPHRASING_FRONT_PROMPT,
-                back=config[LLM_BASIC_AND_REVERSE_NOTE_REPHRASING_BACK_PROMPT_CONFIG_KEY] or LLM_NORMAL_NOTE_REPHRASING_BACK_PROMPT,
-                cloze=config[LLM_CLOZE_NOTE_REPHRASING_PROMPT_CONFIG_KEY] or LLM_CLOZE_NOTE_REPHRASING_PROMPT,
+            if ml_provider is not None and config[CIRCUIT_BREAKER_FAILURES_CONFIG_KEY] > 0:
+                ml_provider = CircuitBreakerProvider(
+                    provider=ml_provider,
+                    failures_threshold=config[CIRCUIT_BREAKER_FAILURES_CONFIG_KEY],
+                    on_availability_change=self._on_ml_provider_availability_change,
+                )
+            if self._ml_provider is not None:
+                self._ml_provider.close()
+            self._ml_provider = ml_provider
+            prompts = Prompts.from_config(
+                front=config[LLM_BASIC_NOTE_REPHRASING_FRONT_PROMPT_CONFIG_KEY],
+                back=config[LLM_BASIC_AND_REVERSE_NOTE_REPHRASING_BACK_PROMPT_CONFIG_KEY],
+                cloze=config[LLM_CLOZE_NOTE_REPHRASING_PROMPT_CONFIG_KEY],
+            )
+            prompt_budget = PromptBudget(
+                field_max_tokens=config[PROMPT_FIELD_MAX_TOKENS_CONFIG_KEY],
+                output_tokens_ratio=config[OUTPUT_TOKENS_RATIO_CONFIG_KEY],
             )
             if ml_provider is None:
                 if self._ml_tutor is not None:
                     self._remove_tutor_hooks()
+                    self._ml_tutor.shutdown()
                 self._ml_tutor = None
             elif self._ml_tutor is None:
                 self._ml_tutor = MLTutor(
@@ -84,6 +159,15 @@ class AnkiAddon:
                     ease_target=config[EASE_TARGET_CONFIG_KEY],
                     min_interval_days=config[MIN_INTERVAL_DAYS_CONFIG_KEY],
                     min_reviews=config[MIN_REVIEWS_CONFIG_KEY],
+                    variants=config[REPHRASING_VARIANTS_CONFIG_KEY],
+                    prompt_budget=prompt_budget,
+                    warm_up_due_cards=config[WARM_UP_DUE_CARDS_CONFIG_KEY],
+                    warm_up_max_notes_per_minute=config[WARM_UP_MAX_NOTES_PER_MINUTE_CONFIG_KEY],
+                    forecast_days=config[FORECAST_DAYS_CONFIG_KEY],
+                    rephrase_edited_notes=config[REPHRASE_EDITED_NOTES_CONFIG_KEY],
+                    on_screen_timeout_seconds=(
+                        config[REQUEST_CONNECT_TIMEOUT_CONFIG_KEY] + config[REQUEST_READ_TIMEOUT_CONFIG_KEY]
+                    ),
                 )
                 self._add_tutor_hooks()
             if self._ml_tutor is not None:
@@ -95,8 +179,50 @@ class AnkiAddon:
                 self._ml_tutor.set_ease_target(ease_target=config[EASE_TARGET_CONFIG_KEY])
                 self._ml_tutor.set_min_interval_days(min_interval_days=config[MIN_INTERVAL_DAYS_CONFIG_KEY])
                 self._ml_tutor.set_min_reviews(min_reviews=config[MIN_REVIEWS_CONFIG_KEY])
+                self._ml_tutor.set_variants(variants=config[REPHRASING_VARIANTS_CONFIG_KEY])
+                self._ml_tutor.set_prompt_budget(prompt_budget=prompt_budget)
+                self._ml_tutor.set_warm_up_due_cards(warm_up_due_cards=config[WARM_UP_DUE_CARDS_CONFIG_KEY])
+                self._ml_tutor.set_warm_up_max_notes_per_minute(
+                    warm_up_max_notes_per_minute=config[WARM_UP_MAX_NOTES_PER_MINUTE_CONFIG_KEY]
+                )
+                self._ml_tutor.set_forecast_days(forecast_days=config[FORECAST_DAYS_CONFIG_KEY])
+                self._ml_tutor.set_rephrase_edited_notes(rephrase_edited_notes=config[REPHRASE_EDITED_NOTES_CONFIG_KEY])
+                self._ml_tutor.set_on_screen_timeout_seconds(
+                    on_screen_timeout_seconds=(
+                        config[REQUEST_CONNECT_TIMEOUT_CONFIG_KEY] + config[REQUEST_READ_TIMEOUT_CONFIG_KEY]
+                    )
+                )
         return text
 
+    @staticmethod
+    def _on_ml_provider_availability_change(available: bool):
+        if available:
+            message = f"[{TUTOR_NAME}] The OpenAI API is reachable again, resuming the rephrasing of cards."
+        else:
+            message = f"[{TUTOR_NAME}] The OpenAI API is not responding, showing the original cards for now."
+        mw.taskman.run_on_main(lambda: tooltip(message))
+
+    @staticmethod
+    def _on_profile_finished(summary_path: str):
+        for add_on_id in (__name__, TUTOR_NAME.lower(), ADD_ON_ID):
+            config = mw.addonManager.getConfig(add_on_id)
+            if config is not None:  # a single profile is recorded, not one on every restart
+                config[PROFILE_HOOK_INVOCATIONS_CONFIG_KEY] = 0
+                mw.addonManager.writeConfig(add_on_id, config)
+                break
+        tooltip(f"[{TUTOR_NAME}] Profile saved to {summary_path}", period=6000)
+
+    def _load_synced_rephrasings(self, col: Collection):
+        self._synced_rephrasings.load(media_dir=col.media.dir())
+
+    def _on_media_sync_did_start_or_stop(self, running: bool):
+        if not running and mw.col is not None:
+            self._load_synced_rephrasings(col=mw.col)  # pick up the rephrasings of the other devices
+
+    def _save_synced_rephrasings(self):
+        if mw.col is not None:
+            self._synced_rephrasings.save(media_dir=mw.col.media.dir())
+
     def _add_tutor_hooks(self):
         if self._ml_tutor.on_collection_load not in gui_hooks.collection_did_load._hooks:
             gui_hooks.collection_did_load.append(self._ml_tutor.on_collection_load)
@@ -104,6 +230,14 @@ class AnkiAddon:
             gui_hooks.card_will_show.append(self._ml_tutor.on_card_will_show)
         if self._ml_tutor.on_reviewer_did_show_answer not in gui_hooks.reviewer_did_show_answer._hooks:
             gui_hooks.reviewer_did_show_answer.append(self._ml_tutor.on_reviewer_did_show_answer)
+        if self._ml_tutor.on_reviewer_did_answer_card not in gui_hooks.reviewer_did_answer_card._hooks:
+            gui_hooks.reviewer_did_answer_card.append(self._ml_tutor.on_reviewer_did_answer_card)
+        if self._ml_tutor.on_sync_did_finish not in gui_hooks.sync_did_finish._hooks:
+            gui_hooks.sync_did_finish.append(self._ml_tutor.on_sync_did_finish)
+        if self._ml_tutor.on_operation_did_execute not in gui_hooks.operation_did_execute._hooks:
+            gui_hooks.operation_did_execute.append(self._ml_tutor.on_operation_did_execute)
+        if self._ml_tutor.on_reviewer_will_end not in gui_hooks.reviewer_will_end._hooks:
+            gui_hooks.reviewer_will_end.append(self._ml_tutor.on_reviewer_will_end)
 
     def _remove_tutor_hooks(self):
         if self._ml_tutor.on_collection_load in gui_hooks.collection_did_load._hooks:
@@ -112,6 +246,14 @@ class AnkiAddon:
             gui_hooks.card_will_show.remove(self._ml_tutor.on_card_will_show)
         if self._ml_tutor.on_reviewer_did_show_answer in gui_hooks.reviewer_did_show_answer._hooks:
             gui_hooks.reviewer_did_show_answer.remove(self._ml_tutor.on_reviewer_did_show_answer)
+        if self._ml_tutor.on_reviewer_did_answer_card in gui_hooks.reviewer_did_answer_card._hooks:
+            gui_hooks.reviewer_did_answer_card.remove(self._ml_tutor.on_reviewer_did_answer_card)
+        if self._ml_tutor.on_sync_did_finish in gui_hooks.sync_did_finish._hooks:
+            gui_hooks.sync_did_finish.remove(self._ml_tutor.on_sync_did_finish)
+        if self._ml_tutor.on_operation_did_execute in gui_hooks.operation_did_execute._hooks:
+            gui_hooks.operation_did_execute.remove(self._ml_tutor.on_operation_did_execute)
+        if self._ml_tutor.on_reviewer_will_end in gui_hooks.reviewer_will_end._hooks:
+            gui_hooks.reviewer_will_end.remove(self._ml_tutor.on_reviewer_will_end)
 
     @staticmethod
     def _initialize_ml_provider(config: dict) -> Optional[MLProvider]:
@@ -121,7 +263,11 @@ class AnkiAddon:
             showInfo(f"[{TUTOR_NAME}] OpenAI API key is not set. Please set it via the add-on settings.")
         else:
             openai_generative_model = config["openai-generative-model"]
-            openai = OpenAI(api_key=openai_api_key, generative_model=openai_generative_model)
+            openai = OpenAI(
+                api_key=openai_api_key,
+                generative_model=openai_generative_model,
+                timeout=(config[REQUEST_CONNECT_TIMEOUT_CONFIG_KEY], config[REQUEST_READ_TIMEOUT_CONFIG_KEY]),
+            )
 
             if openai.check_connected_to_web() is False:
                 showCritical(f"[{TUTOR_NAME}] OpenAI API server is not reachable.", help=None)
@@ -138,4 +284,9 @@ class AnkiAddon:
                 )
                 openai = None
 
-        return openai
+        ml_provider = openai
+        if openai is not None:  # the additional accounts are ejected from the pool at runtime if they fail
+            ml_provider = build_provider_pool(
+                primary=openai, additional_accounts=config[ADDITIONAL_OPENAI_ACCOUNTS_CONFIG_KEY]
+            )
+        return ml_provider
@@ -31,14 +31,73 @@
 
 TUTOR_NAME = "ML-Tutor"
 REPHRASE_CARDS_AHEAD = 3
+WARM_UP_FETCH_LIMIT = 5000
+WARM_UP_PROGRESS_INTERVAL_SECONDS = 5
+PREFETCH_WORKER_THREADS = 2
+ON_SCREEN_TIMEOUT_SECONDS = 35
+FORECAST_IDLE_SECONDS = 60
+FORECAST_IDLE_CHECK_INTERVAL_SECONDS = 5
+EDITED_NOTES_DEBOUNCE_SECONDS = 5
+EDITED_NOTES_MAX_BATCH = 20
+SYNCED_REPHRASINGS_FILE_NAME = "_ml-tutor-rephrasings.json.gz"
+SYNCED_REPHRASINGS_MAX_ENTRIES = 20000
+COMPRESSION_MIN_LENGTH = 200
+NEAR_DUPLICATE_BANDS = 8
+NEAR_DUPLICATE_ROWS_PER_BAND = 4
+NEAR_DUPLICATE_SHINGLE_SIZE = 5
+MIN_LETTERS_RATIO_TO_REPHRASE = 0.5
+CJK_CHARACTERS_PER_WORD = 2
+NEGATIVE_CACHE_BASE_BACKOFF_SECONDS = 30
+NEGATIVE_CACHE_MAX_BACKOFF_SECONDS = 60 * 60
+NEGATIVE_CACHE_AMBIGUOUS_TTL_SECONDS = 30 * 24 * 60 * 60
+NEGATIVE_CACHE_MAX_ENTRIES = 5000
+CIRCUIT_BREAKER_PROBE_BASE_INTERVAL_SECONDS = 15
+CIRCUIT_BREAKER_PROBE_MAX_INTERVAL_SECONDS = 5 * 60
+MODEL_LATENCY_SMOOTHING = 0.2
+PROFILE_SUMMARY_FUNCTIONS_COUNT = 30
+PROFILE_SUMMARY_ALLOCATIONS_COUNT = 20
+PROFILE_TRACEMALLOC_FRAMES = 10
+PROFILES_DIR_NAME = "profiles"
+TRACES_DIR_NAME = "traces"
+REPHRASING_STORE_LOCK_STRIPES = 16
+POOL_EJECTION_BASE_SECONDS = 10
+POOL_EJECTION_MAX_SECONDS = 5 * 60
+COMBINED_REQUEST_MAX_UNPARSEABLE_REPLIES = 3
+RENDERED_CARDS_MAX_ENTRIES = 200
 NOTE_TEXT_PARSER = "html.parser"
+CHARACTERS_PER_TOKEN = 4
+TRUNCATED_TEXT_MARKER = " [...]"
+MIN_OUTPUT_TOKENS = 32
 DISPLAY_ORIGINAL_QUESTION_CONFIG_KEY = "display-original-question"
 EASE_TARGET_CONFIG_KEY = "ease-target"
 MIN_INTERVAL_DAYS_CONFIG_KEY = "min-interval-days"
 MIN_REVIEWS_CONFIG_KEY = "min-reviews"
+REPHRASING_VARIANTS_CONFIG_KEY = "rephrasing-variants"
+PROMPT_FIELD_MAX_TOKENS_CONFIG_KEY = "prompt-field-max-tokens"
+OUTPUT_TOKENS_RATIO_CONFIG_KEY = "output-tokens-ratio"
+WARM_UP_DUE_CARDS_CONFIG_KEY = "warm-up-due-cards"
+WARM_UP_MAX_NOTES_PER_MINUTE_CONFIG_KEY = "warm-up-max-notes-per-minute"
+FORECAST_DAYS_CONFIG_KEY = "forecast-days"
+REPHRASE_EDITED_NOTES_CONFIG_KEY = "rephrase-edited-notes"
+REQUEST_CONNECT_TIMEOUT_CONFIG_KEY = "request-connect-timeout-seconds"
+REQUEST_READ_TIMEOUT_CONFIG_KEY = "request-read-timeout-seconds"
+SYNC_REPHRASINGS_CONFIG_KEY = "sync-rephrasings"
+COMPRESS_REPHRASINGS_CONFIG_KEY = "compress-rephrasings"
+NEAR_DUPLICATE_THRESHOLD_CONFIG_KEY = "near-duplicate-threshold"
+MIN_WORDS_TO_REPHRASE_CONFIG_KEY = "min-words-to-rephrase"
+COMBINE_REVERSED_NOTE_REQUESTS_CONFIG_KEY = "combine-reversed-note-requests"
+CIRCUIT_BREAKER_FAILURES_CONFIG_KEY = "circuit-breaker-failures"
+SHORT_TEXT_MODEL_CONFIG_KEY = "short-text-model"
+SHORT_TEXT_MAX_TOKENS_CONFIG_KEY = "short-text-max-tokens"
+NOTE_TYPE_MODELS_CONFIG_KEY = "note-type-models"
+DECK_MODELS_CONFIG_KEY = "deck-models"
+ROUTE_ON_SCREEN_TO_FASTEST_MODEL_CONFIG_KEY = "route-on-screen-to-fastest-model"
+PROFILE_HOOK_INVOCATIONS_CONFIG_KEY = "profile-hook-invocations"
+RECORD_REVIEW_TRACES_CONFIG_KEY = "record-review-traces"
+ADDITIONAL_OPENAI_ACCOUNTS_CONFIG_KEY = "additional-openai-accounts"
 LLM_BASIC_NOTE_REPHRASING_FRONT_PROMPT_CONFIG_KEY = "basic-note-front-prompt"
 LLM_BASIC_NOTE_REPHRASING_FRONT_PROMPT = """
-Given the spaced-repetition note front text: '{note_front}', please attempt to rephrase
+You will be given the front text of a spaced-repetition note. Please attempt to rephrase
 the note front in a way that retains the core information and intent but alters the
 structure and wording. This rephrasing should encourage understanding and recall of the
 concept rather than memorization of the exact structure of the question. If the text is
@@ -47,7 +106,7 @@ without any further explanation why the text is ambiguous.
 """
 LLM_BASIC_AND_REVERSE_NOTE_REPHRASING_BACK_PROMPT_CONFIG_KEY = "basic-and-reverse-note-back-prompt"
 LLM_NORMAL_NOTE_REPHRASING_BACK_PROMPT = """
-Given the spaced-repetition note back text: '{note_back}', please attempt to rephrase
+You will be given the back text of a spaced-repetition note. Please attempt to rephrase
 the note back in a way that retains the core information and intent but alters the
 structure and wording. This rephrasing should encourage understanding and recall of the
 concept rather than memorization of the exact structure of the question. If the text is
@@ -56,6 +115,45 @@ without any further explanation why the text is ambiguous.
 """
 LLM_CLOZE_NOTE_REPHRASING_PROMPT_CONFIG_KEY = "cloze-note-prompt"
 LLM_CLOZE_NOTE_REPHRASING_PROMPT = """
+You will be given a spaced-repetition cloze-deletion note. Please reword it in a
+way that retains the core information and intent but alters the structure and wording.
+The goal is to enhance understanding and recall without relying on the exact structure
+of the question. Keep the same number of fill-in-the-blank spaces. If the text is too
+ambiguous to rephrase without altering its intended meaning, return an empty string
+without any further explanation why the text is ambiguous.
+"""
+# the request for both sides of a reversed note, wrapped around the front and back prompts
+LLM_BASIC_AND_REVERSE_NOTE_BOTH_SIDES_PROMPT_INTRO = """
+You will be given both sides of a spaced-repetition note. Please rephrase each side separately,
+following the instructions below.
+"""
+LLM_BASIC_AND_REVERSE_NOTE_BOTH_SIDES_PROMPT_FORMAT = """
+Reply with a JSON object only, holding the rephrased front as "front" and the rephrased back
+as "back". Where the instructions ask for an empty string, use it as the value of that side.
+"""
+# appended to the note part of a request when the rephrasings of a near-duplicate note can be adapted
+LLM_SIMILAR_NOTE_REPHRASINGS_INTRO = """
+Rephrasings of a similar note, which may be adapted to the note above. Keep every fact of the
+note above, even where it differs from the similar note:
+"""
+# the defaults used before the note fields were moved out of the prompts, replaced by the above when found in a config
+LEGACY_LLM_BASIC_NOTE_REPHRASING_FRONT_PROMPT = """
+Given the spaced-repetition note front text: '{note_front}', please attempt to rephrase
+the note front in a way that retains the core information and intent but alters the
+structure and wording. This rephrasing should encourage understanding and recall of the
+concept rather than memorization of the exact structure of the question. If the text is
+too ambiguous to rephrase without altering its intended meaning, return an empty string
+without any further explanation why the text is ambiguous.
+"""
+LEGACY_LLM_NORMAL_NOTE_REPHRASING_BACK_PROMPT = """
+Given the spaced-repetition note back text: '{note_back}', please attempt to rephrase
+the note back in a way that retains the core information and intent but alters the
+structure and wording. This rephrasing should encourage understanding and recall of the
+concept rather than memorization of the exact structure of the question. If the text is
+too ambiguous to rephrase without altering its intended meaning, return an empty string
+without any further explanation why the text is ambiguous.
+"""
+LEGACY_LLM_CLOZE_NOTE_REPHRASING_PROMPT = """
 Given the spaced-repetition cloze-deletion note '{note_cloze}', please reword it in a
 way that retains the core information and intent but alters the structure and wording.
 The goal is to enhance understanding and recall without relying on the exact structure
@@ -63,5 +161,10 @@ of the question. Keep the same number of fill-in-the-blank spaces. If the text i
 ambiguous to rephrase without altering its intended meaning, return an empty string
 without any further explanation why the text is ambiguous.
 """
+PROMPT_FIELD_LABELS = {
+    "note_front": "Note front",
+    "note_back": "Note back",
+    "note_cloze": "Cloze-deletion note",
+}
 
 ADD_ON_ID = "1505658371"
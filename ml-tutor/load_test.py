@@ -0,0 +1,439 @@
+# -*- coding: utf-8 -*-
+
+# ML-Tutor Add-on for Anki
+#
+# Copyright (C)  2024 Petrov P.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version, with the additions
+# listed at the end of the license file that accompanied this program
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# NOTE: This program is subject to certain additional terms pursuant to
+# Section 7 of the GNU Affero General Public License.  You should have
+# received a copy of these additional terms immediately following the
+# terms and conditions of the GNU Affero General Public License that
+# accompanied this program.
+#
+# If not, please request a copy through one of the means of contact
+# listed here: <mailto:petioptrv@icloud.com>.
+#
+# Any modifications to this file must keep this entire header intact.
+
+"""Replays a simulated review session against the `MLTutor` hooks to measure how the add-on behaves under load.
+
+The add-on's provider stack (OpenAI client, account pool and circuit breaker) is pointed at the stand-in OpenAI API
+of `stand_in_server.py`, started in-process unless `--base-url` is given. The session reviews a synthetic
+collection of Basic notes due today, without the Anki GUI: the calling thread plays the part of the main thread and
+the think times between the hooks are sampled like the stand-in latencies. The report gives the time the hooks
+blocked the main thread, the completions per second that reached the add-on and the prefetch hit rate, i.e. the
+share of the eligible cards that were already rephrased when shown.
+
+    python load_test.py --notes 200 --reviews 100 --latency lognormal:1.5,0.6 --throttle-rate 0.05
+"""
+
+import argparse
+import logging
+import os
+import random
+import statistics
+import tempfile
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field, asdict
+from threading import Lock
+from typing import Callable, Dict, List, Optional
+
+import aqt
+import requests
+from anki.cards import Card
+from anki.collection import Collection
+from anki.consts import CARD_TYPE_REV, QUEUE_TYPE_REV
+
+
+class _SessionTaskManager:
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1)  # like Anki, one collection operation at a time
+
+    def run_in_background(
+        self, task: Callable, on_done: Optional[Callable[[Future], None]] = None, uses_collection: bool = True
+    ):
+        future = self._executor.submit(task)
+        if on_done is not None:
+            future.add_done_callback(on_done)  # on the executor's thread, the session has no main loop to run it on
+
+    def run_on_main(self, closure: Callable):
+        pass  # the session has no GUI to update
+
+
+class _SessionMainWindow:
+    """What the add-on uses of Anki's main window."""
+
+    def __init__(self):
+        self.col: Optional[Collection] = None
+        self.taskman = _SessionTaskManager()
+
+    def _increase_background_ops(self):
+        pass
+
+    def _decrease_background_ops(self):
+        pass
+
+    @staticmethod
+    def prepare_card_text_for_display(text: str) -> str:
+        return text  # the session cards have neither media nor sounds
+
+
+aqt.mw = _SessionMainWindow()  # the add-on modules bind `aqt.mw` when they are imported
+
+from constants import (  # noqa: E402
+    TUTOR_NAME,
+    EASE_TARGET_CONFIG_KEY,
+    MIN_INTERVAL_DAYS_CONFIG_KEY,
+    MIN_REVIEWS_CONFIG_KEY,
+    REPHRASING_VARIANTS_CONFIG_KEY,
+    DISPLAY_ORIGINAL_QUESTION_CONFIG_KEY,
+    MIN_WORDS_TO_REPHRASE_CONFIG_KEY,
+    REQUEST_CONNECT_TIMEOUT_CONFIG_KEY,
+    REQUEST_READ_TIMEOUT_CONFIG_KEY,
+    CIRCUIT_BREAKER_FAILURES_CONFIG_KEY,
+)
+from ml.circuit_breaker import CircuitBreakerProvider, ProviderUnavailable  # noqa: E402
+from ml.ml_provider import MLProvider  # noqa: E402
+from ml.model_router import ModelRouter  # noqa: E402
+from ml.open_ai import OpenAI  # noqa: E402
+from ml.provider_pool import build_provider_pool  # noqa: E402
+from ml_tutor import MLTutor  # noqa: E402
+from notes_wrappers import NotesWrapperFactory  # noqa: E402
+from precompute import load_config, build_prompts_settings  # noqa: E402
+from rephrasing_filter import RephrasingFilter  # noqa: E402
+from stand_in_server import StandInServer, LatencyDistribution, add_settings_arguments, build_settings  # noqa: E402
+
+_DEFAULT_DECK_ID = 1
+_GOOD_EASE = 3
+_WORDS = (
+    "which river crosses the capital city of the country known for its old bridges and long winters where "
+    "farmers grow wheat while merchants trade silk along ancient roads that connect distant mountain towns"
+).split()
+_WORDS_PER_FIELD = 9
+
+
+class _CountingProvider(MLProvider):
+    """Counts the completions that reach the add-on, past the account pool and the circuit breaker.
+
+    The requests that the open circuit breaker rejects without sending them are counted apart from the failed ones.
+    """
+
+    def __init__(self, provider: MLProvider):
+        self._provider = provider
+        self._lock = Lock()
+        self.completions_count = 0
+        self.failed_requests_count = 0
+        self.short_circuited_requests_count = 0
+
+    def check_connected_to_web(self) -> bool:
+        return self._provider.check_connected_to_web()
+
+    def completion(self, prompt: str) -> str:
+        completions = self.completions(prompt=prompt, n=1)
+        return completions[0] if len(completions) != 0 else ""
+
+    def completions(
+        self,
+        prompt: str,
+        n: int,
+        max_tokens: Optional[int] = None,
+        model: Optional[str] = None,
+        instructions: Optional[str] = None,
+    ) -> List[str]:
+        try:
+            completions = self._provider.completions(
+                prompt=prompt, n=n, max_tokens=max_tokens, model=model, instructions=instructions
+            )
+        except ProviderUnavailable:
+            with self._lock:
+                self.short_circuited_requests_count += 1
+            raise
+        except Exception:
+            with self._lock:
+                self.failed_requests_count += 1
+            raise
+        with self._lock:
+            self.completions_count += len(completions)
+        return completions
+
+    def is_available(self) -> bool:
+        return self._provider.is_available()
+
+    def close(self):
+        self._provider.close()
+
+
+@dataclass
+class SessionReport:
+    reviews_count: int = 0
+    elapsed_seconds: float = 0.0
+    eligible_shows_count: int = 0
+    prefetch_hits_count: int = 0
+    completions_count: int = 0
+    failed_requests_count: int = 0
+    short_circuited_requests_count: int = 0
+    hook_durations: Dict[str, List[float]] = field(default_factory=dict)
+    stand_in_stats: Optional[dict] = None
+
+    @property
+    def blocked_seconds(self) -> float:
+        return sum(sum(durations) for durations in self.hook_durations.values())
+
+    @property
+    def completions_per_second(self) -> float:
+        return self.completions_count / self.elapsed_seconds if self.elapsed_seconds > 0 else 0.0
+
+    @property
+    def prefetch_hit_rate(self) -> float:
+        return self.prefetch_hits_count / self.eligible_shows_count if self.eligible_shows_count != 0 else 0.0
+
+    def format(self) -> str:
+        lines = [
+            f"Reviews: {self.reviews_count} in {self.elapsed_seconds:.1f}s",
+            f"Main thread blocked by the hooks: {self.blocked_seconds:.3f}s",
+        ]
+        for hook, durations in self.hook_durations.items():
+            if len(durations) != 0:
+                sorted_durations = sorted(durations)
+                p95 = sorted_durations[min(int(len(durations) * 0.95), len(durations) - 1)]
+                lines.append(
+                    f"  {hook}: total {sum(durations):.3f}s, median {statistics.median(durations) * 1000:.1f}ms,"
+                    f" p95 {p95 * 1000:.1f}ms, max {sorted_durations[-1] * 1000:.1f}ms"
+                )
+        lines += [
+            f"Completions: {self.completions_count} ({self.completions_per_second:.2f}/s),"
+            f" {self.failed_requests_count} failed requests,"
+            f" {self.short_circuited_requests_count} requests not sent while the circuit breaker was open",
+            f"Prefetch hit rate: {self.prefetch_hit_rate:.1%}"
+            f" ({self.prefetch_hits_count}/{self.eligible_shows_count} eligible cards rephrased before shown)",
+        ]
+        if self.stand_in_stats is not None:
+            lines.append(f"Stand-in server: {self.stand_in_stats}")
+        return "\n".join(lines)
+
+
+def build_session_collection(
+    collection_path: str,
+    config: dict,
+    notes_count: int,
+    ineligible_ratio: float,
+    rng: random.Random,
+) -> Collection:
+    """A collection of Basic notes whose review cards are all due today.
+
+    The cards are well learned according to the add-on's config, except for a share of them whose ease is too low.
+    """
+    col = Collection(collection_path)
+    deck_config = col.decks.config_dict_for_deck_id(_DEFAULT_DECK_ID)
+    deck_config["rev"]["perDay"] = notes_count
+    col.decks.update_config(deck_config)
+    notetype = col.models.by_name("Basic")
+    min_factor = int(config[EASE_TARGET_CONFIG_KEY] * 1000)
+
+    for i in range(notes_count):
+        note = col.new_note(notetype)
+        note["Front"] = f"{' '.join(rng.sample(_WORDS, _WORDS_PER_FIELD)).capitalize()} ({i})?"
+        note["Back"] = f"{' '.join(rng.sample(_WORDS, _WORDS_PER_FIELD)).capitalize()}."
+        col.add_note(note, deck_id=_DEFAULT_DECK_ID)
+        card = note.cards()[0]
+        card.type = CARD_TYPE_REV
+        card.queue = QUEUE_TYPE_REV
+        card.due = col.sched.today
+        card.ivl = config[MIN_INTERVAL_DAYS_CONFIG_KEY] + rng.randint(0, 60)
+        card.reps = config[MIN_REVIEWS_CONFIG_KEY] + rng.randint(0, 10)
+        if rng.random() < ineligible_ratio:
+            card.factor = max(min_factor - rng.randint(100, 500), 1300)
+        else:
+            card.factor = min_factor + rng.randint(0, 500)
+        col.update_card(card)
+    return col
+
+
+def run_session(
+    ml_tutor: MLTutor,
+    col: Collection,
+    config: dict,
+    reviews_count: int,
+    question_seconds: LatencyDistribution,
+    answer_seconds: LatencyDistribution,
+    rng: random.Random,
+) -> SessionReport:
+    report = SessionReport(
+        hook_durations={
+            "card_will_show (question)": [],
+            "card_will_show (answer)": [],
+            "reviewer_did_show_answer": [],
+            "reviewer_did_answer_card": [],
+        }
+    )
+    prompts, prompt_budget = build_prompts_settings(config=config)
+
+    def timed(hook: str, func: Callable, *args):
+        start = time.perf_counter()
+        func(*args)
+        report.hook_durations[hook].append(time.perf_counter() - start)
+
+    start_ts = time.monotonic()
+    ml_tutor.on_collection_load(col)
+    for _ in range(reviews_count):
+        queued_cards = col.sched.get_queued_cards(fetch_limit=1)
+        if len(queued_cards.cards) == 0:
+            break
+        card: Card = col.get_card(queued_cards.cards[0].card.id)
+        card.start_timer()
+        wrapped_note = NotesWrapperFactory.get_wrapped_note(
+            note=card.note(),
+            prompts=prompts,
+            display_original_question=config[DISPLAY_ORIGINAL_QUESTION_CONFIG_KEY],
+            variants=config[REPHRASING_VARIANTS_CONFIG_KEY],
+            prompt_budget=prompt_budget,
+        )
+        if _is_card_well_learned(card=card, config=config) and wrapped_note.should_rephrase(card=card):
+            report.eligible_shows_count += 1
+            report.prefetch_hits_count += wrapped_note.rephrased
+
+        timed("card_will_show (question)", ml_tutor.on_card_will_show, card.question(), card, "reviewQuestion")
+        time.sleep(question_seconds.sample(rng=rng))
+        timed("card_will_show (answer)", ml_tutor.on_card_will_show, card.answer(), card, "reviewAnswer")
+        timed("reviewer_did_show_answer", ml_tutor.on_reviewer_did_show_answer, card)
+        time.sleep(answer_seconds.sample(rng=rng))
+        col.sched.answerCard(card, _GOOD_EASE)
+        timed("reviewer_did_answer_card", ml_tutor.on_reviewer_did_answer_card, None, card, _GOOD_EASE)
+        report.reviews_count += 1
+    report.elapsed_seconds = time.monotonic() - start_ts
+    return report
+
+
+def _is_card_well_learned(card: Card, config: dict) -> bool:
+    return (
+        card.factor / 1000.0 >= config[EASE_TARGET_CONFIG_KEY]
+        and card.ivl >= config[MIN_INTERVAL_DAYS_CONFIG_KEY]
+        and card.reps >= config[MIN_REVIEWS_CONFIG_KEY]
+    )
+
+
+def build_ml_provider(config: dict, base_url: str, api_keys: List[str]) -> _CountingProvider:
+    """The same provider stack as the add-on's, with one account per given key, all served by the stand-in."""
+    primary = OpenAI(
+        api_key=api_keys[0],
+        generative_model=config["openai-generative-model"],
+        timeout=(config[REQUEST_CONNECT_TIMEOUT_CONFIG_KEY], config[REQUEST_READ_TIMEOUT_CONFIG_KEY]),
+        base_url=base_url,
+    )
+    ml_provider = build_provider_pool(primary=primary, additional_accounts=[{"key": key} for key in api_keys[1:]])
+    if config[CIRCUIT_BREAKER_FAILURES_CONFIG_KEY] > 0:
+        ml_provider = CircuitBreakerProvider(
+            provider=ml_provider,
+            failures_threshold=config[CIRCUIT_BREAKER_FAILURES_CONFIG_KEY],
+            on_availability_change=lambda available: logging.info(
+                f"[{TUTOR_NAME}] The ML provider is {'available' if available else 'unavailable'}."
+            ),
+        )
+    return _CountingProvider(provider=ml_provider)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the add-on's hooks against a stand-in OpenAI API.")
+    parser.add_argument("--config", help="Add-on config (config.json format) or Anki's meta.json of the add-on.")
+    parser.add_argument("--notes", type=int, default=200, help="Notes in the synthetic collection.")
+    parser.add_argument("--reviews", type=int, default=100, help="Cards reviewed in the session.")
+    parser.add_argument("--ineligible-ratio", type=float, default=0.2, help="Share of cards not well learned.")
+    parser.add_argument("--question-seconds", default="lognormal:4,0.5", help="Time spent on the question side.")
+    parser.add_argument("--answer-seconds", default="lognormal:1.5,0.5", help="Time spent on the answer side.")
+    parser.add_argument("--accounts", type=int, default=1, help="Accounts of the provider pool.")
+    parser.add_argument("--base-url", help="An already running stand-in, e.g. http://127.0.0.1:8765/v1.")
+    add_settings_arguments(parser=parser)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    config = load_config(config_path=args.config)
+    stand_in_settings = build_settings(args=args)
+    rng = random.Random(args.seed)
+    server = None
+    base_url = args.base_url
+    if base_url is None:
+        server = StandInServer(settings=stand_in_settings, port=0)
+        server.start()
+        base_url = server.base_url
+    api_keys = list(args.api_keys) or [f"sk-stand-in-{i}" for i in range(args.accounts)]
+    api_keys = [api_keys[i % len(api_keys)] for i in range(args.accounts)]
+
+    RephrasingFilter().set_min_words(min_words=config[MIN_WORDS_TO_REPHRASE_CONFIG_KEY])
+    ModelRouter().set_routes(
+        default_model=stand_in_settings.models[0],
+        short_text_model="",
+        short_text_max_tokens=0,
+        note_type_models={},
+        deck_models={},
+        route_on_screen_to_fastest_model=False,
+    )
+    config["openai-generative-model"] = stand_in_settings.models[0]
+    ml_provider = build_ml_provider(config=config, base_url=base_url, api_keys=api_keys)
+    prompts, prompt_budget = build_prompts_settings(config=config)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        col = build_session_collection(
+            collection_path=os.path.join(temp_dir, "collection.anki2"),
+            config=config,
+            notes_count=args.notes,
+            ineligible_ratio=args.ineligible_ratio,
+            rng=rng,
+        )
+        aqt.mw.col = col
+        ml_tutor = MLTutor(
+            notes_decorator_factory=NotesWrapperFactory(),
+            ml_provider=ml_provider,
+            ease_target=config[EASE_TARGET_CONFIG_KEY],
+            min_interval_days=config[MIN_INTERVAL_DAYS_CONFIG_KEY],
+            min_reviews=config[MIN_REVIEWS_CONFIG_KEY],
+            prompts=prompts,
+            display_original_question=config[DISPLAY_ORIGINAL_QUESTION_CONFIG_KEY],
+            variants=config[REPHRASING_VARIANTS_CONFIG_KEY],
+            prompt_budget=prompt_budget,
+            on_screen_timeout_seconds=(
+                config[REQUEST_CONNECT_TIMEOUT_CONFIG_KEY] + config[REQUEST_READ_TIMEOUT_CONFIG_KEY]
+            ),
+        )
+        try:
+            report = run_session(
+                ml_tutor=ml_tutor,
+                col=col,
+                config=config,
+                reviews_count=args.reviews,
+                question_seconds=LatencyDistribution(spec=args.question_seconds),
+                answer_seconds=LatencyDistribution(spec=args.answer_seconds),
+                rng=rng,
+            )
+        finally:
+            ml_tutor.shutdown()
+            ml_provider.close()
+            aqt.mw.col = None
+            col.close()
+    report.completions_count = ml_provider.completions_count
+    report.failed_requests_count = ml_provider.failed_requests_count
+    report.short_circuited_requests_count = ml_provider.short_circuited_requests_count
+    if server is not None:
+        report.stand_in_stats = asdict(server.stats)
+        server.stop()
+    else:
+        report.stand_in_stats = requests.get(url=f"{base_url.rsplit('/v1', 1)[0]}/stand-in/stats").json()
+    print(report.format())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+# ML-Tutor Add-on for Anki
+#
+# Copyright (C)  2024 Petrov P.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version, with the additions
+# listed at the end of the license file that accompanied this program
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# NOTE: This program is subject to certain additional terms pursuant to
+# Section 7 of the GNU Affero General Public License.  You should have
+# received a copy of these additional terms immediately following the
+# terms and conditions of the GNU Affero General Public License that
+# accompanied this program.
+#
+# If not, please request a copy through one of the means of contact
+# listed here: <mailto:petioptrv@icloud.com>.
+#
+# Any modifications to this file must keep this entire header intact.
+
+import logging
+from enum import Enum
+from threading import Event, Lock, Thread
+from typing import Callable, List, Optional
+
+from constants import TUTOR_NAME, CIRCUIT_BREAKER_PROBE_BASE_INTERVAL_SECONDS, \
+    CIRCUIT_BREAKER_PROBE_MAX_INTERVAL_SECONDS
+from ml.ml_provider import MLProvider, ProviderResponseError
+
+
+class ProviderUnavailable(Exception):
+    pass
+
+
+class CircuitState(Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+
+class CircuitBreakerProvider(MLProvider):
+    """Stops sending requests to a provider that keeps failing.
+
+    After `failures_threshold` consecutive failures or timeouts the circuit opens and every completion request fails
+    immediately with `ProviderUnavailable`. A background thread then probes the provider with an increasing interval
+    and, once it is reachable again, lets a single trial request through. The circuit closes if it succeeds.
+    """
+
+    def __init__(
+        self,
+        provider: MLProvider,
+        failures_threshold: int,
+        on_availability_change: Optional[Callable[[bool], None]] = None,
+    ):
+        self._provider = provider
+        self._failures_threshold = failures_threshold
+        self._on_availability_change = on_availability_change
+        self._state = CircuitState.CLOSED
+        self._consecutive_failures = 0
+        self._trial_in_flight = False
+        self._lock = Lock()
+        self._closed = Event()
+
+    @property
+    def state(self) -> CircuitState:
+        return self._state
+
+    def is_available(self) -> bool:
+        return self._state != CircuitState.OPEN
+
+    def check_connected_to_web(self) -> bool:
+        return self._provider.check_connected_to_web()
+
+    def completion(self, prompt: str) -> str:
+        completions = self.completions(prompt=prompt, n=1)
+        return completions[0] if len(completions) != 0 else ""
+
+    def completions(
+        self,
+        prompt: str,
+        n: int,
+        max_tokens: Optional[int] = None,
+        model: Optional[str] = None,
+        instructions: Optional[str] = None,
+    ) -> List[str]:
+        with self._lock:
+            if self._state == CircuitState.OPEN or (self._state == CircuitState.HALF_OPEN and self._trial_in_flight):
+                raise ProviderUnavailable()
+            self._trial_in_flight = self._state == CircuitState.HALF_OPEN
+        try:
+            completions = self._provider.completions(
+                prompt=prompt, n=n, max_tokens=max_tokens, model=model, instructions=instructions
+            )
+        except ProviderResponseError as e:
+            if e.is_transient:
+                self._record_failure()
+            else:
+                self._record_success()  # the provider is up, the request itself was rejected
+            raise
+        except Exception:
+            self._record_failure()
+            raise
+        self._record_success()
+        return completions
+
+    def close(self):
+        self._closed.set()
+        self._provider.close()
+
+    def _record_success(self):
+        with self._lock:
+            self._consecutive_failures = 0
+            self._trial_in_flight = False
+            recovered = self._state != CircuitState.CLOSED
+            self._state = CircuitState.CLOSED
+        if recovered:
+            logging.info(f"[{TUTOR_NAME}] The ML provider is available again.")
+            self._notify_availability_change(available=True)
+
+    def _record_failure(self):
+        with self._lock:
+            self._consecutive_failures += 1
+            self._trial_in_flight = False
+            should_open = self._state == CircuitState.HALF_OPEN or (
+                self._state == CircuitState.CLOSED and self._consecutive_failures >= self._failures_threshold
+            )
+            was_closed = self._state == CircuitState.CLOSED
+            if should_open:
+                self._state = CircuitState.OPEN
+        if should_open:
+            Thread(target=self._probe, daemon=True).start()
+            if was_closed:  # a failed trial does not notify again
+                logging.warning(f"[{TUTOR_NAME}] The ML provider is unavailable, showing the original cards.")
+                self._notify_availability_change(available=False)
+
+    def _probe(self):
+        interval = CIRCUIT_BREAKER_PROBE_BASE_INTERVAL_SECONDS
+        while not self._closed.wait(timeout=interval):
+            if self._provider.check_connected_to_web():
+                with self._lock:
+                    if self._state == CircuitState.OPEN:
+                        self._state = CircuitState.HALF_OPEN
+                break
+            interval = min(interval * 2, CIRCUIT_BREAKER_PROBE_MAX_INTERVAL_SECONDS)
+
+    def _notify_availability_change(self, available: bool):
+        if self._on_availability_change is not None:
+            self._on_availability_change(available)
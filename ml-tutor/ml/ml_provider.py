@@ -30,9 +30,61 @@
 # Any modifications to this file must keep this entire header intact.
 
 from abc import ABC, abstractmethod
+from typing import List, Optional
+
+
+class ProviderResponseError(Exception):
+    def __init__(self, status_code: int, message: str, retry_after: Optional[float] = None):
+        super().__init__(f"{status_code}: {message}")
+        self.status_code = status_code
+        self.retry_after = retry_after  # in seconds, if the provider said when to retry
+
+    @property
+    def is_transient(self) -> bool:
+        return self.status_code == 429 or self.status_code >= 500
+
+    @property
+    def is_unauthorized(self) -> bool:
+        return self.status_code in (401, 403)
+
+
+class CompletionTruncated(ProviderResponseError):
+    """Every completion was cut off by the length cap, the request may go through later with a larger one."""
+
+    def __init__(self, max_tokens: int):
+        super().__init__(status_code=200, message=f"Every completion was cut off at {max_tokens} tokens")
 
 
 class MLProvider(ABC):
+    @abstractmethod
+    def check_connected_to_web(self) -> bool:
+        raise NotImplementedError()
+
     @abstractmethod
     def completion(self, prompt: str) -> str:
         raise NotImplementedError()
+
+    def is_available(self) -> bool:
+        """Whether completion requests are currently expected to go through."""
+        return True
+
+    def close(self):
+        pass
+
+    def completions(
+        self,
+        prompt: str,
+        n: int,
+        max_tokens: Optional[int] = None,
+        model: Optional[str] = None,
+        instructions: Optional[str] = None,
+    ) -> List[str]:
+        """Generate `n` independent completions for the same prompt.
+
+        Providers that can return several choices from a single request, that can cap the length of the
+        completions to `max_tokens`, that serve several models or that can send the `instructions` preceding the
+        prompt as a separate (e.g. system) message should override this.
+        """
+        if instructions is not None:
+            prompt = f"{instructions}\n\n{prompt}"
+        return [self.completion(prompt=prompt) for _ in range(n)]
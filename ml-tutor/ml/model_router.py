@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+# ML-Tutor Add-on for Anki
+#
+# Copyright (C)  2024 Petrov P.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version, with the additions
+# listed at the end of the license file that accompanied this program
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# NOTE: This program is subject to certain additional terms pursuant to
+# Section 7 of the GNU Affero General Public License.  You should have
+# received a copy of these additional terms immediately following the
+# terms and conditions of the GNU Affero General Public License that
+# accompanied this program.
+#
+# If not, please request a copy through one of the means of contact
+# listed here: <mailto:petioptrv@icloud.com>.
+#
+# Any modifications to this file must keep this entire header intact.
+
+from threading import Lock
+from typing import Dict, Optional
+
+from constants import MODEL_LATENCY_SMOOTHING
+from utils import Singleton, estimate_tokens
+
+
+class ModelRouter(metaclass=Singleton):
+    """Picks the generative model of each completion request.
+
+    In order of precedence, the model is chosen by the deck of the note (sub-decks inherit the model of their
+    parent deck), by the fastest model observed so far for the card being displayed, by the note type and by the
+    length of the rephrased text. The latency of each model is tracked as a moving average of the seconds spent per
+    generated token, so that short and long requests can be compared.
+    """
+
+    def __init__(self):
+        self._default_model = ""
+        self._short_text_model = ""
+        self._short_text_max_tokens = 0
+        self._note_type_models: Dict[str, str] = {}
+        self._deck_models: Dict[str, str] = {}
+        self._route_on_screen_to_fastest_model = False
+        self._seconds_per_token: Dict[str, float] = {}
+        self._lock = Lock()
+
+    @property
+    def has_deck_models(self) -> bool:
+        return len(self._deck_models) != 0
+
+    def set_routes(
+        self,
+        default_model: str,
+        short_text_model: str,
+        short_text_max_tokens: int,
+        note_type_models: Dict[str, str],
+        deck_models: Dict[str, str],
+        route_on_screen_to_fastest_model: bool,
+    ):
+        self._default_model = default_model
+        self._short_text_model = short_text_model
+        self._short_text_max_tokens = short_text_max_tokens
+        self._note_type_models = note_type_models
+        self._deck_models = deck_models
+        self._route_on_screen_to_fastest_model = route_on_screen_to_fastest_model
+
+    def select_model(self, note_type: str, deck_name: Optional[str], text: str, on_screen: bool) -> str:
+        model = self._get_deck_model(deck_name=deck_name)
+        if model is None and on_screen and self._route_on_screen_to_fastest_model:
+            model = self._get_fastest_model()
+        if model is None:
+            model = self._note_type_models.get(note_type)
+        if (
+            model is None
+            and self._short_text_model != ""
+            and estimate_tokens(text=text) <= self._short_text_max_tokens
+        ):
+            model = self._short_text_model
+        return model or self._default_model
+
+    def record_latency(self, model: str, seconds: float, completions: str):
+        seconds_per_token = seconds / max(estimate_tokens(text=completions), 1)
+        with self._lock:
+            previous = self._seconds_per_token.get(model)
+            if previous is not None:
+                seconds_per_token = previous + MODEL_LATENCY_SMOOTHING * (seconds_per_token - previous)
+            self._seconds_per_token[model] = seconds_per_token
+
+    def _get_deck_model(self, deck_name: Optional[str]) -> Optional[str]:
+        model = None
+        while model is None and deck_name:
+            model = self._deck_models.get(deck_name)
+            deck_name = deck_name.rpartition("::")[0]
+        return model
+
+    def _get_fastest_model(self) -> Optional[str]:
+        with self._lock:
+            candidates = {self._default_model, self._short_text_model, *self._note_type_models.values()}
+            latencies = {
+                model: seconds_per_token
+                for model, seconds_per_token in self._seconds_per_token.items()
+                if model in candidates
+            }
+        return min(latencies, key=latencies.get) if len(latencies) != 0 else None
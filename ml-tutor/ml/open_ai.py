@@ -30,30 +30,59 @@
 # Any modifications to this file must keep this entire header intact.
 
 import logging
-from typing import Dict
+import re
+import time
+from typing import Dict, List, Optional, Tuple
 
 import requests
-from aqt.utils import showCritical, showInfo
+from ml.ml_provider import MLProvider, ProviderResponseError, CompletionTruncated
 
-from constants import TUTOR_NAME
-from ml.ml_provider import MLProvider
+
+_DURATION_PATTERN = re.compile(r"([0-9.]+)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 60 * 60}
 
 
 class OpenAI(MLProvider):
     _base_url = "https://api.openai.com/v1"
 
-    def __init__(self, api_key: str, generative_model: str):
+    def __init__(
+        self, api_key: str, generative_model: str, timeout: Tuple[float, float], base_url: Optional[str] = None
+    ):
         self._api_key = api_key
         self._generative_model = generative_model
+        self._timeout = timeout  # (connect, read) in seconds
+        if base_url:  # e.g. a proxy or another OpenAI-compatible server
+            self._base_url = base_url.rstrip("/")
+        # the request quota left for the current window, as reported by the latest response
+        self.remaining_requests: Optional[int] = None
+        self.requests_reset_seconds: Optional[float] = None
+
+    def with_account(self, api_key: Optional[str] = None, base_url: Optional[str] = None) -> "OpenAI":
+        """A provider for the same model, using another key and/or endpoint."""
+        return OpenAI(
+            api_key=api_key or self._api_key,
+            generative_model=self._generative_model,
+            timeout=self._timeout,
+            base_url=base_url or self._base_url,
+        )
+
+    @property
+    def timeout_seconds(self) -> float:
+        """The longest a request may take before timing out."""
+        return sum(self._timeout)
+
+    @property
+    def name(self) -> str:
+        return f"{self._base_url} (key ...{self._api_key[-4:]})"
 
     def check_connected_to_web(self) -> bool:
         success = False
         try:
             url = f"{self._base_url}/models"
             headers = self._build_auth_headers()
-            requests.get(url=url, headers=headers)
+            requests.get(url=url, headers=headers, timeout=self._timeout)
             success = True
-        except requests.exceptions.ConnectionError:
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
             pass  #
         except Exception:
             logging.exception("OpenAI API server check failed.")
@@ -64,7 +93,7 @@ class OpenAI(MLProvider):
         try:
             url = f"{self._base_url}/models"
             headers = self._build_auth_headers()
-            response = requests.get(url=url, headers=headers)
+            response = requests.get(url=url, headers=headers, timeout=self._timeout)
             success = response.status_code == 200
         except Exception:
             logging.exception("OpenAI API key check failed.")
@@ -73,7 +102,7 @@ class OpenAI(MLProvider):
     def get_valid_models(self) -> list:
         url = f"{self._base_url}/models"
         headers = self._build_auth_headers()
-        response = requests.get(url=url, headers=headers).json()
+        response = requests.get(url=url, headers=headers, timeout=self._timeout).json()
         models = [model_data["id"] for model_data in response["data"]]
         return models
 
@@ -82,30 +111,104 @@ class OpenAI(MLProvider):
         try:
             url = f"{self._base_url}/models/{self._generative_model}"
             headers = self._build_auth_headers()
-            response = requests.get(url=url, headers=headers)
+            response = requests.get(url=url, headers=headers, timeout=self._timeout)
             success = response.status_code == 200
         except Exception:
             logging.exception("OpenAI model check failed.")
         return success
 
     def completion(self, prompt: str) -> str:
+        completions = self.completions(prompt=prompt, n=1)
+        return completions[0] if len(completions) != 0 else ""
+
+    def completions(
+        self,
+        prompt: str,
+        n: int,
+        max_tokens: Optional[int] = None,
+        model: Optional[str] = None,
+        instructions: Optional[str] = None,
+        deadline: Optional[float] = None,
+    ) -> List[str]:
+        """Completions cut off by `max_tokens` are dropped, as a cut-off rephrasing is worse than none.
+
+        If all of them are, the request is retried once with twice the cap before raising `CompletionTruncated`. The
+        timeouts are shortened so as not to wait past the `deadline` (see `time.monotonic`), if given.
+        """
+        messages = self._request_completions(
+            prompt=prompt, n=n, max_tokens=max_tokens, model=model, instructions=instructions, deadline=deadline
+        )
+        if messages is None and max_tokens is not None:
+            messages = self._request_completions(
+                prompt=prompt,
+                n=n,
+                max_tokens=max_tokens * 2,
+                model=model,
+                instructions=instructions,
+                deadline=deadline,
+            )
+            if messages is None:
+                raise CompletionTruncated(max_tokens=max_tokens * 2)
+        return messages or []
+
+    def _request_completions(
+        self,
+        prompt: str,
+        n: int,
+        max_tokens: Optional[int],
+        model: Optional[str],
+        instructions: Optional[str],
+        deadline: Optional[float],
+    ) -> Optional[List[str]]:
+        """The completions that were not cut off, or None if there were some and all of them were."""
         url = f"{self._base_url}/chat/completions"
         headers = self._build_auth_headers()
         headers["Content-Type"] = "application/json"
-        message = {
-            "role": "user",
-            "content": prompt,
-        }
+        messages = []
+        if instructions is not None:  # sent first and unchanged across notes so that OpenAI can cache it
+            messages.append({"role": "system", "content": instructions})
+        messages.append({"role": "user", "content": prompt})
         data = {
-            "model": self._generative_model,
-            "messages": [message],
+            "model": model or self._generative_model,
+            "messages": messages,
+            "n": n,
         }
-        raw_response = requests.post(url=url, headers=headers, json=data)
+        if max_tokens is not None:
+            data["max_completion_tokens"] = max_tokens  # `max_tokens` is deprecated and rejected by reasoning models
+        timeout = self._timeout
+        if deadline is not None:
+            remaining_seconds = deadline - time.monotonic()
+            if remaining_seconds <= 0:
+                raise requests.exceptions.Timeout("The deadline of the request passed before sending it")
+            timeout = tuple(min(seconds, remaining_seconds) for seconds in self._timeout)
+        raw_response = requests.post(url=url, headers=headers, json=data, timeout=timeout)
+        self._update_rate_limits(headers=raw_response.headers)
+        if raw_response.status_code != 200:
+            retry_after = raw_response.headers.get("retry-after")
+            raise ProviderResponseError(
+                status_code=raw_response.status_code,
+                message=raw_response.text,
+                retry_after=float(retry_after) if retry_after and retry_after.isdigit() else None,
+            )
         response = raw_response.json()
         if response is None or "choices" not in response:
-            showCritical(f"[{TUTOR_NAME}] Faulty response from OpenAI {raw_response}", help=None)
-        message = response["choices"][0]["message"]["content"]
-        return message
+            raise ProviderResponseError(status_code=raw_response.status_code, message="Faulty response from OpenAI")
+        messages = [
+            choice["message"]["content"] for choice in response["choices"] if choice.get("finish_reason") != "length"
+        ]
+        if len(messages) == 0 and len(response["choices"]) != 0:
+            messages = None
+        return messages
+
+    def _update_rate_limits(self, headers: Dict):
+        remaining_requests = headers.get("x-ratelimit-remaining-requests")
+        self.remaining_requests = int(remaining_requests) if remaining_requests is not None else None
+        reset_requests = headers.get("x-ratelimit-reset-requests")  # e.g. "1s", "6m0s" or "20ms"
+        self.requests_reset_seconds = (
+            sum(float(value) * _DURATION_UNITS[unit] for value, unit in _DURATION_PATTERN.findall(reset_requests))
+            if reset_requests is not None
+            else None
+        )
 
     def _build_auth_headers(self) -> Dict:
         headers = {
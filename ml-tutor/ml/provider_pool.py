@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+# ML-Tutor Add-on for Anki
+#
+# Copyright (C)  2024 Petrov P.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version, with the additions
+# listed at the end of the license file that accompanied this program
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# NOTE: This program is subject to certain additional terms pursuant to
+# Section 7 of the GNU Affero General Public License.  You should have
+# received a copy of these additional terms immediately following the
+# terms and conditions of the GNU Affero General Public License that
+# accompanied this program.
+#
+# If not, please request a copy through one of the means of contact
+# listed here: <mailto:petioptrv@icloud.com>.
+#
+# Any modifications to this file must keep this entire header intact.
+
+import logging
+import time
+from dataclasses import dataclass
+from threading import Lock
+from typing import Dict, List, Optional, Set, Tuple
+
+from constants import TUTOR_NAME, POOL_EJECTION_BASE_SECONDS, POOL_EJECTION_MAX_SECONDS, MODEL_LATENCY_SMOOTHING
+from ml.circuit_breaker import ProviderUnavailable
+from ml.ml_provider import MLProvider, ProviderResponseError
+from ml.open_ai import OpenAI
+
+
+@dataclass
+class _PoolMember:
+    provider: OpenAI
+    latency: Optional[float] = None  # moving average of the request durations, in seconds
+    in_flight: int = 0
+    consecutive_failures: int = 0
+    ejected_until: float = 0
+
+
+class ProviderPool(MLProvider):
+    """Spreads the completion requests over several OpenAI keys and/or endpoints.
+
+    Each request goes to the available member with the lowest expected wait, which is its observed latency times
+    the number of requests it is already serving, and then to the one with the largest quota left. Members that
+    fail, are throttled or have used up their quota are ejected for a while and the request is retried on another
+    member. Errors caused by the request itself are raised right away. The retries share the timeout of a single
+    request, so that a rephrasing never waits longer than the configured timeouts, whatever the number of members.
+    """
+
+    def __init__(self, providers: List[OpenAI]):
+        self._members = [_PoolMember(provider=provider) for provider in providers]
+        self._lock = Lock()
+
+    def check_connected_to_web(self) -> bool:
+        return any(member.provider.check_connected_to_web() for member in self._members)
+
+    def completion(self, prompt: str) -> str:
+        completions = self.completions(prompt=prompt, n=1)
+        return completions[0] if len(completions) != 0 else ""
+
+    def completions(
+        self,
+        prompt: str,
+        n: int,
+        max_tokens: Optional[int] = None,
+        model: Optional[str] = None,
+        instructions: Optional[str] = None,
+    ) -> List[str]:
+        tried: Set[int] = set()
+        last_error: Optional[Exception] = None
+        deadline = time.monotonic() + max(member.provider.timeout_seconds for member in self._members)
+        member = self._acquire_member(excluded=tried)
+        while member is not None:
+            start_ts = time.monotonic()
+            try:
+                completions = member.provider.completions(
+                    prompt=prompt,
+                    n=n,
+                    max_tokens=max_tokens,
+                    model=model,
+                    instructions=instructions,
+                    deadline=deadline,
+                )
+            except ProviderResponseError as e:
+                if not e.is_transient and not e.is_unauthorized:
+                    self._release_member(member=member)
+                    raise  # another member would reject the request just the same
+                self._eject_member(member=member, error=e)
+                last_error = e
+            except Exception as e:
+                self._eject_member(member=member, error=e)
+                last_error = e
+            else:
+                self._release_member(member=member, latency=time.monotonic() - start_ts)
+                return completions
+            tried.add(id(member))
+            member = self._acquire_member(excluded=tried) if time.monotonic() < deadline else None
+        raise last_error or ProviderUnavailable()
+
+    def close(self):
+        for member in self._members:
+            member.provider.close()
+
+    def _acquire_member(self, excluded: Set[int]) -> Optional[_PoolMember]:
+        now = time.monotonic()
+        with self._lock:
+            candidates = [
+                member for member in self._members if member.ejected_until <= now and id(member) not in excluded
+            ]
+            member = min(candidates, key=self._get_member_score, default=None)
+            if member is not None:
+                member.in_flight += 1
+        return member
+
+    @staticmethod
+    def _get_member_score(member: _PoolMember) -> Tuple[float, float]:
+        expected_wait = (member.in_flight + 1) * (member.latency or 0)  # members never used are tried first
+        remaining_requests = member.provider.remaining_requests
+        return expected_wait, -(remaining_requests if remaining_requests is not None else float("inf"))
+
+    def _release_member(self, member: _PoolMember, latency: Optional[float] = None):
+        with self._lock:
+            member.in_flight -= 1
+            if latency is not None:
+                member.consecutive_failures = 0
+                member.latency = (
+                    latency
+                    if member.latency is None
+                    else member.latency + MODEL_LATENCY_SMOOTHING * (latency - member.latency)
+                )
+                if member.provider.remaining_requests == 0 and member.provider.requests_reset_seconds:
+                    member.ejected_until = time.monotonic() + member.provider.requests_reset_seconds
+
+    def _eject_member(self, member: _PoolMember, error: Exception):
+        with self._lock:
+            member.in_flight -= 1
+            member.consecutive_failures += 1
+            if isinstance(error, ProviderResponseError) and error.is_unauthorized:
+                ejection_seconds = POOL_EJECTION_MAX_SECONDS
+            elif isinstance(error, ProviderResponseError) and error.retry_after is not None:
+                ejection_seconds = error.retry_after
+            else:
+                ejection_seconds = min(
+                    POOL_EJECTION_BASE_SECONDS * 2 ** (member.consecutive_failures - 1), POOL_EJECTION_MAX_SECONDS
+                )
+            member.ejected_until = time.monotonic() + ejection_seconds
+        logging.warning(
+            f"[{TUTOR_NAME}] Not using {member.provider.name} for {ejection_seconds:.0f}s after {error!r}."
+        )
+
+
+def build_provider_pool(primary: OpenAI, additional_accounts: List[Dict[str, str]]) -> MLProvider:
+    """The primary provider or, if additional accounts are configured, a pool of all of them.
+
+    Each additional account may set a `key` and a `base-url`, which default to the primary key and to OpenAI's API.
+    """
+    provider = primary
+    if len(additional_accounts) != 0:
+        provider = ProviderPool(
+            providers=[primary] + [
+                primary.with_account(api_key=account.get("key"), base_url=account.get("base-url"))
+                for account in additional_accounts
+            ]
+        )
+    return provider
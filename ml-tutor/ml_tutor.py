@@ -29,17 +29,32 @@
 #
 # Any modifications to this file must keep this entire header intact.
 
+import logging
+import time
+from threading import Thread
+from typing import Optional, List, Dict
+
 from anki.cards_pb2 import Card
-from anki.collection import Collection
+from anki.collection import Collection, OpChanges
 from anki.notes_pb2 import Note
 from anki.scheduler.v3 import QueuedCards
 from aqt import mw
 from aqt.operations import QueryOp
+from aqt.reviewer import Reviewer
+from aqt.utils import tooltip
 
-from prompts import Prompts
-from constants import REPHRASE_CARDS_AHEAD
-from notes_wrappers import NotesWrapperFactory
+from cancellation import CancellationToken
+from prompts import Prompts, PromptBudget
+from constants import TUTOR_NAME, REPHRASE_CARDS_AHEAD, WARM_UP_FETCH_LIMIT, PREFETCH_WORKER_THREADS, \
+    FORECAST_IDLE_SECONDS, FORECAST_IDLE_CHECK_INTERVAL_SECONDS, EDITED_NOTES_DEBOUNCE_SECONDS, \
+    EDITED_NOTES_MAX_BATCH, WARM_UP_PROGRESS_INTERVAL_SECONDS, ON_SCREEN_TIMEOUT_SECONDS
+from notes_wrappers import NotesWrapperFactory, NoteWrapperBase
+from prefetch_worker import PrefetchWorker, PrefetchPriority
+from profiling import profiled_hook
+from rendered_cards import RenderedCardsCache
+from review_traces import ReviewTraceRecorder
 from ml.ml_provider import MLProvider
+from ml.model_router import ModelRouter
 
 
 class MLTutor:
@@ -54,6 +69,15 @@ class MLTutor:
         min_reviews: int,
         prompts: Prompts,
         display_original_question: bool = True,
+        variants: int = 1,
+        prompt_budget: Optional[PromptBudget] = None,
+        warm_up_due_cards: bool = False,
+        warm_up_max_notes_per_minute: int = 0,
+        forecast_days: int = 0,
+        rephrase_edited_notes: bool = True,
+        cards_ahead: int = REPHRASE_CARDS_AHEAD,
+        prefetch_threads: int = PREFETCH_WORKER_THREADS,
+        on_screen_timeout_seconds: float = ON_SCREEN_TIMEOUT_SECONDS,
     ):
         self._notes_decorator_factory = notes_decorator_factory
         self._ml_provider = ml_provider
@@ -62,6 +86,28 @@ class MLTutor:
         self._ease_target = ease_target
         self._min_interval_days = min_interval_days
         self._min_reviews = min_reviews
+        self._variants = variants
+        self._prompt_budget = prompt_budget or PromptBudget()
+        self._warm_up_due_cards = warm_up_due_cards
+        self._warm_up_max_notes_per_minute = warm_up_max_notes_per_minute
+        self._warm_up_thread: Optional[Thread] = None
+        self._forecast_days = forecast_days
+        self._forecast_thread: Optional[Thread] = None
+        self._last_review_activity_ts = 0.0
+        self._rephrase_edited_notes = rephrase_edited_notes
+        self._edited_note_ids: Dict[int, None] = {}  # saved by an editor since the last pass, the latest last
+        self._edited_notes_saves_count = 0
+        self._edited_notes_pass_running = False
+        self._cards_ahead = cards_ahead
+        self._on_screen_timeout_seconds = on_screen_timeout_seconds
+        self._prefetch_worker = PrefetchWorker(rephrase_note=self._rephrase_note_by_id, threads_count=prefetch_threads)
+        self._rephrased_note_id_on_screen: Optional[int] = None
+        self._model_router = ModelRouter()
+        self._avoided_completions_count = 0
+        self._reported_avoided_completions_count = 0
+        self._queued_card_ids: Dict[int, List[int]] = {}
+        self._rendered_cards = RenderedCardsCache()
+        self._review_trace_recorder = ReviewTraceRecorder()
 
     def set_ml_provider(self, ml_provider: MLProvider):
         self._ml_provider = ml_provider
@@ -81,30 +127,120 @@ class MLTutor:
     def set_min_reviews(self, min_reviews: int):
         self._min_reviews = min_reviews
 
+    def set_variants(self, variants: int):
+        self._variants = variants
+
+    def set_prompt_budget(self, prompt_budget: PromptBudget):
+        self._prompt_budget = prompt_budget
+
+    def set_warm_up_due_cards(self, warm_up_due_cards: bool):
+        self._warm_up_due_cards = warm_up_due_cards
+
+    def set_warm_up_max_notes_per_minute(self, warm_up_max_notes_per_minute: int):
+        self._warm_up_max_notes_per_minute = warm_up_max_notes_per_minute
+
+    def set_forecast_days(self, forecast_days: int):
+        self._forecast_days = forecast_days
+
+    def set_rephrase_edited_notes(self, rephrase_edited_notes: bool):
+        self._rephrase_edited_notes = rephrase_edited_notes
+
+    def set_on_screen_timeout_seconds(self, on_screen_timeout_seconds: float):
+        self._on_screen_timeout_seconds = on_screen_timeout_seconds
+
+    def shutdown(self):
+        self._warm_up_due_cards = False
+        self._forecast_days = 0
+        self._rephrase_edited_notes = False
+        self._edited_note_ids.clear()
+        self._prefetch_worker.stop()
+
     def on_collection_load(self, _: Collection):
-        self._start_next_cards_in_queue()
+        self._prefetch_next_cards_in_queue()
+        self._start_warm_up()
+        self._start_forecast()
+
+    def on_sync_did_finish(self):
+        self._start_warm_up()
+        self._start_forecast()
 
+    def on_operation_did_execute(self, changes: OpChanges, handler: Optional[object]):
+        """Schedules the rephrasing of the notes saved in an editor once the edits settle down.
+
+        Only the note of the editor that made the change is taken, so that syncs and the browser's bulk operations
+        (e.g. find and replace) do not send all the notes they changed. The editor saves a note every few keystrokes,
+        so the pass is pushed back on every save.
+        """
+        note_id = self._get_edited_note_id(handler=handler) if changes.note_text else None
+        if note_id is not None and self._rephrase_edited_notes:
+            self._edited_note_ids.pop(note_id, None)
+            self._edited_note_ids[note_id] = None
+            if len(self._edited_note_ids) > EDITED_NOTES_MAX_BATCH:
+                del self._edited_note_ids[next(iter(self._edited_note_ids))]
+            self._edited_notes_saves_count += 1
+            saves_count = self._edited_notes_saves_count
+            mw.progress.single_shot(
+                EDITED_NOTES_DEBOUNCE_SECONDS * 1000, lambda: self._start_rephrasing_edited_notes(saves_count)
+            )
+
+    @profiled_hook
     def on_card_will_show(self, text: str, card: Card, kind: str) -> str:
-        self._start_next_cards_in_queue()
+        self._last_review_activity_ts = time.monotonic()
+        self._prefetch_next_cards_in_queue()
         note = self._get_note_from_card(card=card)
-        decorated_note = self._notes_decorator_factory.get_wrapped_note(
-            note=note,
-            prompts=self._prompts,
-            display_original_question=self._display_original_question,
-        )
-        if not decorated_note.rephrased:
-            if decorated_note.is_rephrasing:
-                decorated_note.wait_rephrasing()
-            else:
-                decorated_note.rephrase_note(ml_provider=self._ml_provider)
+        decorated_note = self._get_wrapped_note(note=note)
+        if kind == "reviewQuestion":
+            self._review_trace_recorder.record_card_shown(
+                card=card, note=note, note_type=decorated_note.get_model_name()
+            )
+        is_eligible = self._is_card_well_learned(card=card) and decorated_note.should_rephrase(card=card)
+        if not is_eligible and not decorated_note.rephrased:
+            if kind == "reviewQuestion":  # the answer of the card is shown without a request just the same
+                self._record_avoided_completion(note_id=note.id)
+        elif not decorated_note.rephrased:
+            on_screen_done = self._prefetch_worker.submit(note_id=note.id, priority=PrefetchPriority.ON_SCREEN)
+            # otherwise the original card is shown right away
+            if self._ml_provider.is_available() and not on_screen_done.wait(timeout=self._on_screen_timeout_seconds):
+                # the job may be queued behind another note or chain several requests, each with its own timeout
+                self._prefetch_worker.cancel(note_id=note.id)
+                logging.warning(f"[{TUTOR_NAME}] Showing the original card, note {note.id} took too long to rephrase.")
+                self._rephrased_note_id_on_screen = None
+                return text
 
-        if self._is_card_well_learned(card=card) and decorated_note.should_rephrase(card=card):
-            text = decorated_note.rephrase_text(text=text, kind=kind)
+        if is_eligible and decorated_note.rephrased:  # the rephrasing may have failed
+            rendered_text = self._rendered_cards.get(
+                card_id=card.id, kind=kind, text=text, state=decorated_note.rendering_state
+            )
+            text = rendered_text if rendered_text is not None else decorated_note.rephrase_text(text=text, kind=kind)
+            self._rephrased_note_id_on_screen = note.id
+        else:
+            self._rephrased_note_id_on_screen = None
 
         return text
 
-    def on_reviewer_did_show_answer(self, _: Card):
-        self._start_next_cards_in_queue()
+    @profiled_hook
+    def on_reviewer_did_show_answer(self, card: Card):
+        self._review_trace_recorder.record_answer_shown(card=card)
+        self._prefetch_next_cards_in_queue()
+
+    def on_reviewer_will_end(self):
+        skipped_count = self._avoided_completions_count - self._reported_avoided_completions_count
+        self._reported_avoided_completions_count = self._avoided_completions_count
+        if skipped_count != 0:
+            tooltip(
+                msg=f"[{TUTOR_NAME}] {skipped_count} cards did not qualify for rephrasing and were shown without"
+                f" requesting the ML provider.",
+                period=4000,
+            )
+
+    @profiled_hook
+    def on_reviewer_did_answer_card(self, _: Reviewer, card: Card, ease: int):
+        self._last_review_activity_ts = time.monotonic()
+        self._review_trace_recorder.record_card_answered(card=card, ease=ease)
+        if card.nid == self._rephrased_note_id_on_screen:
+            note = self._get_note_from_card(card=card)
+            self._get_wrapped_note(note=note).advance_variant(card=card)
+        self._rephrased_note_id_on_screen = None
 
     def _is_card_well_learned(self, card: Card):
         ease = card.factor / 1000.0
@@ -115,26 +251,298 @@ class MLTutor:
                 interval >= self._min_interval_days and
                 reviews >= self._min_reviews)
 
-    def _start_next_cards_in_queue(self):
+    def _prefetch_next_cards_in_queue(self):
+        if mw.col is not None:  # the queue is read off the main thread, the hooks calling this must not wait for it
+            op = QueryOp(
+                parent=mw,
+                op=lambda _: self._do_prefetch_next_cards_in_queue(),
+                success=lambda _: None,
+            )
+            op.run_in_background()
+
+    def _do_prefetch_next_cards_in_queue(self):
+        col = mw.col
+        if col is not None:
+            next_cards_queue: QueuedCards = col.sched.get_queued_cards(fetch_limit=self._cards_ahead)
+            note_ids = []
+            queued_card_ids: Dict[int, List[int]] = {}
+            for queued_card in next_cards_queue.cards:
+                if self._is_queued_card_eligible(queued_card=queued_card):  # the others are counted when shown
+                    note_ids.append(queued_card.card.note_id)
+                    queued_card_ids.setdefault(queued_card.card.note_id, []).append(queued_card.card.id)
+            self._queued_card_ids = queued_card_ids
+            self._prefetch_worker.submit_queue_snapshot(note_ids=note_ids)
+
+    def _is_queued_card_eligible(self, queued_card: QueuedCards.QueuedCard) -> bool:
+        """Mirrors the checks done before displaying a card without loading it from the collection.
+
+        New cards are never rephrased. The note-type specific checks (e.g. fields too short to be rephrased) are
+        left to the wrapper, which does not request a completion for those fields either.
+        """
+        card = queued_card.card
+        return (
+            queued_card.queue != QueuedCards.NEW
+            and card.ease_factor / 1000.0 >= self._ease_target
+            and card.interval >= self._min_interval_days
+            and card.reps >= self._min_reviews
+        )
+
+    def _record_avoided_completion(self, note_id: int):
+        self._avoided_completions_count += 1
+        logging.debug(
+            f"[{TUTOR_NAME}] Note {note_id} is not eligible for rephrasing,"
+            f" {self._avoided_completions_count} requests skipped so far."
+        )
+
+    def _rephrase_note_by_id(self, note_id: int, priority: PrefetchPriority, cancellation_token: CancellationToken):
+        col = mw.col
+        if col is not None:
+            note = col.get_note(id=note_id)
+            decorated_note = self._get_wrapped_note(note=note)
+            deck_name = None
+            if self._model_router.has_deck_models:
+                deck_name = col.decks.name(col.get_card(note.card_ids()[0]).did)
+            decorated_note.rephrase_note(
+                ml_provider=self._ml_provider,
+                cancellation_token=cancellation_token,
+                deck_name=deck_name,
+                on_screen=priority == PrefetchPriority.ON_SCREEN,
+            )
+            if priority == PrefetchPriority.NEXT_UP:
+                self._prerender_queued_cards(col=col, note_id=note_id, decorated_note=decorated_note)
+
+    def _prerender_queued_cards(self, col: Collection, note_id: int, decorated_note: NoteWrapperBase):
+        """Renders the rephrased question and answer of the note's queued cards ahead of `on_card_will_show`.
+
+        Keeps the HTML parsing off the main thread. The card text is prepared the way the reviewer prepares it
+        before calling the hook, save for the type-in-the-answer filter which depends on the reviewer's state;
+        the cards using it are simply rendered on the main thread when shown. The notes are submitted again on every
+        card shown, the cards already rendered from the current rephrasings are not rendered again.
+        """
+        kinds = ("reviewQuestion", "reviewAnswer")
+        for card_id in self._queued_card_ids.get(note_id, []):
+            if self._rendered_cards.is_rendered(card_id=card_id, kinds=kinds, state=decorated_note.rendering_state):
+                continue
+            card = col.get_card(card_id)
+            if not (
+                self._is_card_well_learned(card=card)
+                and decorated_note.should_rephrase(card=card)
+                and decorated_note.rephrased
+            ):
+                continue
+            state = decorated_note.rendering_state  # taken first, so that a concurrent change leaves a stale entry
+            for kind, text in zip(kinds, (card.question(), card.answer())):
+                text = mw.prepare_card_text_for_display(text)
+                if self._rendered_cards.get(card_id=card_id, kind=kind, text=text, state=state) is None:
+                    self._rendered_cards.put(
+                        card_id=card_id,
+                        kind=kind,
+                        text=text,
+                        state=state,
+                        rendered_text=decorated_note.rephrase_text(text=text, kind=kind),
+                    )
+
+    @staticmethod
+    def _get_edited_note_id(handler: Optional[object]) -> Optional[int]:
+        """The note shown by the editor that is, or belongs to, the window that made the change."""
+        editor = getattr(handler, "editor", handler)
+        note = getattr(editor, "note", None)
+        note_id = note.id if note is not None else getattr(editor, "nid", None)
+        return note_id or None  # the notes being added have no id yet
+
+    def _start_rephrasing_edited_notes(self, saves_count: int):
+        """Runs on the main thread once no note was saved for a while, one pass at a time."""
+        if saves_count != self._edited_notes_saves_count or len(self._edited_note_ids) == 0:
+            return  # a later save schedules its own pass
+        if self._edited_notes_pass_running:
+            mw.progress.single_shot(
+                EDITED_NOTES_DEBOUNCE_SECONDS * 1000, lambda: self._start_rephrasing_edited_notes(saves_count)
+            )
+            return
+        note_ids = list(reversed(self._edited_note_ids))
+        self._edited_note_ids.clear()
+        self._edited_notes_pass_running = True
         op = QueryOp(
             parent=mw,
-            op=lambda _: self._do_start_next_cards_in_queue(),
-            success=lambda _: _,
+            op=lambda _: self._get_edited_note_ids_to_rephrase(note_ids=note_ids),
+            success=self._rephrase_edited_notes_in_background,
         )
+        op.failure(self._on_edited_notes_lookup_failure)
         op.run_in_background()
 
-    def _do_start_next_cards_in_queue(self):
+    def _get_edited_note_ids_to_rephrase(self, note_ids: List[int]) -> List[int]:
         col = mw.col
-        next_cards_queue: QueuedCards = col.sched.get_queued_cards(fetch_limit=REPHRASE_CARDS_AHEAD)
-
-        for card in next_cards_queue.cards:
-            note = self._get_note_from_card(card=card.card)
-            decorated_note = self._notes_decorator_factory.get_wrapped_note(
-                note=note,
-                prompts=self._prompts,
-                display_original_question=self._display_original_question,
+        eligible_note_ids = []
+
+        for note_id in note_ids:
+            note = col.get_note(id=note_id)
+            decorated_note = self._get_wrapped_note(note=note)
+            is_eligible = any(
+                self._is_card_well_learned(card=card) and decorated_note.should_rephrase(card=card)
+                for card in note.cards()
+            )
+            if is_eligible and not decorated_note.rephrased:
+                eligible_note_ids.append(note_id)
+
+        return eligible_note_ids
+
+    def _on_edited_notes_lookup_failure(self, e: Exception):
+        self._edited_notes_pass_running = False
+        logging.warning(f"[{TUTOR_NAME}] Could not look up the edited notes: {e!r}")  # e.g. a note deleted meanwhile
+
+    def _rephrase_edited_notes_in_background(self, note_ids: List[int]):
+        Thread(target=self._do_rephrase_edited_notes, args=(note_ids,), daemon=True).start()
+
+    def _do_rephrase_edited_notes(self, note_ids: List[int]):
+        last_request_ts = 0.0
+
+        try:
+            for i, note_id in enumerate(note_ids):
+                if mw.col is None or not self._rephrase_edited_notes:
+                    break
+                if self._warm_up_max_notes_per_minute > 0:
+                    min_request_interval = 60 / self._warm_up_max_notes_per_minute
+                    time.sleep(max(last_request_ts + min_request_interval - time.time(), 0))
+                last_request_ts = time.time()
+                self._prefetch_worker.submit(note_id=note_id, priority=PrefetchPriority.EDITED, rank=i).wait()
+        finally:
+            self._edited_notes_pass_running = False
+
+    def _start_warm_up(self):
+        if self._warm_up_due_cards and (self._warm_up_thread is None or not self._warm_up_thread.is_alive()):
+            op = QueryOp(
+                parent=mw,
+                op=lambda _: self._get_warm_up_note_ids(),
+                success=self._warm_up_notes,
             )
-            decorated_note.rephrase_note(ml_provider=self._ml_provider)
+            op.run_in_background()
+
+    def _get_warm_up_note_ids(self) -> List[int]:
+        """The notes of today's due review cards not rephrased yet, in the order the scheduler will show them."""
+        col = mw.col
+        due_cards_queue: QueuedCards = col.sched.get_queued_cards(fetch_limit=WARM_UP_FETCH_LIMIT)
+        note_ids = {}
+
+        for queued_card in due_cards_queue.cards:
+            if queued_card.queue == QueuedCards.REVIEW and queued_card.card.note_id not in note_ids:
+                card = col.get_card(queued_card.card.id)
+                if self._is_card_well_learned(card=card) and not self._get_wrapped_note(note=card.note()).rephrased:
+                    note_ids[card.nid] = None  # dicts keep the insertion order
+
+        return list(note_ids)
+
+    def _warm_up_notes(self, note_ids: List[int]):
+        if len(note_ids) != 0 and (self._warm_up_thread is None or not self._warm_up_thread.is_alive()):
+            self._warm_up_thread = Thread(target=self._do_warm_up_notes, args=(note_ids,), daemon=True)
+            self._warm_up_thread.start()
+
+    def _do_warm_up_notes(self, note_ids: List[int]):
+        last_request_ts = 0.0
+        last_progress_ts = time.monotonic()
+        sent_count = 0
+
+        for i, note_id in enumerate(note_ids):
+            if mw.col is None or not self._warm_up_due_cards:
+                break
+            decorated_note = self._get_wrapped_note(note=mw.col.get_note(id=note_id))
+            if not decorated_note.rephrased:  # it may have been rephrased since by the prefetching of the next cards
+                if self._warm_up_max_notes_per_minute > 0:
+                    min_request_interval = 60 / self._warm_up_max_notes_per_minute
+                    time.sleep(max(last_request_ts + min_request_interval - time.time(), 0))
+                last_request_ts = time.time()
+                self._prefetch_worker.submit(note_id=note_id, priority=PrefetchPriority.WARM_UP, rank=i).wait()
+                sent_count += 1
+            if time.monotonic() - last_progress_ts >= WARM_UP_PROGRESS_INTERVAL_SECONDS and i + 1 != len(note_ids):
+                last_progress_ts = time.monotonic()
+                self._show_warm_up_progress(sent_count=sent_count, total_count=len(note_ids))
+        else:
+            if sent_count != 0:
+                self._show_warm_up_progress(sent_count=sent_count, total_count=len(note_ids), done=True)
+
+    def _start_forecast(self):
+        if self._forecast_days > 0 and (self._forecast_thread is None or not self._forecast_thread.is_alive()):
+            forecast_days = self._forecast_days
+            op = QueryOp(
+                parent=mw,
+                op=lambda _: self._get_forecast_note_ids(forecast_days=forecast_days),
+                success=self._forecast_notes,
+            )
+            op.run_in_background()
+
+    def _get_forecast_note_ids(self, forecast_days: int) -> List[int]:
+        """The notes of the review cards due in the next days that will be rephrased, in the order they come due.
+
+        A card's ease, interval and reviews only change when it is reviewed, so the cards that are well learned now
+        will still be when they come due. Today's cards are left to the warm-up.
+        """
+        col = mw.col
+        cards = [
+            col.get_card(card_id)
+            for card_id in col.find_cards(f"is:review -is:suspended -is:buried prop:due>=1 prop:due<={forecast_days}")
+        ]
+        note_ids = {}
+
+        for card in sorted(cards, key=lambda card_: card_.due):
+            if card.nid not in note_ids and self._is_card_well_learned(card=card):
+                note_ids[card.nid] = None  # dicts keep the insertion order
+
+        return list(note_ids)
+
+    def _forecast_notes(self, note_ids: List[int]):
+        if len(note_ids) != 0 and (self._forecast_thread is None or not self._forecast_thread.is_alive()):
+            self._forecast_thread = Thread(target=self._do_forecast_notes, args=(note_ids,), daemon=True)
+            self._forecast_thread.start()
+
+    def _do_forecast_notes(self, note_ids: List[int]):
+        """Rephrases the notes one at a time, only while Anki is idle, at the lowest priority."""
+        last_request_ts = 0.0
+        rephrased_count = 0
+
+        for i, note_id in enumerate(note_ids):
+            while self._forecast_days > 0 and mw.col is not None and not self._is_idle():
+                time.sleep(FORECAST_IDLE_CHECK_INTERVAL_SECONDS)
+            if mw.col is None or self._forecast_days <= 0:
+                break
+            decorated_note = self._get_wrapped_note(note=mw.col.get_note(id=note_id))
+            if not decorated_note.rephrased:
+                if self._warm_up_max_notes_per_minute > 0:
+                    min_request_interval = 60 / self._warm_up_max_notes_per_minute
+                    time.sleep(max(last_request_ts + min_request_interval - time.time(), 0))
+                last_request_ts = time.time()
+                self._prefetch_worker.submit(note_id=note_id, priority=PrefetchPriority.FORECAST, rank=i).wait()
+                rephrased_count += 1
+
+        logging.info(
+            f"[{TUTOR_NAME}] Forecast pre-generation rephrased {rephrased_count} of the {len(note_ids)} notes due"
+            f" in the next {self._forecast_days} days."
+        )
+
+    def _is_idle(self) -> bool:
+        """Not reviewing, nor warming up today's cards, since a while."""
+        return (
+            mw.state != "review"
+            and time.monotonic() - self._last_review_activity_ts >= FORECAST_IDLE_SECONDS
+            and (self._warm_up_thread is None or not self._warm_up_thread.is_alive())
+        )
+
+    @staticmethod
+    def _show_warm_up_progress(sent_count: int, total_count: int, done: bool = False):
+        """The counts only include the notes sent for rephrasing, not those that already were rephrased."""
+        if done:
+            message = f"[{TUTOR_NAME}] Rephrased {sent_count} of today's due notes."
+        else:
+            message = f"[{TUTOR_NAME}] Rephrasing today's due notes: {sent_count}/{total_count}"
+        mw.taskman.run_on_main(lambda: tooltip(msg=message, period=2000))
+
+    def _get_wrapped_note(self, note: Note) -> NoteWrapperBase:
+        decorated_note = self._notes_decorator_factory.get_wrapped_note(
+            note=note,
+            prompts=self._prompts,
+            display_original_question=self._display_original_question,
+            variants=self._variants,
+            prompt_budget=self._prompt_budget,
+        )
+        return decorated_note
 
     @staticmethod
     def _get_note_from_card(card: Card) -> Note:
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+# ML-Tutor Add-on for Anki
+#
+# Copyright (C)  2024 Petrov P.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version, with the additions
+# listed at the end of the license file that accompanied this program
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# NOTE: This program is subject to certain additional terms pursuant to
+# Section 7 of the GNU Affero General Public License.  You should have
+# received a copy of these additional terms immediately following the
+# terms and conditions of the GNU Affero General Public License that
+# accompanied this program.
+#
+# If not, please request a copy through one of the means of contact
+# listed here: <mailto:petioptrv@icloud.com>.
+#
+# Any modifications to this file must keep this entire header intact.
+
+import hashlib
+import random
+from array import array
+from itertools import count
+from threading import Lock
+from typing import Dict, List, Optional, Set, Tuple, Union
+
+from constants import NEAR_DUPLICATE_BANDS, NEAR_DUPLICATE_ROWS_PER_BAND, NEAR_DUPLICATE_SHINGLE_SIZE
+from prompts import Prompt
+from utils import Singleton, compute_digest, normalize_text
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+
+class NearDuplicateIndex(metaclass=Singleton):
+    """Offline index of the rephrased prompts used to reuse rephrasings across near-duplicate notes.
+
+    Only the normalized note part of the prompts (case, punctuation and whitespace dropped) is compared, within the
+    prompts sharing the same instructions and note type. Identical note parts are matched through a dictionary of
+    digests by `get`, and their rephrasings can be reused as they are. Below a similarity threshold of 1,
+    `find_similar` finds candidates with MinHash signatures of the character shingles of the note parts and
+    locality-sensitive hashing over bands of the signatures, and accepts them if their estimated Jaccard similarity
+    reaches the threshold. As a note that differs by a word may state another fact, the rephrasings of similar notes
+    are only a starting point for a new request. A threshold of 0 disables the index.
+    """
+
+    def __init__(self):
+        self._threshold = 0.0
+        self._lock = Lock()
+        self._entry_ids = count()
+        self._rephrasings: Dict[int, List[str]] = {}
+        self._exact_entries: Dict[bytes, int] = {}
+        self._signatures: Dict[int, array] = {}
+        self._buckets: Dict[int, Union[int, List[int]]] = {}  # most buckets hold a single entry
+        permutations_random = random.Random(0)
+        self._permutations = [
+            (permutations_random.randrange(1, _MERSENNE_PRIME), permutations_random.randrange(0, _MERSENNE_PRIME))
+            for _ in range(NEAR_DUPLICATE_BANDS * NEAR_DUPLICATE_ROWS_PER_BAND)
+        ]
+
+    def set_threshold(self, threshold: float):
+        self._threshold = threshold
+
+    def get(self, prompt: Prompt, note_type: str) -> Optional[List[str]]:
+        """The rephrasings of a prompt whose note part is identical once normalized."""
+        rephrasings = None
+        if self._threshold > 0:
+            _, exact_digest = self._get_keys(prompt=prompt, note_type=note_type)
+            entry_id = self._exact_entries.get(exact_digest)
+            if entry_id is not None:
+                rephrasings = self._rephrasings[entry_id]
+        return rephrasings
+
+    def find_similar(self, prompt: Prompt, note_type: str) -> Optional[List[str]]:
+        """The rephrasings of the most similar prompt, to adapt to this one, if any reaches the threshold."""
+        rephrasings = None
+        if 0 < self._threshold < 1:
+            scope, exact_digest = self._get_keys(prompt=prompt, note_type=note_type)
+            entry_id = self._find_similar_entry(scope=scope, normalized_note=normalize_text(text=prompt.note))
+            if entry_id is not None and entry_id != self._exact_entries.get(exact_digest):
+                rephrasings = self._rephrasings[entry_id]
+        return rephrasings
+
+    def add(self, prompt: Prompt, note_type: str, rephrasings: List[str]):
+        if self._threshold > 0:
+            scope, digest = self._get_keys(prompt=prompt, note_type=note_type)
+            signature = None
+            if self._threshold < 1:
+                signature = self._compute_signature(normalized_note=normalize_text(text=prompt.note))
+            with self._lock:
+                entry_id = self._exact_entries.get(digest)
+                if entry_id is None:
+                    entry_id = next(self._entry_ids)
+                    self._exact_entries[digest] = entry_id
+                self._rephrasings[entry_id] = rephrasings
+                if signature is not None and entry_id not in self._signatures:
+                    self._signatures[entry_id] = signature
+                    for bucket_key in self._get_bucket_keys(scope=scope, signature=signature):
+                        bucket = self._buckets.get(bucket_key)
+                        if bucket is None:
+                            self._buckets[bucket_key] = entry_id
+                        elif isinstance(bucket, int):
+                            self._buckets[bucket_key] = [bucket, entry_id]
+                        else:
+                            bucket.append(entry_id)
+
+    @staticmethod
+    def _get_keys(prompt: Prompt, note_type: str) -> Tuple[bytes, bytes]:
+        """The digest of the prompts comparable to this one, and the digest of the prompt's normalized note part."""
+        scope = compute_digest(text=f"{note_type}\n{prompt.instructions}")
+        return scope, compute_digest(text=f"{scope.hex()}\n{normalize_text(text=prompt.note)}")
+
+    def _find_similar_entry(self, scope: bytes, normalized_note: str) -> Optional[int]:
+        signature = self._compute_signature(normalized_note=normalized_note)
+        candidates: Set[int] = set()
+        with self._lock:
+            for bucket_key in self._get_bucket_keys(scope=scope, signature=signature):
+                bucket = self._buckets.get(bucket_key)
+                if isinstance(bucket, int):
+                    candidates.add(bucket)
+                elif bucket is not None:
+                    candidates.update(bucket)
+        best_entry_id = None
+        best_similarity = self._threshold
+        for candidate in candidates:
+            candidate_signature = self._signatures[candidate]
+            similarity = sum(a == b for a, b in zip(signature, candidate_signature)) / len(signature)
+            if similarity >= best_similarity:
+                best_entry_id = candidate
+                best_similarity = similarity
+        return best_entry_id
+
+    def _compute_signature(self, normalized_note: str) -> array:
+        shingles = {
+            normalized_note[i:i + NEAR_DUPLICATE_SHINGLE_SIZE]
+            for i in range(max(len(normalized_note) - NEAR_DUPLICATE_SHINGLE_SIZE + 1, 1))
+        }
+        shingle_hashes = [
+            int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=4).digest(), "little")
+            for shingle in shingles
+        ]
+        signature = array("Q", (
+            min((a * shingle_hash + b) % _MERSENNE_PRIME for shingle_hash in shingle_hashes) & _MAX_HASH
+            for a, b in self._permutations
+        ))
+        return signature
+
+    @staticmethod
+    def _get_bucket_keys(scope: bytes, signature: array) -> List[int]:
+        bucket_keys = []
+        for band in range(NEAR_DUPLICATE_BANDS):
+            rows = tuple(signature[band * NEAR_DUPLICATE_ROWS_PER_BAND:(band + 1) * NEAR_DUPLICATE_ROWS_PER_BAND])
+            bucket_keys.append(hash((scope, band, rows)))
+        return bucket_keys
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+# ML-Tutor Add-on for Anki
+#
+# Copyright (C)  2024 Petrov P.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version, with the additions
+# listed at the end of the license file that accompanied this program
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# NOTE: This program is subject to certain additional terms pursuant to
+# Section 7 of the GNU Affero General Public License.  You should have
+# received a copy of these additional terms immediately following the
+# terms and conditions of the GNU Affero General Public License that
+# accompanied this program.
+#
+# If not, please request a copy through one of the means of contact
+# listed here: <mailto:petioptrv@icloud.com>.
+#
+# Any modifications to this file must keep this entire header intact.
+
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, List, NamedTuple, Optional, Set
+
+from constants import NEGATIVE_CACHE_BASE_BACKOFF_SECONDS, NEGATIVE_CACHE_MAX_BACKOFF_SECONDS, \
+    NEGATIVE_CACHE_AMBIGUOUS_TTL_SECONDS, NEGATIVE_CACHE_MAX_ENTRIES
+from utils import Singleton
+
+AMBIGUOUS_REASON = "ambiguous"
+
+
+class RephrasingBackedOff(Exception):
+    pass
+
+
+class NegativeCacheEntry(NamedTuple):
+    reason: str
+    expiry_ts: Optional[float]  # None in the files synced by earlier versions, for the ambiguous entries
+    failures_count: int
+
+
+class NegativeCache(metaclass=Singleton):
+    """Remembers the prompts for which no rephrasing could be obtained.
+
+    Entries are keyed like the synced rephrasings, by the hash of the prompt, so they become irrelevant as soon as
+    the note changes. Ambiguous notes are not requested again for a month, in case a later model manages them, while
+    failed requests are retried with an exponential backoff instead of on every display. The least recently used
+    entries are dropped beyond `NEGATIVE_CACHE_MAX_ENTRIES`. The failures of this device only (e.g. throttling or
+    timeouts) are kept in memory, only those caused by the prompt itself are synced to the other devices.
+    """
+
+    def __init__(self):
+        self._entries: "OrderedDict[str, NegativeCacheEntry]" = OrderedDict()
+        self._local_keys: Set[str] = set()
+        self._lock = Lock()
+        self.dirty = False
+
+    def get(self, key: str) -> Optional[NegativeCacheEntry]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is not None and entry.expiry_ts <= time.time():
+            entry = None  # the failures count is kept to extend the next backoff
+        return entry
+
+    def put_ambiguous(self, key: str):
+        with self._lock:
+            self._local_keys.discard(key)
+            self._put(
+                key=key,
+                entry=NegativeCacheEntry(
+                    reason=AMBIGUOUS_REASON,
+                    expiry_ts=time.time() + NEGATIVE_CACHE_AMBIGUOUS_TTL_SECONDS,
+                    failures_count=0,
+                ),
+            )
+
+    def put_failure(self, key: str, reason: str, is_local: bool = False):
+        with self._lock:
+            if is_local:
+                self._local_keys.add(key)
+            else:
+                self._local_keys.discard(key)
+            previous_entry = self._entries.get(key)
+            failures_count = 1 if previous_entry is None else previous_entry.failures_count + 1
+            backoff = min(
+                NEGATIVE_CACHE_BASE_BACKOFF_SECONDS * 2 ** (failures_count - 1), NEGATIVE_CACHE_MAX_BACKOFF_SECONDS
+            )
+            self._put(
+                key=key,
+                entry=NegativeCacheEntry(reason=reason, expiry_ts=time.time() + backoff, failures_count=failures_count),
+            )
+
+    def remove(self, key: str):
+        with self._lock:
+            self._local_keys.discard(key)
+            if self._entries.pop(key, None) is not None:
+                self.dirty = True
+
+    def export_entries(self) -> Dict[str, List]:
+        """The entries from the least to the most recently used, without the local and the expired ambiguous ones."""
+        now = time.time()
+        with self._lock:
+            self.dirty = False
+            return {
+                key: list(entry)
+                for key, entry in self._entries.items()
+                if key not in self._local_keys and (entry.reason != AMBIGUOUS_REASON or entry.expiry_ts > now)
+            }
+
+    def merge_entries(self, entries: Dict[str, List]):
+        now = time.time()
+        with self._lock:
+            for key, entry in entries.items():
+                if key not in self._entries:
+                    entry = NegativeCacheEntry(*entry)
+                    if entry.expiry_ts is None:
+                        entry = entry._replace(expiry_ts=now + NEGATIVE_CACHE_AMBIGUOUS_TTL_SECONDS)
+                    self._entries[key] = entry
+                    self._entries.move_to_end(key, last=False)  # the local entries were used more recently
+            self._trim()
+
+    def _put(self, key: str, entry: NegativeCacheEntry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        self._trim()
+        self.dirty = True
+
+    def _trim(self):
+        while len(self._entries) > NEGATIVE_CACHE_MAX_ENTRIES:
+            key, _ = self._entries.popitem(last=False)
+            self._local_keys.discard(key)
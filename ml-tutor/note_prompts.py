@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+# ML-Tutor Add-on for Anki
+#
+# Copyright (C)  2024 Petrov P.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version, with the additions
+# listed at the end of the license file that accompanied this program
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# NOTE: This program is subject to certain additional terms pursuant to
+# Section 7 of the GNU Affero General Public License.  You should have
+# received a copy of these additional terms immediately following the
+# terms and conditions of the GNU Affero General Public License that
+# accompanied this program.
+#
+# If not, please request a copy through one of the means of contact
+# listed here: <mailto:petioptrv@icloud.com>.
+#
+# Any modifications to this file must keep this entire header intact.
+
+"""The prompts of the notes, built from the raw field values of the notes.
+
+Neither the collection nor Anki's GUI are accessed, so that the prompts can be prepared outside of Anki (see
+`precompute.py`). The note wrappers build their prompts with the same functions.
+"""
+
+from typing import Callable, Dict, List, Tuple
+
+from prompts import Prompt, Prompts, PromptBudget, PromptTemplate
+from rephrasing_filter import RephrasingFilter
+from utils import remove_tags
+
+_rephrasing_filter = RephrasingFilter()
+
+
+def clean_rephrasings(completions: List[str]) -> List[str]:
+    rephrasings = [completion.strip('"').strip("'") for completion in completions]
+    return [rephrasing for rephrasing in rephrasings if len(rephrasing) != 0]
+
+
+def format_basic_prompt(
+    template: PromptTemplate,
+    front: str,
+    back: str,
+    prompt_budget: PromptBudget,
+    truncate_front: bool,
+    truncate_back: bool,
+) -> Prompt:
+    """Only the sides given as context may be truncated, the rephrasing of a side replaces all of it on the card."""
+    return template.format(
+        note_front=prompt_budget.fit_field(text=front, truncate=truncate_front),
+        note_back=prompt_budget.fit_field(text=back, truncate=truncate_back),
+    )
+
+
+def format_cloze_prompt(template: PromptTemplate, cloze: str, prompt_budget: PromptBudget) -> Prompt:
+    return template.format(note_cloze=prompt_budget.fit_field(text=cloze, truncate=False))
+
+
+def build_basic_prompts(
+    fields: Dict[str, str], prompts: Prompts, prompt_budget: PromptBudget
+) -> List[Tuple[Prompt, str]]:
+    """The prompt and plain text of each field that would be rephrased."""
+    front = remove_tags(html=fields["Front"])
+    back = remove_tags(html=fields["Back"])
+    field_prompts = []
+    if _rephrasing_filter.get_skip_reason(html=fields["Front"]) is None:
+        field_prompts.append(
+            (
+                format_basic_prompt(
+                    template=prompts.front,
+                    front=front,
+                    back=back,
+                    prompt_budget=prompt_budget,
+                    truncate_front=False,
+                    truncate_back=True,
+                ),
+                front,
+            )
+        )
+    return field_prompts
+
+
+def build_basic_and_reverse_prompts(
+    fields: Dict[str, str], prompts: Prompts, prompt_budget: PromptBudget
+) -> List[Tuple[Prompt, str]]:
+    field_prompts = build_basic_prompts(fields=fields, prompts=prompts, prompt_budget=prompt_budget)
+    front = remove_tags(html=fields["Front"])
+    back = remove_tags(html=fields["Back"])
+    if _rephrasing_filter.get_skip_reason(html=fields["Back"]) is None:
+        field_prompts.append(
+            (
+                format_basic_prompt(
+                    template=prompts.back,
+                    front=front,
+                    back=back,
+                    prompt_budget=prompt_budget,
+                    truncate_front=True,
+                    truncate_back=False,
+                ),
+                back,
+            )
+        )
+    return field_prompts
+
+
+def build_cloze_prompts(
+    fields: Dict[str, str], prompts: Prompts, prompt_budget: PromptBudget
+) -> List[Tuple[Prompt, str]]:
+    field_prompts = []
+    if _rephrasing_filter.get_skip_reason(html=fields["Text"]) is None:
+        cloze = remove_tags(html=fields["Text"])
+        field_prompts.append(
+            (format_cloze_prompt(template=prompts.cloze, cloze=cloze, prompt_budget=prompt_budget), cloze)
+        )
+    return field_prompts
+
+
+# by the lowercase name of the note types, as the note wrappers are registered
+NOTE_PROMPT_BUILDERS: Dict[str, Callable[[Dict[str, str], Prompts, PromptBudget], List[Tuple[Prompt, str]]]] = {
+    "basic": build_basic_prompts,
+    "basic (and reversed card)": build_basic_and_reverse_prompts,
+    "cloze": build_cloze_prompts,
+}
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+# ML-Tutor Add-on for Anki
+#
+# Copyright (C)  2024 Petrov P.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version, with the additions
+# listed at the end of the license file that accompanied this program
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# NOTE: This program is subject to certain additional terms pursuant to
+# Section 7 of the GNU Affero General Public License.  You should have
+# received a copy of these additional terms immediately following the
+# terms and conditions of the GNU Affero General Public License that
+# accompanied this program.
+#
+# If not, please request a copy through one of the means of contact
+# listed here: <mailto:petioptrv@icloud.com>.
+#
+# Any modifications to this file must keep this entire header intact.
+
+from typing import Dict, NamedTuple, Optional
+
+from anki.collection import OpChanges
+from anki.notes import Note
+
+from utils import Singleton
+
+
+class NoteVersion(NamedTuple):
+    epoch: int
+    count: int
+
+
+class NoteVersions(metaclass=Singleton):
+    """Per-note version counters maintained from Anki's note-saving hooks.
+
+    Every save of a note bumps its counter. Operations that change note texts without saving them one by one (e.g.
+    find-and-replace or undo) bump the epoch instead. An unchanged version spares reading the note, while a changed
+    one only means that the note may have changed and must be verified against the note itself.
+    """
+
+    def __init__(self):
+        self._counts: Dict[int, int] = {}
+        self._epoch = 0
+        self._notes_flushed_since_last_operation = False
+
+    def get(self, note_id: int) -> NoteVersion:
+        return NoteVersion(epoch=self._epoch, count=self._counts.get(note_id, 0))
+
+    def bump(self, note_id: int):
+        self._counts[note_id] = self._counts.get(note_id, 0) + 1
+
+    def bump_epoch(self):
+        self._epoch += 1
+
+    def on_note_will_flush(self, note: Note):
+        self.bump(note_id=note.id)
+        self._notes_flushed_since_last_operation = True
+
+    def on_operation_did_execute(self, changes: OpChanges, _: Optional[object]):
+        if changes.note_text and not self._notes_flushed_since_last_operation:
+            self.bump_epoch()
+        self._notes_flushed_since_last_operation = False
@@ -30,12 +30,15 @@
 # Any modifications to this file must keep this entire header intact.
 
 import inspect
+import logging
 import re
+import time
+import zlib
 from abc import ABC, abstractmethod, ABCMeta
 from collections import defaultdict
 from copy import copy
-from threading import Event
-from typing import Union, Optional, Dict, List, Tuple
+from threading import Lock
+from typing import Union, Optional, Dict, List, Tuple, Callable
 import warnings
 
 from anki.cards import Card
@@ -43,19 +46,42 @@ from anki.notes_pb2 import Note
 from aqt import mw
 from bs4 import BeautifulSoup, Tag, MarkupResemblesLocatorWarning
 
-from prompts import Prompts
-from utils import Singleton, remove_tags, build_html_paragraph_from_text
+from cancellation import CancellationToken
+from ml.circuit_breaker import ProviderUnavailable
+from ml.model_router import ModelRouter
+from near_duplicates import NearDuplicateIndex
+from negative_cache import NegativeCache, RephrasingBackedOff, AMBIGUOUS_REASON
+from note_prompts import clean_rephrasings, format_basic_prompt, format_cloze_prompt
+from note_versions import NoteVersion, NoteVersions
+from rephrasing_filter import RephrasingFilter
+from rephrasing_store import FieldRephrasings, RephrasingStore
+from synced_rephrasings import SyncedRephrasings
+from prompts import Prompt, Prompts, PromptBudget, parse_sides
+from utils import Singleton, remove_tags, build_html_paragraph_from_text, compute_digest
 from constants import (
     TUTOR_NAME,
     NOTE_TEXT_PARSER,
+    COMPRESSION_MIN_LENGTH,
+    COMBINED_REQUEST_MAX_UNPARSEABLE_REPLIES,
+    LLM_SIMILAR_NOTE_REPHRASINGS_INTRO,
 )
-from ml.ml_provider import MLProvider
+from ml.ml_provider import MLProvider, ProviderResponseError
 
 warnings.filterwarnings("ignore", category=MarkupResemblesLocatorWarning)
 
 
 class NotesWrapperFactory(metaclass=Singleton):
     _note_wrappers: Dict[int, "NoteWrapperBase"] = {}
+    _note_wrappers_lock = Lock()  # the notes are wrapped from the prefetch threads as well as the main thread
+
+    @staticmethod
+    def set_compress_rephrasings(compress_rephrasings: bool):
+        NoteWrapperBase.compress_rephrasings = compress_rephrasings
+
+    @staticmethod
+    def set_combine_reversed_note_requests(combine_reversed_note_requests: bool):
+        BasicAndReverseNoteWrapper.combine_sides = combine_reversed_note_requests
+        BasicAndReverseNoteWrapper.unparseable_replies_count = 0
 
     @classmethod
     def get_wrapped_note(
@@ -63,24 +89,37 @@ class NotesWrapperFactory(metaclass=Singleton):
         note: Note,
         prompts: Prompts,
         display_original_question: Optional[bool] = None,
+        variants: Optional[int] = None,
+        prompt_budget: Optional[PromptBudget] = None,
     ) -> "NoteWrapperBase":
-        if note.id in NotesWrapperFactory._note_wrappers:
-            wrapped_note = NotesWrapperFactory._note_wrappers[note.id]
-            wrapped_note.set_prompts(prompts=prompts)
-            if display_original_question is not None:
-                wrapped_note.set_display_original_question(display_original_question=display_original_question)
-        else:
-            col = mw.col
-            model_name = col.models.get(col.get_note(id=note.id).mid)["name"].lower()
-
-            decorator_cls = NoteWrapperBase.registry.get(model_name)
-            if decorator_cls is None:
-                decorator_cls = PassThroughNoteWrapper
-
-            display_original_question = display_original_question is None or display_original_question
-            wrapped_note = decorator_cls(note=note, prompts=prompts, display_original_question=display_original_question)
+        with NotesWrapperFactory._note_wrappers_lock:
+            wrapped_note = NotesWrapperFactory._note_wrappers.get(note.id)
+            if wrapped_note is not None:
+                wrapped_note.set_prompts(prompts=prompts)
+                if display_original_question is not None:
+                    wrapped_note.set_display_original_question(display_original_question=display_original_question)
+                if variants is not None:
+                    wrapped_note.set_variants(variants=variants)
+                if prompt_budget is not None:
+                    wrapped_note.set_prompt_budget(prompt_budget=prompt_budget)
+            else:
+                col = mw.col
+                model_name = col.models.get(col.get_note(id=note.id).mid)["name"].lower()
+
+                decorator_cls = NoteWrapperBase.registry.get(model_name)
+                if decorator_cls is None:
+                    decorator_cls = PassThroughNoteWrapper
+
+                display_original_question = display_original_question is None or display_original_question
+                wrapped_note = decorator_cls(
+                    note=note,
+                    prompts=prompts,
+                    display_original_question=display_original_question,
+                    variants=variants or 1,
+                    prompt_budget=prompt_budget or PromptBudget(),
+                )
 
-            NotesWrapperFactory._note_wrappers[note.id] = wrapped_note
+                NotesWrapperFactory._note_wrappers[note.id] = wrapped_note
 
         return wrapped_note
 
@@ -100,6 +139,17 @@ class DecoratorRegistryMeta(ABCMeta, DecoratorRegistry):
 
 
 class NoteWrapperBase(ABC, metaclass=DecoratorRegistryMeta):
+    _note_versions = NoteVersions()
+    _synced_rephrasings = SyncedRephrasings()
+    _near_duplicates = NearDuplicateIndex()
+    _rephrasing_filter = RephrasingFilter()
+    _negative_cache = NegativeCache()
+    _model_router = ModelRouter()
+    _rephrasing_store = RephrasingStore()
+    _fields: Tuple[str, ...] = ()
+    _skip_decisions: Dict[Tuple[int, str], Tuple[NoteVersion, int, bool]] = {}
+    compress_rephrasings = False
+
     @property
     @abstractmethod
     def rephrased(self) -> bool:
@@ -120,22 +170,36 @@ class NoteWrapperBase(ABC, metaclass=DecoratorRegistryMeta):
         ...
 
     @abstractmethod
-    def _do_rephrase_note(self, ml_provider: MLProvider):
+    def _do_rephrase_note(self, ml_provider: MLProvider, cancellation_token: CancellationToken):
         ...
 
-    def __init__(self, note: Note, prompts: Prompts, display_original_question: bool):
+    def __init__(
+        self,
+        note: Note,
+        prompts: Prompts,
+        display_original_question: bool,
+        variants: int = 1,
+        prompt_budget: Optional[PromptBudget] = None,
+    ):
         self._note_id = note.id
         self._prompts = prompts
         self._display_original_question = display_original_question
-        self._is_rephrasing: Optional[Event] = None
+        self._variants = variants
+        self._prompt_budget = prompt_budget or PromptBudget()
+        self._rephrasing_lock = Lock()  # held for the whole rephrasing, so that only one thread rephrases the note
+        self._rephrasing_deck_name: Optional[str] = None
+        self._rephrasing_on_screen = False
 
     @property
     def id(self) -> Union[int, None]:
-        return self.get_note().id
+        return self._note_id
 
     @property
-    def is_rephrasing(self) -> bool:
-        return self._is_rephrasing is not None and not self._is_rephrasing.is_set()
+    def rendering_state(self) -> Tuple:
+        """What `rephrase_text` depends on besides the card's HTML, to tell whether an earlier rendering is current."""
+        return (self._display_original_question,) + tuple(
+            self._rephrasing_store.get(note_id=self._note_id, field=field) for field in self._fields
+        )
 
     def get_note(self) -> Note:
         return mw.col.get_note(id=self._note_id)
@@ -146,17 +210,209 @@ class NoteWrapperBase(ABC, metaclass=DecoratorRegistryMeta):
     def set_display_original_question(self, display_original_question: bool):
         self._display_original_question = display_original_question
 
-    def rephrase_note(self, ml_provider: MLProvider) -> int:
-        self.wait_rephrasing()
-        self._is_rephrasing = Event()
-        self._do_rephrase_note(ml_provider=ml_provider)
-        is_augmenting = self._is_rephrasing
-        self._is_rephrasing = None
-        is_augmenting.set()
-        return 0
+    def set_variants(self, variants: int):
+        self._variants = variants
+
+    def set_prompt_budget(self, prompt_budget: PromptBudget):
+        self._prompt_budget = prompt_budget
+
+    def advance_variant(self, card: Card):
+        """Moves on to the next rephrasing variant of the fields shown by the card once it is reviewed."""
+        self._rephrasing_store.advance_cursors(note_id=self._note_id, fields=self._get_card_fields(card=card))
+
+    def rephrase_note(
+        self,
+        ml_provider: MLProvider,
+        cancellation_token: Optional[CancellationToken] = None,
+        deck_name: Optional[str] = None,
+        on_screen: bool = False,
+    ):
+        """The deck name and whether the note is displayed are used to pick the model of the requests."""
+        cancellation_token = cancellation_token or CancellationToken()
+        with self._rephrasing_lock:
+            self._rephrasing_deck_name = deck_name
+            self._rephrasing_on_screen = on_screen
+            self._do_rephrase_note(ml_provider=ml_provider, cancellation_token=cancellation_token)
+
+    def _generate_rephrasings(
+        self,
+        ml_provider: MLProvider,
+        cancellation_token: CancellationToken,
+        prompt: Prompt,
+        rephrased_text: str,
+        fallback: str,
+        previous_rephrasings: Optional[List[str]],
+    ) -> List[str]:
+        rephrasings = self._get_reusable_rephrasings(prompt=prompt, previous_rephrasings=previous_rephrasings)
+        if rephrasings is None:
+            rephrasings = self._request_rephrasings(
+                ml_provider=ml_provider,
+                cancellation_token=cancellation_token,
+                prompt=self._add_similar_note_rephrasings(prompt=prompt),
+                rephrased_text=rephrased_text,
+                key=self._synced_rephrasings.make_key(prompt=prompt.text),
+            )
+            self._remember_rephrasings(prompt=prompt, rephrasings=rephrasings)
+        if len(rephrasings) == 0:
+            rephrasings = [fallback]
+        return rephrasings
+
+    def _get_reusable_rephrasings(
+        self, prompt: Prompt, previous_rephrasings: Optional[List[str]]
+    ) -> Optional[List[str]]:
+        """The synced rephrasings of the prompt, or those of an identical prompt, unless they were already shown."""
+        rephrasings = self._synced_rephrasings.get(key=self._synced_rephrasings.make_key(prompt=prompt.text))
+        if rephrasings is None or rephrasings == previous_rephrasings:  # the synced ones may have been used up
+            rephrasings = self._near_duplicates.get(prompt=prompt, note_type=self.get_model_name())
+        if rephrasings == previous_rephrasings:
+            rephrasings = None
+        return rephrasings
+
+    def _add_similar_note_rephrasings(self, prompt: Prompt) -> Prompt:
+        """The prompt, followed by the rephrasings of a near-duplicate note for the model to adapt, if there is one."""
+        similar_rephrasings = self._near_duplicates.find_similar(prompt=prompt, note_type=self.get_model_name())
+        if similar_rephrasings is not None:
+            similar_rephrasings_list = "\n".join(f"- {rephrasing}" for rephrasing in similar_rephrasings)
+            prompt = Prompt(
+                instructions=prompt.instructions,
+                note=f"{prompt.note}\n{LLM_SIMILAR_NOTE_REPHRASINGS_INTRO}{similar_rephrasings_list}",
+            )
+        return prompt
+
+    def _remember_rephrasings(self, prompt: Prompt, rephrasings: List[str]):
+        if len(rephrasings) != 0:
+            key = self._synced_rephrasings.make_key(prompt=prompt.text)
+            self._synced_rephrasings.put(key=key, rephrasings=rephrasings)
+            self._near_duplicates.add(prompt=prompt, note_type=self.get_model_name(), rephrasings=rephrasings)
+
+    def _request_rephrasings(
+        self,
+        ml_provider: MLProvider,
+        cancellation_token: CancellationToken,
+        prompt: Prompt,
+        rephrased_text: str,
+        key: str,
+    ) -> List[str]:
+        failure = self._negative_cache.get(key=key)
+        if failure is not None and failure.reason == AMBIGUOUS_REASON:
+            rephrasings = []
+        elif failure is not None:
+            raise RephrasingBackedOff(failure.reason)
+        else:
+            cancellation_token.raise_if_cancelled()  # only before sending, the completions paid for are always kept
+            model = self._model_router.select_model(
+                note_type=self.get_model_name(),
+                deck_name=self._rephrasing_deck_name,
+                text=rephrased_text,
+                on_screen=self._rephrasing_on_screen,
+            )
+            start_ts = time.monotonic()
+            try:
+                rephrasings = ml_provider.completions(
+                    prompt=prompt.note,
+                    instructions=prompt.instructions,
+                    n=self._variants,
+                    max_tokens=self._prompt_budget.get_max_output_tokens(text=rephrased_text),
+                    model=model,
+                )
+            except ProviderUnavailable:
+                raise  # the note itself is not at fault
+            except Exception as e:
+                # the requests rejected for the prompt itself would be rejected on the other devices just the same
+                is_prompt_rejected = (
+                    isinstance(e, ProviderResponseError) and not e.is_transient and not e.is_unauthorized
+                )
+                self._negative_cache.put_failure(key=key, reason=type(e).__name__, is_local=not is_prompt_rejected)
+                raise
+            self._model_router.record_latency(
+                model=model, seconds=time.monotonic() - start_ts, completions=" ".join(rephrasings)
+            )
+            rephrasings = clean_rephrasings(completions=rephrasings)
+            if len(rephrasings) == 0:
+                self._negative_cache.put_ambiguous(key=key)
+            else:
+                self._negative_cache.remove(key=key)
+        return rephrasings
+
+    def _augment_field(self, field: str, extract_text: Callable[[], str], generate: Callable[[], List[str]]):
+        if not self._check_field_is_skipped(field=field, extract_text=extract_text) and not (
+            self._check_field_is_rephrased(field=field, extract_text=extract_text)
+        ):
+            version = self._note_versions.get(note_id=self.id)
+            original_digest = compute_digest(text=extract_text())
+            rephrasings = self._pack_rephrasings(rephrasings=generate())
+            self._rephrasing_store.put(
+                note_id=self.id,
+                field=field,
+                record=FieldRephrasings(
+                    rephrasings=tuple(rephrasings), original_digest=original_digest, version=version
+                ),
+            )
+
+    def _check_field_is_rephrased(self, field: str, extract_text: Callable[[], str]) -> bool:
+        record = self._rephrasing_store.get(note_id=self.id, field=field)
+        return (
+            record is not None
+            and record.cursor < len(record.rephrasings)  # there are variants left to display
+            and self._check_field_is_current(field=field, record=record, extract_text=extract_text)
+        )
+
+    def _check_field_is_current(self, field: str, record: FieldRephrasings, extract_text: Callable[[], str]) -> bool:
+        current_version = self._note_versions.get(note_id=self.id)
+        is_current = record.version == current_version
+        if not is_current:
+            # saves that leave the field as it was (e.g. marking the note, changing its tags or another field) bump
+            # the version too, and some operations change notes without saving them one by one
+            is_current = compute_digest(text=extract_text()) == record.original_digest
+            if is_current:
+                self._rephrasing_store.update_version(
+                    note_id=self.id, field=field, record=record, version=current_version
+                )
+        return is_current
+
+    def _check_field_is_skipped(self, field: str, extract_text: Callable[[], str]) -> bool:
+        """Fields that are not worth rephrasing are displayed as they are, without requesting a rephrasing."""
+        version = self._note_versions.get(note_id=self.id)
+        settings_version = self._rephrasing_filter.settings_version
+        decision = self._skip_decisions.get((self.id, field))
+        if decision is None or decision[:2] != (version, settings_version):
+            skip_reason = self._rephrasing_filter.get_skip_reason(html=extract_text())
+            if skip_reason is not None:
+                logging.debug(f"[{TUTOR_NAME}] Not rephrasing the {field} of note {self.id}: {skip_reason}.")
+            decision = (version, settings_version, skip_reason is not None)
+            self._skip_decisions[(self.id, field)] = decision
+        return decision[2]
+
+    def _pack_rephrasings(self, rephrasings: List[str]) -> List[Union[str, bytes]]:
+        packed_rephrasings = []
+        for rephrasing in rephrasings:
+            if self.compress_rephrasings and len(rephrasing) >= COMPRESSION_MIN_LENGTH:
+                packed_rephrasings.append(zlib.compress(rephrasing.encode("utf-8")))
+            else:
+                packed_rephrasings.append(rephrasing)
+        return packed_rephrasings
+
+    @staticmethod
+    def _unpack_rephrasing(rephrasing: Union[str, bytes]) -> str:
+        if isinstance(rephrasing, bytes):
+            rephrasing = zlib.decompress(rephrasing).decode("utf-8")
+        return rephrasing
+
+    def _get_stored_rephrasings(self, field: str) -> Optional[List[str]]:
+        record = self._rephrasing_store.get(note_id=self.id, field=field)
+        rephrasings = None
+        if record is not None:
+            rephrasings = [self._unpack_rephrasing(rephrasing=rephrasing) for rephrasing in record.rephrasings]
+        return rephrasings
 
-    def wait_rephrasing(self):
-        self._is_rephrasing is not None and self._is_rephrasing.wait()
+    def _get_card_fields(self, card: Card) -> Tuple[str, ...]:
+        """The rephrased fields shown by the card."""
+        return self._fields
+
+    def _get_current_variant(self, field: str) -> str:
+        record = self._rephrasing_store.get(note_id=self.id, field=field)
+        rephrasings = record.rephrasings
+        return self._unpack_rephrasing(rephrasing=rephrasings[min(record.cursor, len(rephrasings) - 1)])
 
 
 class PassThroughNoteWrapper(NoteWrapperBase):
@@ -174,7 +430,7 @@ class PassThroughNoteWrapper(NoteWrapperBase):
     def rephrase_text(self, text: str, kind: str) -> str:
         return text
 
-    def _do_rephrase_note(self, ml_provider: MLProvider):
+    def _do_rephrase_note(self, ml_provider: MLProvider, cancellation_token: CancellationToken):
         pass
 
 
@@ -292,51 +548,64 @@ class BasicNoteWrapperBase(NoteWrapperBase, ABC):
 
 
 class BasicNoteWrapper(BasicNoteWrapperBase):
-    _original_front_texts = {}
-    _rephrased_fronts = {}
+    _fields = ("front",)
 
     @property
     def rephrased(self) -> bool:
-        return self._check_front_is_rephrased()
+        return self._check_front_is_skipped() or self._check_front_is_rephrased()
 
     @staticmethod
     def get_model_name() -> str:
         return "basic"
 
-    def _do_rephrase_note(self, ml_provider: MLProvider):
-        self._augment_front(ml_provider=ml_provider)
-        self._augment_back(ml_provider=ml_provider)
+    def should_rephrase(self, card: Card) -> bool:
+        return super().should_rephrase(card=card) and not self._check_front_is_skipped()
+
+    def _do_rephrase_note(self, ml_provider: MLProvider, cancellation_token: CancellationToken):
+        self._augment_front(ml_provider=ml_provider, cancellation_token=cancellation_token)
+        self._augment_back(ml_provider=ml_provider, cancellation_token=cancellation_token)
+
+    def _augment_front(self, ml_provider: MLProvider, cancellation_token: CancellationToken):
+        self._augment_field(
+            field="front",
+            extract_text=self._extract_front_text,
+            generate=lambda: self._generate_rephrased_front(
+                ml_provider=ml_provider, cancellation_token=cancellation_token
+            ),
+        )
 
-    def _augment_front(self, ml_provider: MLProvider):
-        if not self._check_front_is_rephrased():
-            self._rephrased_fronts[self.id] = self._generate_rephrased_front(ml_provider=ml_provider)
-            self._original_front_texts[self.id] = self._extract_front_text()
+    def _check_front_is_skipped(self) -> bool:
+        return self._check_field_is_skipped(field="front", extract_text=self._extract_front_text)
 
     def _check_front_is_rephrased(self) -> bool:
-        rephrased = False
-        rephrased_front = self._rephrased_fronts.get(self.id)
-        if rephrased_front is not None:
-            current_front = self._extract_front_text()
-            original_front = self._original_front_texts.get(self.id)
-            if current_front == original_front:
-                rephrased = True
-        return rephrased
-
-    def _generate_rephrased_front(self, ml_provider: MLProvider) -> str:
+        return self._check_field_is_rephrased(field="front", extract_text=self._extract_front_text)
+
+    def _generate_rephrased_front(self, ml_provider: MLProvider, cancellation_token: CancellationToken) -> List[str]:
         front = self._extract_front()
         back = self._extract_back()
-        prompt = self._prompts.front.format(note_front=front, note_back=back)
-        rephrased_front = ml_provider.completion(prompt=prompt)
-        rephrased_front = rephrased_front.strip('"').strip("'")
-        if len(rephrased_front) == 0:
-            rephrased_front = f"{front}<br><br><b>[{TUTOR_NAME}]</b> Failed to rephrase note front due to ambiguity."
-        return rephrased_front
-
-    def _augment_back(self, ml_provider: MLProvider):
+        prompt = format_basic_prompt(
+            template=self._prompts.front,
+            front=front,
+            back=back,
+            prompt_budget=self._prompt_budget,
+            truncate_front=False,
+            truncate_back=True,
+        )
+        rephrased_fronts = self._generate_rephrasings(
+            ml_provider=ml_provider,
+            cancellation_token=cancellation_token,
+            prompt=prompt,
+            rephrased_text=front,
+            fallback=f"{front}<br><br><b>[{TUTOR_NAME}]</b> Failed to rephrase note front due to ambiguity.",
+            previous_rephrasings=self._get_stored_rephrasings(field="front"),
+        )
+        return rephrased_fronts
+
+    def _augment_back(self, ml_provider: MLProvider, cancellation_token: CancellationToken):
         pass
 
     def _get_rephrased_question_from_original_question(self, question: str) -> str:
-        return self._rephrased_fronts[self.id]
+        return self._get_current_variant(field="front")
 
     def _get_original_question_from_original_note_text(self, text: str) -> str:
         return self._extract_front_text()
@@ -366,42 +635,149 @@ class BasicNoteWrapper(BasicNoteWrapperBase):
 
 
 class BasicAndReverseNoteWrapper(BasicNoteWrapper):
-    _original_back_texts = {}
-    _rephrased_backs = {}
+    _fields = ("front", "back")
+    combine_sides = True
+    unparseable_replies_count = 0  # consecutive ones, the model may not be able to follow the combined prompt
 
     @property
     def rephrased(self) -> bool:
-        return super().rephrased and self._check_back_is_rephrased()
+        return super().rephrased and (self._check_back_is_skipped() or self._check_back_is_rephrased())
 
     @staticmethod
     def get_model_name() -> str:
         return "basic (and reversed card)"
 
-    def _do_rephrase_note(self, ml_provider: MLProvider):
-        self._augment_front(ml_provider=ml_provider)
-        self._augment_back(ml_provider=ml_provider)
+    def should_rephrase(self, card: Card) -> bool:
+        if card.ord == 0:
+            question_is_skipped = self._check_front_is_skipped()
+        else:
+            question_is_skipped = self._check_back_is_skipped()
+        return BasicNoteWrapperBase.should_rephrase(self, card=card) and not question_is_skipped
+
+    def _get_card_fields(self, card: Card) -> Tuple[str, ...]:
+        return ("front",) if card.ord == 0 else ("back",)
 
-    def _augment_back(self, ml_provider: MLProvider):
-        if not self._check_back_is_rephrased():
-            self._rephrased_backs[self.id] = self._generate_rephrased_back(ml_provider=ml_provider)
-            self._original_back_texts[self.id] = self._extract_back_text()
+    def _do_rephrase_note(self, ml_provider: MLProvider, cancellation_token: CancellationToken):
+        if self.combine_sides and self.unparseable_replies_count < COMBINED_REQUEST_MAX_UNPARSEABLE_REPLIES:
+            self._augment_front_and_back(ml_provider=ml_provider, cancellation_token=cancellation_token)
+        # the sides not rephrased by the combined request, if any, are requested one by one
+        self._augment_front(ml_provider=ml_provider, cancellation_token=cancellation_token)
+        self._augment_back(ml_provider=ml_provider, cancellation_token=cancellation_token)
+
+    def _augment_front_and_back(self, ml_provider: MLProvider, cancellation_token: CancellationToken):
+        """Rephrases both sides with a single request when neither has rephrasings to display or reuse."""
+        front = self._extract_front()
+        back = self._extract_back()
+        front_prompt = format_basic_prompt(
+            template=self._prompts.front,
+            front=front,
+            back=back,
+            prompt_budget=self._prompt_budget,
+            truncate_front=False,
+            truncate_back=True,
+        )
+        back_prompt = format_basic_prompt(
+            template=self._prompts.back,
+            front=front,
+            back=back,
+            prompt_budget=self._prompt_budget,
+            truncate_front=True,
+            truncate_back=False,
+        )
+        if (
+            not self._check_front_is_skipped()
+            and not self._check_front_is_rephrased()
+            and not self._check_back_is_skipped()
+            and not self._check_back_is_rephrased()
+            and self._get_reusable_rephrasings(
+                prompt=front_prompt, previous_rephrasings=self._get_stored_rephrasings(field="front")
+            ) is None
+            and self._get_reusable_rephrasings(
+                prompt=back_prompt, previous_rephrasings=self._get_stored_rephrasings(field="back")
+            ) is None
+        ):
+            sides = self._request_front_and_back(
+                ml_provider=ml_provider, cancellation_token=cancellation_token, front=front, back=back
+            )
+            if sides is not None:
+                rephrased_fronts, rephrased_backs = sides
+                for field, prompt, extract_text, rephrasings in (
+                    ("front", front_prompt, self._extract_front_text, rephrased_fronts),
+                    ("back", back_prompt, self._extract_back_text, rephrased_backs),
+                ):
+                    if len(rephrasings) == 0:  # ambiguous, as the side's own request would have found
+                        self._negative_cache.put_ambiguous(key=self._synced_rephrasings.make_key(prompt=prompt.text))
+                    else:
+                        self._remember_rephrasings(prompt=prompt, rephrasings=rephrasings)
+                        self._augment_field(field=field, extract_text=extract_text, generate=lambda r=rephrasings: r)
+
+    def _request_front_and_back(
+        self, ml_provider: MLProvider, cancellation_token: CancellationToken, front: str, back: str
+    ) -> Optional[Tuple[List[str], List[str]]]:
+        """The rephrasings of each side, or None if the reply could not be used and the sides must be requested apart.
+
+        Replies that cannot be parsed are backed off like failed requests, so that the following attempts go straight
+        to the separate requests for a while.
+        """
+        prompt = format_basic_prompt(
+            template=self._prompts.front_and_back,
+            front=front,
+            back=back,
+            prompt_budget=self._prompt_budget,
+            truncate_front=False,
+            truncate_back=False,
+        )
+        key = self._synced_rephrasings.make_key(prompt=prompt.text)
+        try:
+            completions = self._request_rephrasings(
+                ml_provider=ml_provider,
+                cancellation_token=cancellation_token,
+                prompt=prompt,
+                rephrased_text=f"{front}\n{back}",
+                key=key,
+            )
+        except RephrasingBackedOff:
+            completions = []
+        all_sides = [sides for sides in map(parse_sides, completions) if sides is not None]
+        sides = None
+        if len(all_sides) != 0:
+            BasicAndReverseNoteWrapper.unparseable_replies_count = 0
+            sides = (
+                clean_rephrasings(completions=[rephrased_front for rephrased_front, _ in all_sides]),
+                clean_rephrasings(completions=[rephrased_back for _, rephrased_back in all_sides]),
+            )
+        elif len(completions) != 0:
+            logging.debug(f"[{TUTOR_NAME}] Could not parse the combined rephrasing of note {self.id}.")
+            self._negative_cache.put_failure(key=key, reason="unparseable reply")
+            BasicAndReverseNoteWrapper.unparseable_replies_count += 1
+            if self.unparseable_replies_count == COMBINED_REQUEST_MAX_UNPARSEABLE_REPLIES:
+                logging.warning(
+                    f"[{TUTOR_NAME}] The model's replies to the combined prompt of reversed notes could not be parsed,"
+                    f" requesting their sides separately from now on."
+                )
+        return sides
+
+    def _augment_back(self, ml_provider: MLProvider, cancellation_token: CancellationToken):
+        self._augment_field(
+            field="back",
+            extract_text=self._extract_back_text,
+            generate=lambda: self._generate_rephrased_back(
+                ml_provider=ml_provider, cancellation_token=cancellation_token
+            ),
+        )
+
+    def _check_back_is_skipped(self) -> bool:
+        return self._check_field_is_skipped(field="back", extract_text=self._extract_back_text)
 
     def _check_back_is_rephrased(self) -> bool:
-        rephrased = False
-        rephrased_back = self._rephrased_backs.get(self.id)
-        if rephrased_back is not None:
-            current_back = self._extract_back_text()
-            original_back = self._original_back_texts.get(self.id)
-            if current_back == original_back:
-                rephrased = True
-        return rephrased
+        return self._check_field_is_rephrased(field="back", extract_text=self._extract_back_text)
 
     def _get_rephrased_question_from_original_question(self, question: str) -> str:
         front = self._extract_front()
         if question == front:
-            rephrased_question = self._rephrased_fronts[self.id]
+            rephrased_question = self._get_current_variant(field="front")
         else:
-            rephrased_question = self._rephrased_backs[self.id]
+            rephrased_question = self._get_current_variant(field="back")
         return rephrased_question
 
     def _get_original_question_from_original_note_text(self, text: str) -> str:
@@ -411,8 +787,8 @@ class BasicAndReverseNoteWrapper(BasicNoteWrapper):
         return question_string
 
     def _get_original_question_from_rephrased_note_text(self, text: str) -> str:
-        rephrased_front = self._rephrased_fronts[self.id]
-        rephrased_back = self._rephrased_backs[self.id]
+        rephrased_front = self._get_current_variant(field="front")
+        rephrased_back = self._get_current_variant(field="back")
         rephrased_question = self._find_first_match_in_string(
             target=text, first_sub=rephrased_front, second_sub=rephrased_back
         )
@@ -440,32 +816,41 @@ class BasicAndReverseNoteWrapper(BasicNoteWrapper):
             match = first_sub
         return match
 
-    def _generate_rephrased_back(self, ml_provider: MLProvider) -> str:
+    def _generate_rephrased_back(self, ml_provider: MLProvider, cancellation_token: CancellationToken) -> List[str]:
         front = self._extract_front()
         back = self._extract_back()
-        prompt = self._prompts.back.format(note_front=front, note_back=back)
-        rephrased_back = ml_provider.completion(prompt=prompt)
-        rephrased_back = rephrased_back.strip('"').strip("'")
-        if len(rephrased_back) == 0:
-            rephrased_back = f"{back}<br><br><b>[{TUTOR_NAME}]</b> Failed to rephrase note back due to ambiguity."
-        return rephrased_back
+        prompt = format_basic_prompt(
+            template=self._prompts.back,
+            front=front,
+            back=back,
+            prompt_budget=self._prompt_budget,
+            truncate_front=True,
+            truncate_back=False,
+        )
+        rephrased_backs = self._generate_rephrasings(
+            ml_provider=ml_provider,
+            cancellation_token=cancellation_token,
+            prompt=prompt,
+            rephrased_text=back,
+            fallback=f"{back}<br><br><b>[{TUTOR_NAME}]</b> Failed to rephrase note back due to ambiguity.",
+            previous_rephrasings=self._get_stored_rephrasings(field="back"),
+        )
+        return rephrased_backs
 
 
 class ClozeNoteWrapper(NoteWrapperBase):
-    _original_clozes = {}
-    _original_clozes_pieces: Dict[int, Dict[int, List[str]]] = {}
-    _rephrased_clozes = {}
+    _fields = ("cloze",)
 
     @property
     def rephrased(self) -> bool:
-        return self._check_cloze_is_rephrased()
+        return self._check_cloze_is_skipped() or self._check_cloze_is_rephrased()
 
     @staticmethod
     def get_model_name() -> str:
         return "cloze"
 
     def should_rephrase(self, card: Card) -> bool:
-        return card.queue != 0
+        return card.queue != 0 and not self._check_cloze_is_skipped()
 
     def rephrase_text(self, text: str, kind: str) -> str:
         if kind == "reviewQuestion":
@@ -479,30 +864,33 @@ class ClozeNoteWrapper(NoteWrapperBase):
                 )
         return augmented_text
 
-    def _do_rephrase_note(self, ml_provider: MLProvider):
-        if not self._check_cloze_is_rephrased():
-            original_cloze = self._extract_cloze()
-            self._original_clozes[self.id] = original_cloze
-            self._rephrased_clozes[self.id] = self._generate_rephrased_cloze(ml_provider=ml_provider)
+    def _do_rephrase_note(self, ml_provider: MLProvider, cancellation_token: CancellationToken):
+        self._augment_field(
+            field="cloze",
+            extract_text=self._extract_cloze_text,
+            generate=lambda: self._generate_rephrased_cloze(
+                ml_provider=ml_provider, cancellation_token=cancellation_token
+            ),
+        )
+
+    def _check_cloze_is_skipped(self) -> bool:
+        return self._check_field_is_skipped(field="cloze", extract_text=self._extract_cloze_text)
 
     def _check_cloze_is_rephrased(self) -> bool:
-        rephrased = False
-        rephrased_cloze = self._rephrased_clozes.get(self.id)
-        if rephrased_cloze is not None:
-            current_cloze = self._extract_cloze()
-            original_cloze = self._original_clozes.get(self.id)
-            if current_cloze == original_cloze:
-                rephrased = True
-        return rephrased
-
-    def _generate_rephrased_cloze(self, ml_provider: MLProvider) -> str:
+        return self._check_field_is_rephrased(field="cloze", extract_text=self._extract_cloze_text)
+
+    def _generate_rephrased_cloze(self, ml_provider: MLProvider, cancellation_token: CancellationToken) -> List[str]:
         cloze = self._extract_cloze()
-        prompt = self._prompts.cloze.format(note_cloze=cloze)
-        rephrased_cloze = ml_provider.completion(prompt=prompt)
-        rephrased_cloze = rephrased_cloze.strip('"').strip("'")
-        if len(rephrased_cloze) == 0:
-            rephrased_cloze = f"{cloze}<br><br><b>[{TUTOR_NAME}]</b> Failed to rephrase cloze due to ambiguity."
-        return rephrased_cloze
+        prompt = format_cloze_prompt(template=self._prompts.cloze, cloze=cloze, prompt_budget=self._prompt_budget)
+        rephrased_clozes = self._generate_rephrasings(
+            ml_provider=ml_provider,
+            cancellation_token=cancellation_token,
+            prompt=prompt,
+            rephrased_text=cloze,
+            fallback=f"{cloze}<br><br><b>[{TUTOR_NAME}]</b> Failed to rephrase cloze due to ambiguity.",
+            previous_rephrasings=self._get_stored_rephrasings(field="cloze"),
+        )
+        return rephrased_clozes
 
     def _rephrase_note_text_cloze(self, text: str, hide: bool) -> str:
         target_cloze_number = self._get_target_cloze_number(text=text)
@@ -511,7 +899,7 @@ class ClozeNoteWrapper(NoteWrapperBase):
         else:
             rephrased_text = self._get_text_paragraph_for_cloze_number(
                 target_cloze_number=target_cloze_number,
-                cloze=self._rephrased_clozes[self.id],
+                cloze=self._get_current_variant(field="cloze"),
                 hide=hide,
             )
             original_soup = BeautifulSoup(markup=text, features=NOTE_TEXT_PARSER)
@@ -556,7 +944,7 @@ class ClozeNoteWrapper(NoteWrapperBase):
             target_cloze_number = self._get_target_cloze_number(text=text)
             original_cloze_paragraph_page_elements = self._get_text_paragraph_for_cloze_number(
                 target_cloze_number=target_cloze_number,
-                cloze=self._original_clozes[self.id],
+                cloze=self._extract_cloze(),
                 hide=False,
             )
             original_cloze_soup = BeautifulSoup(markup=original_cloze_paragraph_page_elements, features=NOTE_TEXT_PARSER)
@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+
+# ML-Tutor Add-on for Anki
+#
+# Copyright (C)  2024 Petrov P.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version, with the additions
+# listed at the end of the license file that accompanied this program
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# NOTE: This program is subject to certain additional terms pursuant to
+# Section 7 of the GNU Affero General Public License.  You should have
+# received a copy of these additional terms immediately following the
+# terms and conditions of the GNU Affero General Public License that
+# accompanied this program.
+#
+# If not, please request a copy through one of the means of contact
+# listed here: <mailto:petioptrv@icloud.com>.
+#
+# Any modifications to this file must keep this entire header intact.
+
+"""Precomputes the rephrasings of a whole collection without the Anki GUI.
+
+The prompts are built from the notes of a snapshot of the collection in a pool of processes and the completions are
+requested concurrently, within a rate cap. The rephrasings are written to the synced rephrasings file of the
+collection's media folder, which the add-on loads when `sync-rephrasings` is enabled. The file is saved every few
+completions and the prompts it already holds are skipped, so an interrupted run resumes where it stopped.
+
+Neither Anki nor its GUI are needed, and Anki must be closed, as it locks the collection while it is open. The
+rephrasings written in the meantime by Anki or by a media sync are merged with those of the run when saving.
+
+    python precompute.py --collection ~/.local/share/Anki2/User\\ 1/collection.anki2
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from anki.collection import Collection
+
+from constants import TUTOR_NAME, LLM_BASIC_NOTE_REPHRASING_FRONT_PROMPT_CONFIG_KEY, \
+    LLM_BASIC_AND_REVERSE_NOTE_REPHRASING_BACK_PROMPT_CONFIG_KEY, LLM_CLOZE_NOTE_REPHRASING_PROMPT_CONFIG_KEY, \
+    PROMPT_FIELD_MAX_TOKENS_CONFIG_KEY, OUTPUT_TOKENS_RATIO_CONFIG_KEY, \
+    REPHRASING_VARIANTS_CONFIG_KEY, MIN_WORDS_TO_REPHRASE_CONFIG_KEY, REQUEST_CONNECT_TIMEOUT_CONFIG_KEY, \
+    REQUEST_READ_TIMEOUT_CONFIG_KEY, SYNCED_REPHRASINGS_MAX_ENTRIES, ADDITIONAL_OPENAI_ACCOUNTS_CONFIG_KEY
+from ml.ml_provider import MLProvider
+from ml.open_ai import OpenAI
+from ml.provider_pool import build_provider_pool
+from negative_cache import NegativeCache, AMBIGUOUS_REASON
+from note_prompts import NOTE_PROMPT_BUILDERS, clean_rephrasings
+from prompts import Prompt, Prompts, PromptBudget
+from rephrasing_filter import RephrasingFilter
+from synced_rephrasings import SyncedRephrasings
+
+_worker_prompts: Optional[Prompts] = None
+_worker_prompt_budget: Optional[PromptBudget] = None
+
+
+def load_config(config_path: Optional[str]) -> dict:
+    """The add-on's defaults, overridden by the user's settings that Anki keeps in `meta.json`, or by a given file."""
+    addon_dir = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(addon_dir, "config.json"), encoding="utf-8") as f:
+        config = json.load(f)
+    user_config_path = config_path or os.path.join(addon_dir, "meta.json")
+    if os.path.exists(user_config_path):
+        with open(user_config_path, encoding="utf-8") as f:
+            user_config = json.load(f)
+        config.update(user_config.get("config", user_config))
+    return config
+
+
+def build_prompts_settings(config: dict) -> Tuple[Prompts, PromptBudget]:
+    prompts = Prompts.from_config(
+        front=config[LLM_BASIC_NOTE_REPHRASING_FRONT_PROMPT_CONFIG_KEY],
+        back=config[LLM_BASIC_AND_REVERSE_NOTE_REPHRASING_BACK_PROMPT_CONFIG_KEY],
+        cloze=config[LLM_CLOZE_NOTE_REPHRASING_PROMPT_CONFIG_KEY],
+    )
+    prompt_budget = PromptBudget(
+        field_max_tokens=config[PROMPT_FIELD_MAX_TOKENS_CONFIG_KEY],
+        output_tokens_ratio=config[OUTPUT_TOKENS_RATIO_CONFIG_KEY],
+    )
+    return prompts, prompt_budget
+
+
+class CollectionInUse(Exception):
+    pass
+
+
+def read_supported_notes(collection_path: str, search: str) -> List[Tuple[str, Dict[str, str]]]:
+    """The note type and fields of the notes of the supported types, read from a snapshot of the collection.
+
+    The snapshot is taken with SQLite's backup API, which leaves the collection untouched and, unlike a copy of the
+    file, includes the changes not yet moved out of the write-ahead log. Raises `CollectionInUse` if Anki has the
+    collection open.
+    """
+    notes = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        collection_copy_path = os.path.join(temp_dir, "collection.anki2")
+        source = sqlite3.connect(f"file:{collection_path}?mode=ro", uri=True, timeout=1)
+        try:
+            source.execute("select count() from col")  # the backup would wait for Anki's lock indefinitely
+            destination = sqlite3.connect(collection_copy_path)
+            try:
+                source.backup(destination)
+            finally:
+                destination.close()
+        except sqlite3.OperationalError as e:
+            raise CollectionInUse(str(e)) from e
+        finally:
+            source.close()
+        col = Collection(collection_copy_path)
+        try:
+            for note_id in col.find_notes(search):
+                note = col.get_note(note_id)
+                model_name = col.models.get(note.mid)["name"].lower()
+                if model_name in NOTE_PROMPT_BUILDERS:
+                    notes.append((model_name, dict(note.items())))
+        finally:
+            col.close()
+    return notes
+
+
+def _init_prompts_worker(prompts: Prompts, prompt_budget: PromptBudget, min_words: int):
+    global _worker_prompts, _worker_prompt_budget
+    _worker_prompts = prompts
+    _worker_prompt_budget = prompt_budget
+    RephrasingFilter().set_min_words(min_words=min_words)
+
+
+def _build_note_prompts(note: Tuple[str, Dict[str, str]]) -> List[Tuple[Prompt, str]]:
+    model_name, fields = note
+    return NOTE_PROMPT_BUILDERS[model_name](fields, _worker_prompts, _worker_prompt_budget)
+
+
+def build_all_prompts(
+    notes: List[Tuple[str, Dict[str, str]]],
+    prompts: Prompts,
+    prompt_budget: PromptBudget,
+    min_words: int,
+    processes: Optional[int],
+) -> Dict[str, Tuple[Prompt, str]]:
+    """Maps the synced key of each distinct prompt to the prompt and the text it rephrases."""
+    all_prompts = {}
+    with ProcessPoolExecutor(
+        max_workers=processes,
+        initializer=_init_prompts_worker,
+        initargs=(prompts, prompt_budget, min_words),
+    ) as executor:
+        for note_prompts in executor.map(_build_note_prompts, notes, chunksize=64):
+            for prompt, rephrased_text in note_prompts:
+                all_prompts[SyncedRephrasings.make_key(prompt=prompt.text)] = (prompt, rephrased_text)
+    return all_prompts
+
+
+class _RateLimiter:
+    def __init__(self, max_per_minute: int):
+        self._interval = 60 / max_per_minute if max_per_minute > 0 else 0
+        self._next_ts = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next_ts - now
+            self._next_ts = max(now, self._next_ts) + self._interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+async def request_rephrasings(
+    pending_prompts: Dict[str, Tuple[Prompt, str]],
+    ml_provider: MLProvider,
+    variants: int,
+    prompt_budget: PromptBudget,
+    media_dir: str,
+    concurrency: int,
+    max_requests_per_minute: int,
+    checkpoint_every: int,
+):
+    synced_rephrasings = SyncedRephrasings()
+    negative_cache = NegativeCache()
+    semaphore = asyncio.Semaphore(concurrency)
+    rate_limiter = _RateLimiter(max_per_minute=max_requests_per_minute)
+    counts = {"done": 0, "failed": 0}
+
+    async def request(key: str, prompt: Prompt, rephrased_text: str):
+        async with semaphore:
+            await rate_limiter.wait()
+            try:
+                completions = await asyncio.to_thread(
+                    ml_provider.completions,
+                    prompt=prompt.note,
+                    instructions=prompt.instructions,
+                    n=variants,
+                    max_tokens=prompt_budget.get_max_output_tokens(text=rephrased_text),
+                )
+            except Exception as e:
+                logging.warning(f"[{TUTOR_NAME}] Failed to rephrase a note: {e!r}")
+                counts["failed"] += 1
+                return
+        rephrasings = clean_rephrasings(completions=completions)
+        if len(rephrasings) == 0:
+            negative_cache.put_ambiguous(key=key)
+        else:
+            synced_rephrasings.put(key=key, rephrasings=rephrasings)
+        counts["done"] += 1
+        if counts["done"] % checkpoint_every == 0:
+            await asyncio.to_thread(synced_rephrasings.save, media_dir=media_dir)
+            logging.info(f"[{TUTOR_NAME}] {counts['done']}/{len(pending_prompts)} prompts rephrased.")
+
+    await asyncio.gather(
+        *(request(key, prompt, rephrased_text) for key, (prompt, rephrased_text) in pending_prompts.items())
+    )
+    logging.info(f"[{TUTOR_NAME}] {counts['done']} prompts rephrased, {counts['failed']} failed.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute the rephrasings of a collection without Anki.")
+    parser.add_argument("--collection", required=True, help="Path to the collection.anki2 file.")
+    parser.add_argument("--search", default="", help="Anki search restricting the notes, e.g. 'deck:Spanish'.")
+    parser.add_argument("--config", help="Add-on config (config.json format) or Anki's meta.json of the add-on.")
+    parser.add_argument("--api-key", default=os.environ.get("OPENAI_API_KEY"), help="Defaults to OPENAI_API_KEY.")
+    parser.add_argument("--processes", type=int, help="Processes building the prompts. Defaults to the CPU count.")
+    parser.add_argument("--concurrency", type=int, default=4, help="Maximum number of simultaneous requests.")
+    parser.add_argument("--max-requests-per-minute", type=int, default=60, help="Set to 0 to disable the cap.")
+    parser.add_argument("--checkpoint-every", type=int, default=50, help="Completions between two saves.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    config = load_config(config_path=args.config)
+    api_key = args.api_key or config["openai-key"]
+    prompts, prompt_budget = build_prompts_settings(config=config)
+    collection_path = os.path.abspath(args.collection)
+    media_dir = f"{os.path.splitext(collection_path)[0]}.media"
+
+    synced_rephrasings = SyncedRephrasings()
+    synced_rephrasings.set_enabled(enabled=True)
+    synced_rephrasings.load(media_dir=media_dir)
+    negative_cache = NegativeCache()
+
+    try:
+        notes = read_supported_notes(collection_path=collection_path, search=args.search)
+    except CollectionInUse as e:
+        logging.error(f"[{TUTOR_NAME}] Could not read the collection ({e}), please close Anki first.")
+        raise SystemExit(1)
+    all_prompts = build_all_prompts(
+        notes=notes,
+        prompts=prompts,
+        prompt_budget=prompt_budget,
+        min_words=config[MIN_WORDS_TO_REPHRASE_CONFIG_KEY],
+        processes=args.processes,
+    )
+    pending_prompts = {
+        key: prompt
+        for key, prompt in all_prompts.items()
+        if synced_rephrasings.get(key=key) is None
+        and (negative_cache.get(key=key) is None or negative_cache.get(key=key).reason != AMBIGUOUS_REASON)
+    }
+    logging.info(
+        f"[{TUTOR_NAME}] {len(notes)} notes, {len(all_prompts)} distinct prompts,"
+        f" {len(pending_prompts)} left to rephrase."
+    )
+    if len(all_prompts) > SYNCED_REPHRASINGS_MAX_ENTRIES:
+        logging.warning(
+            f"[{TUTOR_NAME}] Only the latest {SYNCED_REPHRASINGS_MAX_ENTRIES} rephrasings are kept,"
+            f" use --search to precompute a subset of the collection."
+        )
+
+    ml_provider = build_provider_pool(
+        primary=OpenAI(
+            api_key=api_key,
+            generative_model=config["openai-generative-model"],
+            timeout=(config[REQUEST_CONNECT_TIMEOUT_CONFIG_KEY], config[REQUEST_READ_TIMEOUT_CONFIG_KEY]),
+        ),
+        additional_accounts=config[ADDITIONAL_OPENAI_ACCOUNTS_CONFIG_KEY],
+    )
+    try:
+        asyncio.run(
+            request_rephrasings(
+                pending_prompts=pending_prompts,
+                ml_provider=ml_provider,
+                variants=config[REPHRASING_VARIANTS_CONFIG_KEY],
+                prompt_budget=prompt_budget,
+                media_dir=media_dir,
+                concurrency=args.concurrency,
+                max_requests_per_minute=args.max_requests_per_minute,
+                checkpoint_every=args.checkpoint_every,
+            )
+        )
+    finally:
+        synced_rephrasings.save(media_dir=media_dir)
+
+
+if __name__ == "__main__":
+    main()
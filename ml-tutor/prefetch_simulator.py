@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*-
+
+# ML-Tutor Add-on for Anki
+#
+# Copyright (C)  2024 Petrov P.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version, with the additions
+# listed at the end of the license file that accompanied this program
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# NOTE: This program is subject to certain additional terms pursuant to
+# Section 7 of the GNU Affero General Public License.  You should have
+# received a copy of these additional terms immediately following the
+# terms and conditions of the GNU Affero General Public License that
+# accompanied this program.
+#
+# If not, please request a copy through one of the means of contact
+# listed here: <mailto:petioptrv@icloud.com>.
+#
+# Any modifications to this file must keep this entire header intact.
+
+"""Replays recorded review traces against the add-on's prefetching, with a modelled ML provider latency.
+
+The traces are recorded by the add-on with `record-review-traces`. Each trace is replayed on a synthetic collection
+holding a note of the recorded type and size for each reviewed note, through the real `MLTutor` hooks; the
+scheduler's queue is the order in which the cards were reviewed. The provider's latency is sampled from a
+distribution plus a time per output token, and the think times of the trace and the latencies are divided by
+`--speed` so that a session replays in a fraction of its duration. The report gives how often the card on screen
+was ready, the time the hooks blocked the main thread and the completions wasted on notes that were not reviewed
+afterwards, to compare prefetching settings on real usage patterns.
+
+    python prefetch_simulator.py user_files/traces/*.jsonl --cards-ahead 5 --prefetch-threads 3
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import tempfile
+import time
+from dataclasses import dataclass
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+
+import aqt
+from anki.cards import Card
+from anki.cards_pb2 import Card as BackendCard
+from anki.collection import Collection
+from anki.scheduler.v3 import QueuedCards
+
+import load_test  # noqa: F401, sets up the `aqt.mw` that the add-on modules below bind when they are imported
+from constants import (
+    REPHRASE_CARDS_AHEAD,
+    PREFETCH_WORKER_THREADS,
+    EASE_TARGET_CONFIG_KEY,
+    MIN_INTERVAL_DAYS_CONFIG_KEY,
+    MIN_REVIEWS_CONFIG_KEY,
+    REPHRASING_VARIANTS_CONFIG_KEY,
+    DISPLAY_ORIGINAL_QUESTION_CONFIG_KEY,
+    MIN_WORDS_TO_REPHRASE_CONFIG_KEY,
+    REQUEST_CONNECT_TIMEOUT_CONFIG_KEY,
+    REQUEST_READ_TIMEOUT_CONFIG_KEY,
+)
+from ml.ml_provider import MLProvider
+from ml.model_router import ModelRouter
+from ml_tutor import MLTutor
+from notes_wrappers import NotesWrapperFactory
+from precompute import load_config, build_prompts_settings
+from rephrasing_filter import RephrasingFilter
+from review_traces import ReviewTraceEntry, read_trace
+from stand_in_server import LatencyDistribution
+from utils import estimate_tokens
+
+_SIMULATED_MODEL = "simulated"
+_NOTE_MARKER_PATTERN = re.compile(r"\bsim(\d+)\b")
+_QUEUES = {"new": QueuedCards.NEW, "learning": QueuedCards.LEARNING, "review": QueuedCards.REVIEW}
+_QUEUE_TYPES = {"new": 0, "learning": 1, "review": 2}
+_NOTE_TYPES = {
+    "basic": ("Basic", "Front", "Back"),
+    "basic (and reversed card)": ("Basic (and reversed card)", "Front", "Back"),
+    "cloze": ("Cloze", "Text", "Back Extra"),
+}
+_WORDS = (
+    "which river crosses the capital city of the country known for its old bridges and long winters where "
+    "farmers grow wheat while merchants trade silk along ancient roads that connect distant mountain towns"
+).split()
+
+
+class SimulatedProvider(MLProvider):
+    """Answers after a sampled latency plus a time per output token, and records which note each request was for."""
+
+    def __init__(self, latency: LatencyDistribution, seconds_per_token: float, speed: float, seed: Optional[int]):
+        self._latency = latency
+        self._seconds_per_token = seconds_per_token
+        self._speed = speed
+        self._rng = random.Random(seed)
+        self._lock = Lock()
+        self.position = 0  # the index of the trace entry on screen, set by the replay
+        self.requests: List[Tuple[int, int, int]] = []  # (note index, position when requested, completions)
+
+    def check_connected_to_web(self) -> bool:
+        return True
+
+    def completion(self, prompt: str) -> str:
+        return self.completions(prompt=prompt, n=1)[0]
+
+    def completions(
+        self,
+        prompt: str,
+        n: int,
+        max_tokens: Optional[int] = None,
+        model: Optional[str] = None,
+        instructions: Optional[str] = None,
+    ) -> List[str]:
+        position = self.position
+        output_tokens = n * (max_tokens or estimate_tokens(text=prompt))
+        with self._lock:
+            latency = self._latency.sample(rng=self._rng) + output_tokens * self._seconds_per_token
+        time.sleep(latency / self._speed)
+        marker = _NOTE_MARKER_PATTERN.search(prompt)
+        with self._lock:
+            self.requests.append((int(marker.group(1)) if marker else -1, position, n))
+        fields = dict(line.partition(": ")[::2] for line in prompt.splitlines() if line.strip() != "")
+        if instructions is not None and "JSON object" in instructions:  # both sides of a reversed note
+            completions = [
+                json.dumps({
+                    "front": f"Put differently ({i + 1}): {fields.get('Note front', '')}",
+                    "back": f"Put differently ({i + 1}): {fields.get('Note back', '')}",
+                })
+                for i in range(n)
+            ]
+        else:
+            completions = [f"Put differently ({i + 1}): {' '.join(fields.values())}" for i in range(n)]
+        return completions
+
+
+class _TraceScheduler:
+    """Queues the cards in the order of the trace, with the scheduling state they had when reviewed."""
+
+    def __init__(self, entries: List[ReviewTraceEntry], card_ids: Dict[str, int], note_ids: Dict[str, int]):
+        self._entries = entries
+        self._card_ids = card_ids
+        self._note_ids = note_ids
+        self.position = 0
+
+    def get_queued_cards(self, fetch_limit: int = 1, intraday_learning_only: bool = False) -> QueuedCards:
+        queued_cards = QueuedCards()
+        for entry in self._entries[self.position:self.position + fetch_limit]:
+            queued_cards.cards.append(
+                QueuedCards.QueuedCard(
+                    card=BackendCard(
+                        id=self._card_ids[_get_card_key(entry=entry)],
+                        note_id=self._note_ids[entry.note],
+                        ease_factor=entry.ease_factor,
+                        interval=entry.interval,
+                        reps=entry.reps,
+                    ),
+                    queue=_QUEUES[entry.queue],
+                )
+            )
+        return queued_cards
+
+
+class _TraceCollection:
+    """The synthetic collection, with the trace's scheduler."""
+
+    def __init__(self, col: Collection, sched: _TraceScheduler):
+        self._col = col
+        self.sched = sched
+
+    def __getattr__(self, name: str):
+        return getattr(self._col, name)
+
+
+@dataclass
+class SimulationReport:
+    reviews_count: int = 0
+    simulated_seconds: float = 0.0
+    eligible_shows_count: int = 0
+    ready_shows_count: int = 0
+    blocked_seconds: float = 0.0
+    completions_count: int = 0
+    wasted_completions_count: int = 0
+
+    def add(self, other: "SimulationReport"):
+        for name in self.__dataclass_fields__:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+    def format(self) -> str:
+        ready_rate = self.ready_shows_count / self.eligible_shows_count if self.eligible_shows_count != 0 else 0.0
+        wasted_rate = self.wasted_completions_count / self.completions_count if self.completions_count != 0 else 0.0
+        return "\n".join([
+            f"Reviews: {self.reviews_count} over {self.simulated_seconds:.0f}s of simulated time",
+            f"Card on screen ready: {ready_rate:.1%} ({self.ready_shows_count}/{self.eligible_shows_count} eligible)",
+            f"Main thread blocked by the hooks: {self.blocked_seconds:.1f}s of simulated time",
+            f"Completions: {self.completions_count}, wasted: {self.wasted_completions_count} ({wasted_rate:.1%})",
+        ])
+
+
+def build_trace_collection(
+    collection_path: str, entries: List[ReviewTraceEntry], rng: random.Random
+) -> Tuple[Collection, Dict[str, int], Dict[str, int]]:
+    """A collection with a note of the recorded type and size for each note of the trace.
+
+    Returns the collection, the ids of the cards by note digest and card ordinal, and the ids of the notes by digest.
+    The text of each note starts with a marker of its index in the trace, by which the simulated provider tells the
+    notes apart.
+    """
+    col = Collection(collection_path)
+    other_notetype = col.models.copy(col.models.by_name("Basic"))
+    card_ids, note_ids = {}, {}
+    for entry in entries:
+        if entry.note not in note_ids:
+            if entry.note_type in _NOTE_TYPES:
+                notetype_name, main_field, other_field = _NOTE_TYPES[entry.note_type]
+                notetype = col.models.by_name(notetype_name)
+            else:  # a copy of Basic, which the add-on does not rephrase
+                notetype_name, main_field, other_field = other_notetype["name"], "Front", "Back"
+                notetype = other_notetype
+            note = col.new_note(notetype)
+            text = _build_text(marker=f"sim{len(note_ids)}", tokens=entry.note_tokens, rng=rng)
+            if notetype_name == "Cloze":
+                first_word, _, rest = text.partition(" ")
+                text = f"{first_word} {{{{c1::{rest}}}}}" if rest != "" else f"{{{{c1::{first_word}}}}}"
+            note[main_field] = text
+            note[other_field] = _build_text(marker="", tokens=max(entry.note_tokens // 4, 3), rng=rng)
+            col.add_note(note, deck_id=col.decks.id_for_name("Default"))
+            note_ids[entry.note] = note.id
+            for card in note.cards():
+                card_ids[f"{entry.note}:{card.ord}"] = card.id
+        card_key = _get_card_key(entry=entry)
+        if card_key not in card_ids:  # e.g. a card added after the note, replayed with the first card
+            card_ids[card_key] = card_ids[f"{entry.note}:0"]
+    return col, card_ids, note_ids
+
+
+def _get_card_key(entry: ReviewTraceEntry) -> str:
+    return f"{entry.note}:{entry.card_ord}"
+
+
+def _build_text(marker: str, tokens: int, rng: random.Random) -> str:
+    words = [marker] if marker != "" else []
+    while estimate_tokens(text=" ".join(words)) < tokens:
+        words.append(rng.choice(_WORDS))
+    return " ".join(words)
+
+
+def replay_trace(
+    entries: List[ReviewTraceEntry],
+    config: dict,
+    provider: SimulatedProvider,
+    cards_ahead: int,
+    prefetch_threads: int,
+    speed: float,
+    max_gap_seconds: float,
+    rng: random.Random,
+) -> SimulationReport:
+    report = SimulationReport()
+    prompts, prompt_budget = build_prompts_settings(config=config)
+    provider.requests.clear()
+    eligible_positions: Dict[int, List[int]] = {}
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        col, card_ids, note_ids = build_trace_collection(
+            collection_path=os.path.join(temp_dir, "collection.anki2"), entries=entries, rng=rng
+        )
+        note_indexes = {note_id: i for i, note_id in enumerate(note_ids.values())}
+        scheduler = _TraceScheduler(entries=entries, card_ids=card_ids, note_ids=note_ids)
+        aqt.mw.col = _TraceCollection(col=col, sched=scheduler)
+        ml_tutor = MLTutor(
+            notes_decorator_factory=NotesWrapperFactory(),
+            ml_provider=provider,
+            ease_target=config[EASE_TARGET_CONFIG_KEY],
+            min_interval_days=config[MIN_INTERVAL_DAYS_CONFIG_KEY],
+            min_reviews=config[MIN_REVIEWS_CONFIG_KEY],
+            prompts=prompts,
+            display_original_question=config[DISPLAY_ORIGINAL_QUESTION_CONFIG_KEY],
+            variants=config[REPHRASING_VARIANTS_CONFIG_KEY],
+            prompt_budget=prompt_budget,
+            cards_ahead=cards_ahead,
+            prefetch_threads=prefetch_threads,
+            on_screen_timeout_seconds=(
+                config[REQUEST_CONNECT_TIMEOUT_CONFIG_KEY] + config[REQUEST_READ_TIMEOUT_CONFIG_KEY]
+            ) / speed,
+        )
+
+        def timed(func, *args):
+            start = time.perf_counter()
+            func(*args)
+            report.blocked_seconds += (time.perf_counter() - start) * speed
+
+        try:
+            ml_tutor.on_collection_load(col)
+            for i, entry in enumerate(entries):
+                scheduler.position = provider.position = i
+                card = _build_card(col=col, card_id=card_ids[_get_card_key(entry=entry)], entry=entry)
+                wrapped_note = NotesWrapperFactory.get_wrapped_note(note=card.note(), prompts=prompts)
+                if _is_card_well_learned(card=card, config=config) and wrapped_note.should_rephrase(card=card):
+                    report.eligible_shows_count += 1
+                    report.ready_shows_count += wrapped_note.rephrased
+                    eligible_positions.setdefault(note_indexes[card.nid], []).append(i)
+
+                timed(ml_tutor.on_card_will_show, card.question(), card, "reviewQuestion")
+                time.sleep(entry.answer_seconds / speed)
+                timed(ml_tutor.on_card_will_show, card.answer(), card, "reviewAnswer")
+                timed(ml_tutor.on_reviewer_did_show_answer, card)
+                time.sleep(max(entry.review_seconds - entry.answer_seconds, 0) / speed)
+                scheduler.position = i + 1  # the answered card leaves the queue
+                timed(ml_tutor.on_reviewer_did_answer_card, None, card, entry.ease)
+                if i + 1 < len(entries):
+                    gap = entries[i + 1].offset_seconds - entry.offset_seconds - entry.review_seconds
+                    time.sleep(min(max(gap, 0), max_gap_seconds) / speed)
+        finally:
+            ml_tutor.shutdown()
+            aqt.mw.col = None
+            col.close()
+
+    report.reviews_count = len(entries)
+    if len(entries) != 0:
+        report.simulated_seconds = entries[-1].offset_seconds + entries[-1].review_seconds
+    for note_index, position, completions_count in provider.requests:
+        report.completions_count += completions_count
+        if not any(shown >= position for shown in eligible_positions.get(note_index, [])):
+            report.wasted_completions_count += completions_count
+    return report
+
+
+def _build_card(col: Collection, card_id: int, entry: ReviewTraceEntry) -> Card:
+    card = col.get_card(card_id)
+    card.factor = entry.ease_factor
+    card.ivl = entry.interval
+    card.reps = entry.reps
+    card.queue = card.type = _QUEUE_TYPES[entry.queue]
+    return card
+
+
+def _is_card_well_learned(card: Card, config: dict) -> bool:
+    return (
+        card.factor / 1000.0 >= config[EASE_TARGET_CONFIG_KEY]
+        and card.ivl >= config[MIN_INTERVAL_DAYS_CONFIG_KEY]
+        and card.reps >= config[MIN_REVIEWS_CONFIG_KEY]
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay review traces against the add-on's prefetching.")
+    parser.add_argument("traces", nargs="+", help="Trace files recorded with `record-review-traces`.")
+    parser.add_argument("--config", help="Add-on config (config.json format) or Anki's meta.json of the add-on.")
+    parser.add_argument("--cards-ahead", type=int, default=REPHRASE_CARDS_AHEAD, help="Cards prefetched ahead.")
+    parser.add_argument("--prefetch-threads", type=int, default=PREFETCH_WORKER_THREADS, help="Prefetch workers.")
+    parser.add_argument("--latency", default="lognormal:1.0,0.5", help="Latency of a request, e.g. fixed:0.5.")
+    parser.add_argument("--seconds-per-token", type=float, default=0.01, help="Added latency per output token.")
+    parser.add_argument("--speed", type=float, default=10.0, help="How much faster than recorded to replay.")
+    parser.add_argument("--max-gap-seconds", type=float, default=60.0, help="Cap on the breaks between reviews.")
+    parser.add_argument("--seed", type=int, help="Seed of the latencies and the synthetic notes.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(message)s")
+
+    config = load_config(config_path=args.config)
+    RephrasingFilter().set_min_words(min_words=config[MIN_WORDS_TO_REPHRASE_CONFIG_KEY])
+    ModelRouter().set_routes(
+        default_model=_SIMULATED_MODEL,
+        short_text_model="",
+        short_text_max_tokens=0,
+        note_type_models={},
+        deck_models={},
+        route_on_screen_to_fastest_model=False,
+    )
+    rng = random.Random(args.seed)
+    provider = SimulatedProvider(
+        latency=LatencyDistribution(spec=args.latency),
+        seconds_per_token=args.seconds_per_token,
+        speed=args.speed,
+        seed=args.seed,
+    )
+    report = SimulationReport()
+    for path in args.traces:
+        report.add(
+            replay_trace(
+                entries=read_trace(path=path),
+                config=config,
+                provider=provider,
+                cards_ahead=args.cards_ahead,
+                prefetch_threads=args.prefetch_threads,
+                speed=args.speed,
+                max_gap_seconds=args.max_gap_seconds,
+                rng=rng,
+            )
+        )
+    print(report.format())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+# ML-Tutor Add-on for Anki
+#
+# Copyright (C)  2024 Petrov P.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version, with the additions
+# listed at the end of the license file that accompanied this program
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# NOTE: This program is subject to certain additional terms pursuant to
+# Section 7 of the GNU Affero General Public License.  You should have
+# received a copy of these additional terms immediately following the
+# terms and conditions of the GNU Affero General Public License that
+# accompanied this program.
+#
+# If not, please request a copy through one of the means of contact
+# listed here: <mailto:petioptrv@icloud.com>.
+#
+# Any modifications to this file must keep this entire header intact.
+
+import heapq
+import logging
+from enum import IntEnum
+from itertools import count
+from threading import Condition, Event, Thread
+from typing import Callable, Dict, List, Optional, Tuple
+
+from cancellation import CancellationToken, RephrasingCancelled
+from constants import TUTOR_NAME
+from ml.circuit_breaker import ProviderUnavailable
+from ml.ml_provider import ProviderResponseError
+from negative_cache import RephrasingBackedOff
+
+
+class PrefetchPriority(IntEnum):
+    ON_SCREEN = 0
+    NEXT_UP = 1
+    EDITED = 2
+    WARM_UP = 3
+    FORECAST = 4
+
+
+class _PrefetchJob:
+    def __init__(self, note_id: int, priority: PrefetchPriority, rank: int):
+        self.note_id = note_id
+        self.priority = priority
+        self.rank = rank
+        self.done = Event()
+        self.cancellation_token = CancellationToken()
+
+    @property
+    def sort_key(self) -> Tuple[int, int]:
+        return self.priority, self.rank
+
+
+class PrefetchWorker:
+    """Long-lived worker rephrasing notes from a deduplicated priority queue.
+
+    Jobs are ordered by priority and then by their rank within the latest queue snapshot that submitted them.
+    Submitting a note that is already pending re-prioritizes the pending job instead of adding a new one, and
+    submitting a note that is being rephrased returns the event of the running job. Next-up jobs whose notes are
+    missing from the latest queue snapshot are cancelled, whether they are pending or running. A note is never
+    rephrased by two threads at once: a job submitted again after its running job was cancelled waits for it to end.
+
+    With several threads, the first one only takes on-screen and next-up jobs, so that those never wait for the
+    background jobs (e.g. the warm-up) running on the other threads.
+    """
+
+    def __init__(
+        self, rephrase_note: Callable[[int, PrefetchPriority, CancellationToken], None], threads_count: int
+    ):
+        self._rephrase_note = rephrase_note
+        self._condition = Condition()
+        self._queue: List[Tuple[int, int, int, _PrefetchJob]] = []
+        self._pending_jobs: Dict[int, _PrefetchJob] = {}
+        self._running_jobs: Dict[int, _PrefetchJob] = {}
+        self._deferred_jobs: Dict[int, _PrefetchJob] = {}  # waiting for the running job of the same note
+        self._sequence = count()
+        self._stopped = False
+        self._threads = [
+            Thread(
+                target=self._run,
+                args=(PrefetchPriority.NEXT_UP if i == 0 and threads_count > 1 else max(PrefetchPriority),),
+                name=f"{TUTOR_NAME} prefetch worker {i}",
+                daemon=True,
+            )
+            for i in range(threads_count)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, note_id: int, priority: PrefetchPriority, rank: int = 0) -> Event:
+        with self._condition:
+            job = self._running_jobs.get(note_id)
+            if job is None or job.cancellation_token.is_cancelled:
+                job = self._pending_jobs.get(note_id)
+            if job is None:
+                job = _PrefetchJob(note_id=note_id, priority=priority, rank=rank)
+                if self._stopped:
+                    job.done.set()
+                else:
+                    self._pending_jobs[note_id] = job
+                    self._push(job=job)
+            elif note_id in self._pending_jobs and self._should_reprioritize(job=job, priority=priority, rank=rank):
+                job.priority = priority
+                job.rank = rank
+                self._push(job=job)
+            return job.done
+
+    def submit_queue_snapshot(self, note_ids: List[int]):
+        with self._condition:
+            self._cancel_jobs(
+                jobs=[
+                    job
+                    for job in list(self._pending_jobs.values()) + list(self._running_jobs.values())
+                    if job.priority == PrefetchPriority.NEXT_UP and job.note_id not in note_ids
+                ]
+            )
+            for rank, note_id in enumerate(note_ids):
+                self.submit(note_id=note_id, priority=PrefetchPriority.NEXT_UP, rank=rank)
+
+    def cancel(self, note_id: int):
+        with self._condition:
+            jobs = [self._pending_jobs.get(note_id), self._running_jobs.get(note_id)]
+            self._cancel_jobs(jobs=[job for job in jobs if job is not None])
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._cancel_jobs(jobs=list(self._pending_jobs.values()) + list(self._running_jobs.values()))
+            self._queue.clear()
+            self._condition.notify_all()
+
+    def _cancel_jobs(self, jobs: List[_PrefetchJob]):
+        for job in jobs:
+            job.cancellation_token.cancel()
+            if self._pending_jobs.get(job.note_id) is job:
+                del self._pending_jobs[job.note_id]  # its queue entry is skipped once popped
+                job.done.set()
+
+    @staticmethod
+    def _should_reprioritize(job: _PrefetchJob, priority: PrefetchPriority, rank: int) -> bool:
+        # the rank within the latest queue snapshot takes precedence over the rank within older ones
+        return priority < job.priority or (priority == job.priority and rank != job.rank)
+
+    def _push(self, job: _PrefetchJob):
+        heapq.heappush(self._queue, (job.priority, job.rank, next(self._sequence), job))
+        self._condition.notify_all()  # the thread reserved to the urgent jobs may not be able to take it
+
+    def _next_job(self, max_priority: PrefetchPriority) -> Optional[_PrefetchJob]:
+        with self._condition:
+            while not self._stopped:
+                job = self._pop_job(max_priority=max_priority)
+                if job is not None:
+                    return job
+                self._condition.wait()
+        return None
+
+    def _pop_job(self, max_priority: PrefetchPriority) -> Optional[_PrefetchJob]:
+        """Takes the first job that can run, unless it is less urgent than `max_priority`. Requires the condition."""
+        while len(self._queue) != 0:
+            priority, rank, _, job = self._queue[0]
+            if self._pending_jobs.get(job.note_id) is not job or job.sort_key != (priority, rank):
+                heapq.heappop(self._queue)  # stale entries left behind by a re-prioritization are skipped
+            elif priority > max_priority:
+                break
+            elif job.note_id in self._running_jobs:
+                heapq.heappop(self._queue)
+                self._deferred_jobs[job.note_id] = job  # pushed again once the running job of the note is done
+            else:
+                heapq.heappop(self._queue)
+                del self._pending_jobs[job.note_id]
+                self._running_jobs[job.note_id] = job
+                return job
+        return None
+
+    def _run(self, max_priority: PrefetchPriority):
+        job = self._next_job(max_priority=max_priority)
+        while job is not None:
+            try:
+                self._rephrase_note(job.note_id, job.priority, job.cancellation_token)
+            except RephrasingCancelled:
+                logging.debug(f"[{TUTOR_NAME}] Cancelled the rephrasing of note {job.note_id}.")
+            except ProviderUnavailable:
+                logging.debug(f"[{TUTOR_NAME}] Skipped the rephrasing of note {job.note_id}, the provider is down.")
+            except RephrasingBackedOff as e:
+                logging.debug(f"[{TUTOR_NAME}] Backing off from rephrasing note {job.note_id} after {e}.")
+            except ProviderResponseError as e:
+                if not e.is_transient:
+                    logging.exception(f"[{TUTOR_NAME}] Failed to rephrase note {job.note_id}.")
+                else:  # throttling and server errors are expected now and then, the note is retried later
+                    logging.warning(f"[{TUTOR_NAME}] Failed to rephrase note {job.note_id}: {e}")
+            except Exception:
+                logging.exception(f"[{TUTOR_NAME}] Failed to rephrase note {job.note_id}.")
+            finally:
+                with self._condition:
+                    if self._running_jobs.get(job.note_id) is job:
+                        del self._running_jobs[job.note_id]
+                    deferred_job = self._deferred_jobs.pop(job.note_id, None)
+                    if deferred_job is not None and self._pending_jobs.get(job.note_id) is deferred_job:
+                        self._push(job=deferred_job)
+                job.done.set()
+            job = self._next_job(max_priority=max_priority)
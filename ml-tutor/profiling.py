@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+# ML-Tutor Add-on for Anki
+#
+# Copyright (C)  2024 Petrov P.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version, with the additions
+# listed at the end of the license file that accompanied this program
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# NOTE: This program is subject to certain additional terms pursuant to
+# Section 7 of the GNU Affero General Public License.  You should have
+# received a copy of these additional terms immediately following the
+# terms and conditions of the GNU Affero General Public License that
+# accompanied this program.
+#
+# If not, please request a copy through one of the means of contact
+# listed here: <mailto:petioptrv@icloud.com>.
+#
+# Any modifications to this file must keep this entire header intact.
+
+import cProfile
+import functools
+import io
+import logging
+import os
+import pstats
+import time
+import tracemalloc
+from typing import Callable, Optional
+
+from constants import TUTOR_NAME, PROFILE_SUMMARY_FUNCTIONS_COUNT, PROFILE_SUMMARY_ALLOCATIONS_COUNT, \
+    PROFILE_TRACEMALLOC_FRAMES
+from utils import Singleton
+
+
+class HookProfiler(metaclass=Singleton):
+    """Captures cProfile and tracemalloc data for a given number of hook invocations.
+
+    Once the invocations are done, the profile (`.prof`, readable with `pstats` or snakeviz), the allocations
+    snapshot (`.snapshot`, readable with `tracemalloc.Snapshot.load`) and a text summary of both are written to the
+    output directory, with the same timestamped name.
+    """
+
+    def __init__(self):
+        self._profile: Optional[cProfile.Profile] = None
+        self._remaining_invocations = 0
+        self._output_dir = ""
+        self._on_finished: Optional[Callable[[str], None]] = None
+        self._started_tracemalloc = False
+        self._is_running_hook = False
+
+    @property
+    def is_active(self) -> bool:
+        return self._profile is not None
+
+    def start(self, invocations_count: int, output_dir: str, on_finished: Optional[Callable[[str], None]] = None):
+        if invocations_count > 0 and not self.is_active:
+            self._remaining_invocations = invocations_count
+            self._output_dir = output_dir
+            self._on_finished = on_finished
+            self._started_tracemalloc = not tracemalloc.is_tracing()
+            if self._started_tracemalloc:
+                tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+            self._profile = cProfile.Profile()
+            logging.info(f"[{TUTOR_NAME}] Profiling the next {invocations_count} hook invocations.")
+
+    def run(self, func: Callable, *args, **kwargs):
+        if not self.is_active or self._is_running_hook:  # hooks triggered from within a hook are profiled with it
+            return func(*args, **kwargs)
+        self._is_running_hook = True
+        try:
+            return self._profile.runcall(func, *args, **kwargs)
+        finally:
+            self._is_running_hook = False
+            self._remaining_invocations -= 1
+            if self._remaining_invocations == 0:
+                self._finish()
+
+    def _finish(self):
+        profile = self._profile
+        self._profile = None
+        snapshot = tracemalloc.take_snapshot()
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+        os.makedirs(self._output_dir, exist_ok=True)
+        base_path = os.path.join(self._output_dir, time.strftime("profile-%Y%m%d-%H%M%S"))
+        profile.dump_stats(f"{base_path}.prof")
+        snapshot.dump(f"{base_path}.snapshot")
+        summary_path = f"{base_path}.txt"
+        with open(summary_path, "w", encoding="utf-8") as f:
+            f.write(self._build_summary(profile=profile, snapshot=snapshot))
+        logging.info(f"[{TUTOR_NAME}] Profile written to {summary_path}.")
+        if self._on_finished is not None:
+            self._on_finished(summary_path)
+
+    @staticmethod
+    def _build_summary(profile: cProfile.Profile, snapshot: tracemalloc.Snapshot) -> str:
+        stream = io.StringIO()
+        stats = pstats.Stats(profile, stream=stream)
+        stream.write("Top functions by cumulative time\n\n")
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(PROFILE_SUMMARY_FUNCTIONS_COUNT)
+        stream.write("Top functions by own time\n\n")
+        stats.sort_stats(pstats.SortKey.TIME).print_stats(PROFILE_SUMMARY_FUNCTIONS_COUNT)
+        stream.write("Top allocations by line\n\n")
+        for statistic in snapshot.statistics("lineno")[:PROFILE_SUMMARY_ALLOCATIONS_COUNT]:
+            stream.write(f"{statistic}\n")
+        return stream.getvalue()
+
+
+def profiled_hook(func: Callable) -> Callable:
+    """Lets the `HookProfiler` capture the invocations of the decorated hook while it is active."""
+    hook_profiler = HookProfiler()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return hook_profiler.run(func, *args, **kwargs)
+
+    return wrapper
@@ -1,8 +1,141 @@
-from dataclasses import dataclass
+import json
+import re
+from dataclasses import dataclass, field
+from typing import Optional, Tuple
+
+from constants import MIN_OUTPUT_TOKENS, PROMPT_FIELD_LABELS, LLM_BASIC_NOTE_REPHRASING_FRONT_PROMPT, \
+    LLM_NORMAL_NOTE_REPHRASING_BACK_PROMPT, LLM_CLOZE_NOTE_REPHRASING_PROMPT, \
+    LEGACY_LLM_BASIC_NOTE_REPHRASING_FRONT_PROMPT, LEGACY_LLM_NORMAL_NOTE_REPHRASING_BACK_PROMPT, \
+    LEGACY_LLM_CLOZE_NOTE_REPHRASING_PROMPT, LLM_BASIC_AND_REVERSE_NOTE_BOTH_SIDES_PROMPT_INTRO, \
+    LLM_BASIC_AND_REVERSE_NOTE_BOTH_SIDES_PROMPT_FORMAT
+from utils import compact_text, estimate_tokens, truncate_to_token_budget
+
+_PLACEHOLDER_PATTERN = re.compile(r"""(['"]?)\{(%s)\}\1""" % "|".join(PROMPT_FIELD_LABELS))
+_CODE_FENCE_PATTERN = re.compile(r"^```(?:json)?\s*|\s*```$")
+
+
+@dataclass(frozen=True)
+class Prompt:
+    """A prompt split into instructions shared by every note and the note-specific part that follows them.
+
+    Keeping the instructions as an identical prefix of every request lets the providers cache it.
+    """
+    instructions: str
+    note: str
+
+    @property
+    def text(self) -> str:
+        return f"{self.instructions}\n\n{self.note}"
+
+
+@dataclass(frozen=True)
+class PromptTemplate:
+    instructions: str
+    note: str
+
+    @classmethod
+    def from_config(
+        cls, template: str, default_template: str, legacy_default_template: str, default_fields: Tuple[str, ...]
+    ) -> "PromptTemplate":
+        """Builds the template from a configured prompt, migrating the prompts that embed the note fields.
+
+        The fields referenced by keywords such as `{note_front}` are moved to the note part and the keywords are
+        replaced by a reference to them. Prompts without keywords are taken as instructions for the default fields.
+        """
+        if template == "" or template.split() == legacy_default_template.split():
+            template = " ".join(default_template.split())  # as written in config.json
+        fields = tuple(dict.fromkeys(match.group(2) for match in _PLACEHOLDER_PATTERN.finditer(template)))
+        if len(fields) == 0:
+            instructions = template
+            fields = default_fields
+        else:
+            instructions = _PLACEHOLDER_PATTERN.sub(
+                lambda match: f"the {PROMPT_FIELD_LABELS[match.group(2)].lower()} given below", template
+            )
+            instructions = instructions.replace("{{", "{").replace("}}", "}")  # the template is no longer formatted
+        note = "\n".join(f"{PROMPT_FIELD_LABELS[field]}: {{{field}}}" for field in fields)
+        return cls(instructions=instructions.strip(), note=note)
+
+    @classmethod
+    def combine_sides(cls, front: "PromptTemplate", back: "PromptTemplate") -> "PromptTemplate":
+        """A template requesting the rephrasings of both sides of a note at once, replied as parsed by `parse_sides`."""
+        instructions = "\n\n".join([
+            " ".join(LLM_BASIC_AND_REVERSE_NOTE_BOTH_SIDES_PROMPT_INTRO.split()),
+            f"For the front: {front.instructions}",
+            f"For the back: {back.instructions}",
+            " ".join(LLM_BASIC_AND_REVERSE_NOTE_BOTH_SIDES_PROMPT_FORMAT.split()),
+        ])
+        note = "\n".join(dict.fromkeys(front.note.splitlines() + back.note.splitlines()))
+        return cls(instructions=instructions, note=note)
+
+    def format(self, **fields: str) -> Prompt:
+        return Prompt(instructions=self.instructions, note=self.note.format(**fields))
+
+
+def parse_sides(completion: str) -> Optional[Tuple[str, str]]:
+    """The rephrased front and back of a reply to a `PromptTemplate.combine_sides` prompt, or None if malformed."""
+    try:
+        reply = json.loads(_CODE_FENCE_PATTERN.sub("", completion.strip()))
+    except ValueError:
+        reply = None
+    sides = None
+    if isinstance(reply, dict) and isinstance(reply.get("front"), str) and isinstance(reply.get("back"), str):
+        sides = reply["front"], reply["back"]
+    return sides
 
 
 @dataclass
 class Prompts:
-    front: str
-    back: str
-    cloze: str
+    front: PromptTemplate
+    back: PromptTemplate
+    cloze: PromptTemplate
+    front_and_back: PromptTemplate = field(init=False)
+
+    def __post_init__(self):
+        self.front_and_back = PromptTemplate.combine_sides(front=self.front, back=self.back)
+
+    @classmethod
+    def from_config(cls, front: str, back: str, cloze: str) -> "Prompts":
+        return cls(
+            front=PromptTemplate.from_config(
+                template=front,
+                default_template=LLM_BASIC_NOTE_REPHRASING_FRONT_PROMPT,
+                legacy_default_template=LEGACY_LLM_BASIC_NOTE_REPHRASING_FRONT_PROMPT,
+                default_fields=("note_front",),
+            ),
+            back=PromptTemplate.from_config(
+                template=back,
+                default_template=LLM_NORMAL_NOTE_REPHRASING_BACK_PROMPT,
+                legacy_default_template=LEGACY_LLM_NORMAL_NOTE_REPHRASING_BACK_PROMPT,
+                default_fields=("note_back",),
+            ),
+            cloze=PromptTemplate.from_config(
+                template=cloze,
+                default_template=LLM_CLOZE_NOTE_REPHRASING_PROMPT,
+                legacy_default_template=LEGACY_LLM_CLOZE_NOTE_REPHRASING_PROMPT,
+                default_fields=("note_cloze",),
+            ),
+        )
+
+
+@dataclass
+class PromptBudget:
+    """Bounds the size of the prompts and of the completions.
+
+    A value of 0 disables the respective bound.
+    """
+    field_max_tokens: int = 0
+    output_tokens_ratio: float = 0
+
+    def fit_field(self, text: str, truncate: bool = True) -> str:
+        """The fields being rephrased must reach the model whole, as their rephrasings replace them on the card."""
+        text = compact_text(text=text)
+        if truncate and self.field_max_tokens > 0:
+            text = truncate_to_token_budget(text=text, max_tokens=self.field_max_tokens)
+        return text
+
+    def get_max_output_tokens(self, text: str) -> Optional[int]:
+        max_output_tokens = None
+        if self.output_tokens_ratio > 0:
+            max_output_tokens = max(int(estimate_tokens(text=text) * self.output_tokens_ratio), MIN_OUTPUT_TOKENS)
+        return max_output_tokens
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+# ML-Tutor Add-on for Anki
+#
+# Copyright (C)  2024 Petrov P.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version, with the additions
+# listed at the end of the license file that accompanied this program
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# NOTE: This program is subject to certain additional terms pursuant to
+# Section 7 of the GNU Affero General Public License.  You should have
+# received a copy of these additional terms immediately following the
+# terms and conditions of the GNU Affero General Public License that
+# accompanied this program.
+#
+# If not, please request a copy through one of the means of contact
+# listed here: <mailto:petioptrv@icloud.com>.
+#
+# Any modifications to this file must keep this entire header intact.
+
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, Hashable, Optional, Tuple
+
+from constants import RENDERED_CARDS_MAX_ENTRIES
+from utils import Singleton, compute_digest
+
+
+class RenderedCardsCache(metaclass=Singleton):
+    """The rephrased HTML of the upcoming cards, prepared by the prefetch threads for the main thread to look up.
+
+    Entries are keyed by card id, kind (e.g. `reviewQuestion`) and a digest of the card's HTML as received by the
+    display hook, so that a card rendered differently than predicted (e.g. by another add-on) is simply a miss.
+    They also hold the rephrasing state they were rendered from and are ignored once it changes, e.g. when the
+    next variant is due. The least recently stored entries are dropped beyond a fixed number.
+    """
+
+    def __init__(self):
+        self._entries: "OrderedDict[Tuple[int, str, bytes], Tuple[Hashable, str]]" = OrderedDict()
+        self._latest_keys: Dict[Tuple[int, str], Tuple[int, str, bytes]] = {}  # by card id and kind
+        self._lock = Lock()
+
+    def get(self, card_id: int, kind: str, text: str, state: Hashable) -> Optional[str]:
+        entry = self._entries.get((card_id, kind, compute_digest(text=text)))
+        return entry[1] if entry is not None and entry[0] == state else None
+
+    def is_rendered(self, card_id: int, kinds: Tuple[str, ...], state: Hashable) -> bool:
+        """If the latest renderings of the card for each kind are current, without rendering the card to tell."""
+        with self._lock:
+            entries = [self._entries.get(self._latest_keys.get((card_id, kind))) for kind in kinds]
+        return all(entry is not None and entry[0] == state for entry in entries)
+
+    def put(self, card_id: int, kind: str, text: str, state: Hashable, rendered_text: str):
+        key = (card_id, kind, compute_digest(text=text))
+        with self._lock:
+            self._entries[key] = (state, rendered_text)
+            self._entries.move_to_end(key)
+            self._latest_keys[(card_id, kind)] = key
+            while len(self._entries) > RENDERED_CARDS_MAX_ENTRIES:
+                dropped_key, _ = self._entries.popitem(last=False)
+                if self._latest_keys.get(dropped_key[:2]) == dropped_key:
+                    del self._latest_keys[dropped_key[:2]]
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+# ML-Tutor Add-on for Anki
+#
+# Copyright (C)  2024 Petrov P.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version, with the additions
+# listed at the end of the license file that accompanied this program
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# NOTE: This program is subject to certain additional terms pursuant to
+# Section 7 of the GNU Affero General Public License.  You should have
+# received a copy of these additional terms immediately following the
+# terms and conditions of the GNU Affero General Public License that
+# accompanied this program.
+#
+# If not, please request a copy through one of the means of contact
+# listed here: <mailto:petioptrv@icloud.com>.
+#
+# Any modifications to this file must keep this entire header intact.
+
+import re
+from typing import Optional
+
+from constants import MIN_LETTERS_RATIO_TO_REPHRASE, CJK_CHARACTERS_PER_WORD
+from utils import Singleton, remove_tags
+
+_SOUND_PATTERN = re.compile(r"\[sound:[^\]]*\]")
+_MEDIA_PATTERN = re.compile(r"<(?:img|audio|video|object|embed)\b|\[sound:[^\]]*\]", flags=re.IGNORECASE)
+_MATH_PATTERN = re.compile(r"\\\(.*?\\\)|\\\[.*?\\\]|\[\$\$?\].*?\[/\$\$?\]|\[latex\].*?\[/latex\]", flags=re.DOTALL)
+_WORD_PATTERN = re.compile(r"[^\W\d_]{2,}")
+_CJK_PATTERN = re.compile(r"[぀-ヿ㐀-䶿一-鿿가-힯]")
+
+
+class RephrasingFilter(metaclass=Singleton):
+    """Fast local check of whether a note field is worth sending to the LLM for rephrasing.
+
+    Fields made of media, formulas, symbols or too few words (e.g. single-word vocabulary cards) are rejected.
+    Words are counted per script so that texts written without spaces between words are not mistaken for one word.
+    """
+
+    def __init__(self):
+        self._min_words = 0
+        self.settings_version = 0
+
+    def set_min_words(self, min_words: int):
+        if min_words != self._min_words:
+            self._min_words = min_words
+            self.settings_version += 1
+
+    def get_skip_reason(self, html: str) -> Optional[str]:
+        skip_reason = None
+        if self._min_words > 0:
+            media_count = len(_MEDIA_PATTERN.findall(html))
+            text = remove_tags(html=_SOUND_PATTERN.sub(" ", _MATH_PATTERN.sub(" ", html)))
+            words_count = self._count_words(text=text)
+            letters_count = sum(character.isalpha() for character in text)
+            visible_characters_count = sum(not character.isspace() for character in text)
+            if words_count == 0 and media_count != 0:
+                skip_reason = "media only"
+            elif words_count < self._min_words:
+                skip_reason = "too few words"
+            elif letters_count < visible_characters_count * MIN_LETTERS_RATIO_TO_REPHRASE:
+                skip_reason = "mostly symbols"
+        return skip_reason
+
+    @staticmethod
+    def _count_words(text: str) -> int:
+        cjk_characters_count = len(_CJK_PATTERN.findall(text))
+        words_count = len(_WORD_PATTERN.findall(_CJK_PATTERN.sub(" ", text)))
+        return words_count + cjk_characters_count // CJK_CHARACTERS_PER_WORD
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+# ML-Tutor Add-on for Anki
+#
+# Copyright (C)  2024 Petrov P.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version, with the additions
+# listed at the end of the license file that accompanied this program
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# NOTE: This program is subject to certain additional terms pursuant to
+# Section 7 of the GNU Affero General Public License.  You should have
+# received a copy of these additional terms immediately following the
+# terms and conditions of the GNU Affero General Public License that
+# accompanied this program.
+#
+# If not, please request a copy through one of the means of contact
+# listed here: <mailto:petioptrv@icloud.com>.
+#
+# Any modifications to this file must keep this entire header intact.
+
+from threading import Lock
+from typing import Dict, NamedTuple, Optional, Tuple, Union
+
+from constants import REPHRASING_STORE_LOCK_STRIPES
+from note_versions import NoteVersion
+from utils import Singleton
+
+
+class FieldRephrasings(NamedTuple):
+    rephrasings: Tuple[Union[str, bytes], ...]
+    original_digest: bytes
+    version: NoteVersion
+    cursor: int = 0  # the variant currently displayed
+
+
+class RephrasingStore(metaclass=Singleton):
+    """The rephrasings of the note fields, shared by the main thread and the prefetch threads.
+
+    Records are immutable and swapped as a whole, so readers always see a consistent record without taking a lock.
+    Writers lock one of several stripes, chosen by note id, only to serialize the updates that depend on the
+    current record of the same note.
+    """
+
+    def __init__(self):
+        self._records: Dict[Tuple[int, str], FieldRephrasings] = {}
+        self._locks = tuple(Lock() for _ in range(REPHRASING_STORE_LOCK_STRIPES))
+
+    def get(self, note_id: int, field: str) -> Optional[FieldRephrasings]:
+        return self._records.get((note_id, field))
+
+    def put(self, note_id: int, field: str, record: FieldRephrasings) -> bool:
+        """Stores the record unless the stored one was generated from a more recent version of the note."""
+        key = (note_id, field)
+        with self._get_lock(note_id=note_id):
+            current_record = self._records.get(key)
+            stored = current_record is None or current_record.version <= record.version
+            if stored:
+                self._records[key] = record
+        return stored
+
+    def update_version(self, note_id: int, field: str, record: FieldRephrasings, version: NoteVersion):
+        """Marks the record as current for the version of the note, if it has not been replaced in the meantime."""
+        key = (note_id, field)
+        with self._get_lock(note_id=note_id):
+            if self._records.get(key) is record:
+                self._records[key] = record._replace(version=version)
+
+    def advance_cursors(self, note_id: int, fields: Tuple[str, ...]):
+        with self._get_lock(note_id=note_id):
+            for field in fields:
+                record = self._records.get((note_id, field))
+                if record is not None:
+                    self._records[(note_id, field)] = record._replace(cursor=record.cursor + 1)
+
+    def _get_lock(self, note_id: int) -> Lock:
+        return self._locks[note_id % len(self._locks)]
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+# ML-Tutor Add-on for Anki
+#
+# Copyright (C)  2024 Petrov P.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version, with the additions
+# listed at the end of the license file that accompanied this program
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# NOTE: This program is subject to certain additional terms pursuant to
+# Section 7 of the GNU Affero General Public License.  You should have
+# received a copy of these additional terms immediately following the
+# terms and conditions of the GNU Affero General Public License that
+# accompanied this program.
+#
+# If not, please request a copy through one of the means of contact
+# listed here: <mailto:petioptrv@icloud.com>.
+#
+# Any modifications to this file must keep this entire header intact.
+
+import hashlib
+import json
+import logging
+import os
+import secrets
+import time
+from dataclasses import dataclass, asdict
+from threading import Lock
+from typing import List, Optional
+
+from anki.cards import Card
+from anki.notes import Note
+
+from constants import TUTOR_NAME
+from utils import Singleton, remove_tags, estimate_tokens
+
+_QUEUE_NAMES = {0: "new", 1: "learning", 2: "review", 3: "learning", 4: "learning"}
+
+
+@dataclass(frozen=True)
+class ReviewTraceEntry:
+    offset_seconds: float  # when the card was shown, since the start of the trace
+    note: str  # salted digest of the note id
+    note_type: str  # the add-on's name of the note type, "other" for unsupported ones
+    note_tokens: int
+    card_ord: int
+    queue: str  # "new", "learning" or "review"
+    ease_factor: int
+    interval: int
+    reps: int
+    answer_seconds: float  # from showing the card to showing its answer
+    review_seconds: float  # from showing the card to answering it
+    ease: int
+
+
+def read_trace(path: str) -> List[ReviewTraceEntry]:
+    with open(path, encoding="utf-8") as f:
+        return [ReviewTraceEntry(**json.loads(line)) for line in f if line.strip() != ""]
+
+
+class ReviewTraceRecorder(metaclass=Singleton):
+    """Records anonymized traces of the review sessions, to be replayed by `prefetch_simulator.py`.
+
+    A trace is a JSON-lines file with one entry per answered card. The content of the notes is not kept: notes are
+    identified by digests of their ids salted per trace, and described by their type and estimated number of tokens.
+    """
+
+    def __init__(self):
+        self._output_dir: Optional[str] = None
+        self._trace_path: Optional[str] = None
+        self._salt = ""
+        self._start_ts: Optional[float] = None
+        self._shown_card_id: Optional[int] = None
+        self._shown_entry: Optional[dict] = None
+        self._answer_shown_ts: Optional[float] = None
+        self._lock = Lock()
+
+    @property
+    def is_recording(self) -> bool:
+        return self._output_dir is not None
+
+    def start(self, output_dir: str):
+        with self._lock:
+            if not self.is_recording:
+                self._output_dir = output_dir
+                self._trace_path = None  # the file is created with the first entry
+                self._start_ts = None
+                self._salt = secrets.token_hex(16)
+                logging.info(f"[{TUTOR_NAME}] Recording review traces to {output_dir}.")
+
+    def stop(self):
+        with self._lock:
+            self._output_dir = None
+            self._shown_card_id = None
+            self._shown_entry = None
+
+    def record_card_shown(self, card: Card, note: Note, note_type: str):
+        if self.is_recording:
+            now = time.monotonic()
+            with self._lock:
+                if self._start_ts is None:
+                    self._start_ts = now
+                self._shown_card_id = card.id
+                self._answer_shown_ts = None
+                self._shown_entry = {
+                    "offset_seconds": round(now - self._start_ts, 3),
+                    "note": hashlib.blake2b(f"{self._salt}{note.id}".encode("utf-8"), digest_size=8).hexdigest(),
+                    "note_type": note_type or "other",
+                    "note_tokens": estimate_tokens(text=remove_tags(html=" ".join(note.fields))),
+                    "card_ord": card.ord,
+                    "queue": _QUEUE_NAMES.get(card.queue, "review"),
+                    "ease_factor": card.factor,
+                    "interval": card.ivl,
+                    "reps": card.reps,
+                }
+
+    def record_answer_shown(self, card: Card):
+        if self.is_recording and card.id == self._shown_card_id and self._answer_shown_ts is None:
+            self._answer_shown_ts = time.monotonic()
+
+    def record_card_answered(self, card: Card, ease: int):
+        if self.is_recording and card.id == self._shown_card_id:
+            now = time.monotonic()
+            with self._lock:
+                if self._shown_entry is None:
+                    return
+                shown_ts = self._start_ts + self._shown_entry["offset_seconds"]
+                entry = ReviewTraceEntry(
+                    **self._shown_entry,
+                    answer_seconds=round((self._answer_shown_ts or now) - shown_ts, 3),
+                    review_seconds=round(now - shown_ts, 3),
+                    ease=ease,
+                )
+                self._shown_card_id = None
+                self._shown_entry = None
+                self._write_entry(entry=entry)
+
+    def _write_entry(self, entry: ReviewTraceEntry):
+        try:
+            if self._trace_path is None:
+                os.makedirs(self._output_dir, exist_ok=True)
+                self._trace_path = os.path.join(self._output_dir, time.strftime("trace-%Y%m%d-%H%M%S.jsonl"))
+            with open(self._trace_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(asdict(entry)) + "\n")
+        except OSError:
+            logging.exception(f"[{TUTOR_NAME}] Failed to write the review trace.")
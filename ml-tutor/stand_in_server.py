@@ -0,0 +1,398 @@
+# -*- coding: utf-8 -*-
+
+# ML-Tutor Add-on for Anki
+#
+# Copyright (C)  2024 Petrov P.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version, with the additions
+# listed at the end of the license file that accompanied this program
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# NOTE: This program is subject to certain additional terms pursuant to
+# Section 7 of the GNU Affero General Public License.  You should have
+# received a copy of these additional terms immediately following the
+# terms and conditions of the GNU Affero General Public License that
+# accompanied this program.
+#
+# If not, please request a copy through one of the means of contact
+# listed here: <mailto:petioptrv@icloud.com>.
+#
+# Any modifications to this file must keep this entire header intact.
+
+"""A local stand-in for the OpenAI API, to load-test the add-on without an account or network.
+
+It serves `/v1/models` and `/v1/chat/completions` with sampled latencies and injects server errors, throttling
+(429 with `Retry-After`) and slow responses whose body is dribbled out in chunks. Completions echo the note text
+of the prompt, so cloze deletions survive, and reply with JSON when both sides of a note are requested at once.
+The counters of what was served are available at `/stand-in/stats`.
+
+    python stand_in_server.py --latency lognormal:0.8,0.5 --error-rate 0.05 --throttle-rate 0.05
+"""
+
+import argparse
+import json
+import logging
+import math
+import random
+import time
+from collections import deque
+from dataclasses import dataclass, field, asdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Lock, Thread
+from typing import Deque, List, Optional, Tuple
+
+from constants import TUTOR_NAME
+
+DEFAULT_PORT = 8765
+_SERVER_ERROR_STATUS_CODES = (500, 502, 503)
+_SLOW_RESPONSE_CHUNKS = 10
+
+
+class LatencyDistribution:
+    """Samples durations in seconds from a spec like `fixed:0.5`, `uniform:0.2,1.5` or `lognormal:0.8,0.5`.
+
+    The parameters of the log-normal distribution are its median and the standard deviation of its logarithm.
+    """
+
+    def __init__(self, spec: str):
+        kind, _, params = spec.partition(":")
+        try:
+            values = [float(param) for param in params.split(",") if param != ""]
+        except ValueError:
+            raise ValueError(f"Invalid latency distribution {spec!r}.")
+        expected_params_count = {"fixed": 1, "uniform": 2, "lognormal": 2}.get(kind)
+        if expected_params_count is None or len(values) != expected_params_count or min(values) < 0:
+            raise ValueError(f"Invalid latency distribution {spec!r}.")
+        self.spec = spec
+        self._kind = kind
+        self._values = values
+
+    def sample(self, rng: random.Random) -> float:
+        if self._kind == "fixed":
+            duration = self._values[0]
+        elif self._kind == "uniform":
+            duration = rng.uniform(*self._values)
+        else:
+            median, sigma = self._values
+            duration = median * math.exp(rng.gauss(0, sigma)) if median > 0 else 0.0
+        return duration
+
+
+@dataclass
+class StandInSettings:
+    latency: LatencyDistribution = field(default_factory=lambda: LatencyDistribution(spec="fixed:0"))
+    error_rate: float = 0.0  # share of the completions answered with a 5xx
+    throttle_rate: float = 0.0  # share of the completions answered with a 429
+    retry_after_seconds: int = 1
+    slow_response_rate: float = 0.0  # share of the completions whose body is dribbled out
+    slow_response_seconds: float = 10.0
+    requests_per_minute: int = 0  # a real quota, answered with 429 once exceeded, 0 for none
+    models: Tuple[str, ...] = ("gpt-3.5-turbo",)
+    api_keys: Tuple[str, ...] = ()  # the keys accepted, any key if empty
+    seed: Optional[int] = None
+
+
+@dataclass
+class StandInStats:
+    requests_count: int = 0
+    completions_count: int = 0
+    server_errors_count: int = 0
+    throttled_count: int = 0
+    slow_responses_count: int = 0
+    unauthorized_count: int = 0
+
+
+class _RequestWindow:
+    """The timestamps of the requests of the last minute, to enforce the quota and report the rate-limit headers."""
+
+    def __init__(self, requests_per_minute: int):
+        self._requests_per_minute = requests_per_minute
+        self._timestamps: Deque[float] = deque()
+
+    def acquire(self) -> Tuple[bool, Optional[int], Optional[float]]:
+        """Whether the request is within the quota, the requests left and the seconds until one more is allowed."""
+        if self._requests_per_minute <= 0:
+            return True, None, None
+        now = time.monotonic()
+        while len(self._timestamps) != 0 and self._timestamps[0] <= now - 60:
+            self._timestamps.popleft()
+        accepted = len(self._timestamps) < self._requests_per_minute
+        if accepted:
+            self._timestamps.append(now)
+        remaining = self._requests_per_minute - len(self._timestamps)
+        reset_seconds = self._timestamps[0] + 60 - now if len(self._timestamps) != 0 else 0.0
+        return accepted, remaining, reset_seconds
+
+
+class StandInServer:
+    def __init__(self, settings: StandInSettings, host: str = "127.0.0.1", port: int = DEFAULT_PORT):
+        self.settings = settings
+        self._stats = StandInStats()
+        self._lock = Lock()
+        self._rng = random.Random(settings.seed)
+        self._window = _RequestWindow(requests_per_minute=settings.requests_per_minute)
+        self._server = ThreadingHTTPServer((host, port), self._build_handler_cls())
+        self._server.daemon_threads = True
+        self._thread: Optional[Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    @property
+    def stats(self) -> StandInStats:
+        with self._lock:
+            return StandInStats(**asdict(self._stats))
+
+    def start(self):
+        """Serves from a background thread."""
+        self._thread = Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _build_handler_cls(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                server._handle_get(handler=self)
+
+            def do_POST(self):
+                server._handle_post(handler=self)
+
+            def log_message(self, format_: str, *args):
+                logging.debug(f"[{TUTOR_NAME}] Stand-in server: {format_ % args}")
+
+        return Handler
+
+    def _handle_get(self, handler: BaseHTTPRequestHandler):
+        if handler.path == "/stand-in/stats":
+            self._send_json(handler=handler, status_code=200, body=asdict(self.stats))
+        elif not self._check_api_key(handler=handler):
+            self._send_error(handler=handler, status_code=401, message="Incorrect API key provided.")
+        elif handler.path == "/v1/models":
+            body = {"object": "list", "data": [self._build_model(model=model) for model in self.settings.models]}
+            self._send_json(handler=handler, status_code=200, body=body)
+        elif handler.path.startswith("/v1/models/") and handler.path.split("/")[-1] in self.settings.models:
+            self._send_json(handler=handler, status_code=200, body=self._build_model(model=handler.path.split("/")[-1]))
+        else:
+            self._send_error(handler=handler, status_code=404, message=f"Unknown path {handler.path}.")
+
+    def _handle_post(self, handler: BaseHTTPRequestHandler):
+        request_body = handler.rfile.read(int(handler.headers.get("Content-Length", 0)))
+        with self._lock:
+            self._stats.requests_count += 1
+        if handler.path != "/v1/chat/completions":
+            self._send_error(handler=handler, status_code=404, message=f"Unknown path {handler.path}.")
+        elif not self._check_api_key(handler=handler):
+            with self._lock:
+                self._stats.unauthorized_count += 1
+            self._send_error(handler=handler, status_code=401, message="Incorrect API key provided.")
+        else:
+            try:
+                request = json.loads(request_body)
+                model = request["model"]
+                messages = request["messages"]
+                n = int(request.get("n", 1))
+            except (ValueError, KeyError, TypeError):
+                self._send_error(handler=handler, status_code=400, message="Invalid request body.")
+                return
+            if model not in self.settings.models:
+                self._send_error(handler=handler, status_code=404, message=f"The model {model} does not exist.")
+                return
+            self._complete(handler=handler, model=model, messages=messages, n=n)
+
+    def _complete(self, handler: BaseHTTPRequestHandler, model: str, messages: List[dict], n: int):
+        with self._lock:
+            latency = self.settings.latency.sample(rng=self._rng)
+            outcome_draw = self._rng.random()
+            accepted, remaining, reset_seconds = self._window.acquire()
+        rate_limit_headers = {}
+        if remaining is not None:
+            rate_limit_headers = {
+                "x-ratelimit-limit-requests": str(self.settings.requests_per_minute),
+                "x-ratelimit-remaining-requests": str(remaining),
+                "x-ratelimit-reset-requests": f"{reset_seconds:.3f}s",
+            }
+        time.sleep(latency)
+
+        settings = self.settings
+        if not accepted or outcome_draw < settings.throttle_rate:
+            with self._lock:
+                self._stats.throttled_count += 1
+            retry_after = math.ceil(reset_seconds) if not accepted else settings.retry_after_seconds
+            self._send_error(
+                handler=handler,
+                status_code=429,
+                message="Rate limit reached for requests.",
+                headers={**rate_limit_headers, "Retry-After": str(retry_after)},
+            )
+        elif outcome_draw < settings.throttle_rate + settings.error_rate:
+            with self._lock:
+                self._stats.server_errors_count += 1
+            self._send_error(
+                handler=handler,
+                status_code=self._rng.choice(_SERVER_ERROR_STATUS_CODES),
+                message="The server had an error while processing your request.",
+                headers=rate_limit_headers,
+            )
+        else:
+            is_slow = outcome_draw < settings.throttle_rate + settings.error_rate + settings.slow_response_rate
+            with self._lock:
+                self._stats.completions_count += n
+                self._stats.slow_responses_count += is_slow
+            self._send_json(
+                handler=handler,
+                status_code=200,
+                body=self._build_completion(model=model, messages=messages, n=n),
+                headers=rate_limit_headers,
+                dribble_seconds=settings.slow_response_seconds if is_slow else 0.0,
+            )
+
+    def _check_api_key(self, handler: BaseHTTPRequestHandler) -> bool:
+        authorization = handler.headers.get("Authorization", "")
+        api_key = authorization[len("Bearer "):] if authorization.startswith("Bearer ") else ""
+        return api_key != "" and (len(self.settings.api_keys) == 0 or api_key in self.settings.api_keys)
+
+    @staticmethod
+    def _build_model(model: str) -> dict:
+        return {"id": model, "object": "model", "created": 0, "owned_by": "stand-in"}
+
+    @staticmethod
+    def _build_completion(model: str, messages: List[dict], n: int) -> dict:
+        # the note text follows the field labels of the user message, e.g. "Note front: ..."
+        note = messages[-1]["content"] if len(messages) != 0 else ""
+        fields = dict(line.partition(": ")[::2] for line in note.splitlines() if line.strip() != "")
+        text = " ".join(value or label for label, value in fields.items())
+        instructions = " ".join(message["content"] for message in messages[:-1])
+        # both sides of a reversed note are requested as a JSON object
+        is_combined = "JSON object" in instructions and "Note front" in fields and "Note back" in fields
+        prompt_tokens = sum(len(message["content"].split()) for message in messages)
+        choices = [
+            {
+                "index": i,
+                "message": {
+                    "role": "assistant",
+                    "content": json.dumps({
+                        "front": f"Put differently ({i + 1}): {fields['Note front']}",
+                        "back": f"Put differently ({i + 1}): {fields['Note back']}",
+                    }) if is_combined else f"Put differently ({i + 1}): {text}",
+                },
+                "finish_reason": "stop",
+            }
+            for i in range(n)
+        ]
+        completion_tokens = sum(len(choice["message"]["content"].split()) for choice in choices)
+        return {
+            "id": f"chatcmpl-stand-in-{time.monotonic_ns()}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": choices,
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+    def _send_error(self, handler: BaseHTTPRequestHandler, status_code: int, message: str, headers: dict = None):
+        body = {"error": {"message": message, "type": "stand_in_error", "code": status_code}}
+        self._send_json(handler=handler, status_code=status_code, body=body, headers=headers)
+
+    @staticmethod
+    def _send_json(
+        handler: BaseHTTPRequestHandler,
+        status_code: int,
+        body: dict,
+        headers: dict = None,
+        dribble_seconds: float = 0.0,
+    ):
+        payload = json.dumps(body).encode("utf-8")
+        try:
+            handler.send_response(status_code)
+            handler.send_header("Content-Type", "application/json")
+            handler.send_header("Content-Length", str(len(payload)))
+            for name, value in (headers or {}).items():
+                handler.send_header(name, value)
+            handler.end_headers()
+            if dribble_seconds > 0:
+                chunk_size = math.ceil(len(payload) / _SLOW_RESPONSE_CHUNKS)
+                for start in range(0, len(payload), chunk_size):
+                    handler.wfile.write(payload[start:start + chunk_size])
+                    handler.wfile.flush()
+                    time.sleep(dribble_seconds / _SLOW_RESPONSE_CHUNKS)
+            else:
+                handler.wfile.write(payload)
+        except (BrokenPipeError, ConnectionResetError):  # the client gave up, e.g. on a read timeout
+            pass
+
+
+def add_settings_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--latency", default="lognormal:0.8,0.5", help="e.g. fixed:0.5, uniform:0.2,1.5.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of completions failing with a 5xx.")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Share of completions throttled (429).")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After of the throttled completions.")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="Share of completions sent slowly.")
+    parser.add_argument("--slow-seconds", type=float, default=10.0, help="Time taken to send a slow completion.")
+    parser.add_argument("--requests-per-minute", type=int, default=0, help="Quota enforced with 429s, 0 for none.")
+    parser.add_argument("--models", nargs="+", default=["gpt-3.5-turbo"], help="Models served.")
+    parser.add_argument("--api-keys", nargs="*", default=[], help="Keys accepted, any key if none are given.")
+    parser.add_argument("--seed", type=int, help="Seed of the latencies and injected failures.")
+
+
+def build_settings(args: argparse.Namespace) -> StandInSettings:
+    return StandInSettings(
+        latency=LatencyDistribution(spec=args.latency),
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        retry_after_seconds=args.retry_after,
+        slow_response_rate=args.slow_rate,
+        slow_response_seconds=args.slow_seconds,
+        requests_per_minute=args.requests_per_minute,
+        models=tuple(args.models),
+        api_keys=tuple(args.api_keys),
+        seed=args.seed,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a local stand-in for the OpenAI API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    add_settings_arguments(parser=parser)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    server = StandInServer(settings=build_settings(args=args), host=args.host, port=args.port)
+    logging.info(f"[{TUTOR_NAME}] Stand-in OpenAI API served at {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        logging.info(f"[{TUTOR_NAME}] Served: {asdict(server.stats)}")
+
+
+if __name__ == "__main__":
+    main()
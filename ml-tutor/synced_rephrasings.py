@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+# ML-Tutor Add-on for Anki
+#
+# Copyright (C)  2024 Petrov P.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version, with the additions
+# listed at the end of the license file that accompanied this program
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# NOTE: This program is subject to certain additional terms pursuant to
+# Section 7 of the GNU Affero General Public License.  You should have
+# received a copy of these additional terms immediately following the
+# terms and conditions of the GNU Affero General Public License that
+# accompanied this program.
+#
+# If not, please request a copy through one of the means of contact
+# listed here: <mailto:petioptrv@icloud.com>.
+#
+# Any modifications to this file must keep this entire header intact.
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+from threading import Lock
+from typing import Dict, List, Optional
+
+from constants import TUTOR_NAME, SYNCED_REPHRASINGS_FILE_NAME, SYNCED_REPHRASINGS_MAX_ENTRIES
+from negative_cache import NegativeCache
+from utils import Singleton
+
+
+class SyncedRephrasings(metaclass=Singleton):
+    """Rephrasings shared between devices through a file in the collection media folder.
+
+    Anki syncs the media folder, so the rephrasings generated on one device can be loaded on the others instead of
+    being requested again. Entries are keyed by a hash of the prompt that produced them and the file is stored as
+    gzipped JSON, along with the entries of the negative cache. Files starting with an underscore are never
+    reported as unused by Anki's media check.
+    """
+
+    def __init__(self):
+        self._enabled = False
+        self._entries: Dict[str, List[str]] = {}
+        self._negative_cache = NegativeCache()
+        self._dirty = False
+        self._lock = Lock()
+
+    def set_enabled(self, enabled: bool):
+        self._enabled = enabled
+
+    @staticmethod
+    def make_key(prompt: str) -> str:
+        return hashlib.sha1(prompt.encode("utf-8")).hexdigest()[:16]
+
+    def get(self, key: str) -> Optional[List[str]]:
+        rephrasings = None
+        if self._enabled:
+            rephrasings = self._entries.get(key)
+        return rephrasings
+
+    def put(self, key: str, rephrasings: List[str]):
+        if self._enabled:
+            with self._lock:
+                self._entries.pop(key, None)  # re-inserting keeps the most recent entries last
+                self._entries[key] = rephrasings
+                while len(self._entries) > SYNCED_REPHRASINGS_MAX_ENTRIES:
+                    del self._entries[next(iter(self._entries))]
+                self._dirty = True
+
+    def load(self, media_dir: str):
+        """Merges the entries of the synced file into the entries of this session."""
+        path = os.path.join(media_dir, SYNCED_REPHRASINGS_FILE_NAME)
+        if self._enabled and os.path.exists(path):
+            self._merge_file(path=path)
+
+    def save(self, media_dir: str):
+        """Writes the entries of this session, merged with those written to the file since it was loaded.
+
+        The file may have been updated by a media sync or by the precompute script in the meantime.
+        """
+        if self._enabled and (self._dirty or self._negative_cache.dirty):
+            path = os.path.join(media_dir, SYNCED_REPHRASINGS_FILE_NAME)
+            if os.path.exists(path):
+                self._merge_file(path=path)
+            with self._lock:
+                while len(self._entries) > SYNCED_REPHRASINGS_MAX_ENTRIES:
+                    del self._entries[next(iter(self._entries))]
+                data = json.dumps(
+                    {"rephrasings": self._entries, "failures": self._negative_cache.export_entries()},
+                    ensure_ascii=False,
+                    separators=(",", ":"),
+                )
+                self._dirty = False
+            try:
+                with gzip.open(path, mode="wt", encoding="utf-8") as f:
+                    f.write(data)
+            except Exception:
+                logging.exception(f"[{TUTOR_NAME}] Failed to save the synced rephrasings.")
+
+    def _merge_file(self, path: str):
+        """Merges the entries of the file into the entries of this session, which take precedence."""
+        try:
+            with gzip.open(path, mode="rt", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception:
+            logging.exception(f"[{TUTOR_NAME}] Failed to load the synced rephrasings.")
+        else:
+            if "rephrasings" in data:
+                synced_entries: Dict[str, List[str]] = data["rephrasings"]
+                self._negative_cache.merge_entries(entries=data.get("failures", {}))
+            else:  # files written before the negative cache was synced only hold the rephrasings
+                synced_entries = data
+            with self._lock:
+                session_entries = self._entries
+                self._entries = synced_entries
+                for key, rephrasings in session_entries.items():
+                    self._entries.pop(key, None)
+                    self._entries[key] = rephrasings
+                self._dirty = len(session_entries) != 0
@@ -29,12 +29,14 @@
 #
 # Any modifications to this file must keep this entire header intact.
 
+import hashlib
+import math
 import re
 import warnings
 
 from bs4 import BeautifulSoup, Tag, MarkupResemblesLocatorWarning
 
-from constants import NOTE_TEXT_PARSER
+from constants import NOTE_TEXT_PARSER, CHARACTERS_PER_TOKEN, TRUNCATED_TEXT_MARKER
 
 warnings.filterwarnings("ignore", category=MarkupResemblesLocatorWarning)
 
@@ -74,3 +76,44 @@ def build_html_paragraph_from_text(soup: BeautifulSoup, text: str) -> Tag:
 def strip_spaces_before_punctuation(text: str) -> str:
     text = re.sub(r'\s([?.!"](?:\s|$))', r'\1', text)  # https://stackoverflow.com/a/18878970
     return text
+
+
+def normalize_text(text: str) -> str:
+    """Lowercases the text and drops its punctuation and extra whitespace."""
+    text = re.sub(pattern=r"[^\w\s]", repl=" ", string=text.lower())
+    text = re.sub(pattern=r"\s+", repl=" ", string=text)
+    return text.strip()
+
+
+def compute_digest(text: str) -> bytes:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough local estimate of the number of LLM tokens in the text.
+
+    Uses the common approximation of a fixed number of characters per token, but never counts fewer tokens than
+    there are words and punctuation marks.
+    """
+    words_count = len(re.findall(pattern=r"\w+|[^\w\s]", string=text))
+    return max(math.ceil(len(text) / CHARACTERS_PER_TOKEN), words_count)
+
+
+def compact_text(text: str) -> str:
+    text = re.sub(pattern=r"\[sound:[^\]]*\]", repl="", string=text)  # audio references
+    text = re.sub(pattern=r"https?://\S+", repl="", string=text)  # links
+    text = re.sub(pattern=r"[ \t]+", repl=" ", string=text)
+    text = re.sub(pattern=r"\s*\n\s*", repl="\n", string=text)
+    return text.strip()
+
+
+def truncate_to_token_budget(text: str, max_tokens: int) -> str:
+    if estimate_tokens(text=text) <= max_tokens:
+        return text
+    truncated_text = text[:max_tokens * CHARACTERS_PER_TOKEN]
+    while len(truncated_text) != 0 and estimate_tokens(text=truncated_text) > max_tokens:
+        truncated_text = truncated_text[:int(len(truncated_text) * 0.9)]
+    last_space_index = truncated_text.rfind(" ")
+    if last_space_index > 0:
+        truncated_text = truncated_text[:last_space_index]
+    return f"{truncated_text}{TRUNCATED_TEXT_MARKER}"
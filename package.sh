@@ -1,4 +1,5 @@
 # Package the ml-tutor directory into a zip file, ignoring all files and directories that start with a dot, as well
-# as __pycache__ directories.
+# as __pycache__ directories and the development scripts that the add-on does not use.
 # Usage: ./package.sh
-cd ml-tutor && zip -r ../ml-tutor.ankiaddon * -x "*/\.*" -x "*/__pycache__/*" -x "*/meta.json"
+cd ml-tutor && zip -r ../ml-tutor.ankiaddon * -x "*/\.*" -x "__pycache__/*" -x "*/__pycache__/*" -x "*/meta.json" \
+    -x "load_test.py" -x "stand_in_server.py" -x "prefetch_simulator.py" -x "precompute.py"